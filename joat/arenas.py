@@ -1,11 +1,48 @@
 from __future__ import annotations
 
+import collections
+import contextlib
+import logging
+import threading
+import time
+from collections.abc import Callable, Iterator, Mapping
+from typing import TYPE_CHECKING, Final
+
 import attrs
 from attrs import field
 from panda3d import bullet
-from panda3d.core import AsyncTaskPause, ClockObject, LPoint3, NodePath, Vec3
+from panda3d.core import (
+    AsyncTask,
+    AsyncTaskPause,
+    ClockObject,
+    CollideMask,
+    LPoint3,
+    NodePath,
+    TransformState,
+    Vec3,
+)
 
+from . import control, physics, spatial, tasks, wireframes
 from .debug import DebugHandler
+from .rng import RandomStreams
+
+if TYPE_CHECKING:
+    from .scenery import StaticGeometry
+
+_logger: Final = logging.getLogger(__name__)
+
+# How far the grid drawn on an open plane reaches across
+GROUND_GRID_SIZE: Final = 20
+
+
+@attrs.frozen
+class TransformSnapshot:
+    """The transforms of an arena's bodies, relative to its root,
+    at a moment in simulation time.
+    """
+
+    time: float = 0
+    transforms: Mapping[NodePath, TransformState] = attrs.Factory(dict)
 
 
 @attrs.define
@@ -13,35 +50,367 @@ class Arena:
     root: NodePath
     world: bullet.BulletWorld
     ground: NodePath[bullet.BulletRigidBodyNode] = field(init=False)
+    # Static walls and props, if the arena has any
+    scenery: NodePath[bullet.BulletRigidBodyNode] | None = field(
+        default=None, init=False
+    )
     running: bool = field(default=False, init=False)
-    debug_handler: DebugHandler = attrs.Factory(DebugHandler.for_arena, takes_self=True)
+    debug_handler: DebugHandler | None = attrs.Factory(
+        DebugHandler.for_arena, takes_self=True
+    )
+    # The source of every random roll made in battle, so that a battle can
+    # be replayed from its seed and the players' inputs
+    rng: RandomStreams = field(factory=RandomStreams.from_entropy, kw_only=True)
+    # Shapes added to the ground plane, which may be shared with other arenas
+    geometry: StaticGeometry | None = field(default=None, kw_only=True)
+    # The length of each physics step. When the world runs on its own task
+    # chain, it is always stepped by exactly this much.
+    step_size: float = 1 / 60
+    max_steps_per_frame: int = 4
+    sim_time: float = field(default=0, init=False)
+    # Whether tracked bodies are shown between their last two states
+    interpolate: bool = True
+    # Whether the ground, scenery and tracked bodies are drawn as
+    # wireframes under `visuals`, rather than only by the debug node
+    draw: bool = True
+    # How far past the current snapshot the simulation has got, in steps
+    step_fraction: float = field(default=1, init=False)
+    task_chain: str | None = field(default=None, init=False)
+    # Called with the step size after every step of the world
+    step_callbacks: list[Callable[[float], object]] = field(factory=list, init=False)
+    controllers: control.ControllerBank = field(
+        factory=control.ControllerBank, init=False
+    )
+    # Tasks that run for as long as the arena does, like those of a battle
+    # in it, which are cancelled when it exits
+    task_group: tasks.TaskGroup = field(
+        factory=lambda: tasks.TaskGroup('arena'), init=False
+    )
+    # Bodies whose transforms are published in `snapshots`, each mapped
+    # to a node that follows it on the rendering side
+    proxies: dict[NodePath, NodePath] = field(factory=dict, init=False)
+    visuals: NodePath = field(init=False)
+    # The previous and current snapshots, replaced as a pair after each
+    # step so that readers on other threads always see a consistent state
+    snapshots: tuple[TransformSnapshot, TransformSnapshot] = field(
+        default=(TransformSnapshot(), TransformSnapshot()), init=False
+    )
+    # While idle, the world is only stepped once every `idle_step` seconds.
+    # Use `math.inf` to stop stepping entirely until something wakes it.
+    idle_step: float = 0.25
+    settle_time: float = 0.5
+    linear_tolerance: float = 0.05
+    angular_tolerance: float = 0.1
+    idle: bool = field(default=False, init=False)
+    # While paused, the world isn't stepped at all, e.g. so that peers in
+    # a lockstep battle don't step it while waiting on each other.
+    paused: bool = field(default=False, init=False)
+    # The team of each collision group given out, starting from the one
+    # after the group of static geometry
+    _group_teams: list[int | None] = field(factory=list, init=False, repr=False)
+    _settled_time: float = field(default=0, init=False, repr=False)
+    _wake_holds: int = field(default=0, init=False, repr=False)
+    _next_step_time: float = field(default=0, init=False, repr=False)
+    _last_step_time: float = field(default=0, init=False, repr=False)
+    _presented: TransformSnapshot | None = field(default=None, init=False, repr=False)
+    # Held while the world is stepped. Anything that adds to, removes from
+    # or queries the world from another thread than the one stepping it
+    # must hold it too, so that it happens between steps.
+    world_lock: threading.RLock = field(factory=threading.RLock, init=False, repr=False)
+    # Calls queued by `call_on_main` from the physics thread
+    _main_calls: collections.deque[Callable[[], object]] = field(
+        factory=collections.deque, init=False, repr=False
+    )
 
     def __attrs_post_init__(self) -> None:
         ground_node = bullet.BulletRigidBodyNode('Ground')
         ground_node.add_shape(bullet.BulletPlaneShape(Vec3(0, 0, 1), 0))
+        if self.geometry is not None:
+            for shape, transform in self.geometry.ground:
+                ground_node.add_shape(shape, transform)
         self.ground = self.root.attach_new_node(ground_node)
         self.ground.set_pos(0, 0, 0)
+        self.ground.set_collide_mask(CollideMask.bit(physics.STATIC_GROUP))
         self.world.attach(ground_node)
+        if self.geometry is not None and self.geometry.scenery:
+            scenery_node = bullet.BulletRigidBodyNode('Scenery')
+            for shape, transform in self.geometry.scenery:
+                scenery_node.add_shape(shape, transform)
+            self.scenery = self.root.attach_new_node(scenery_node)
+            self.scenery.set_collide_mask(CollideMask.bit(physics.STATIC_GROUP))
+            self.world.attach(scenery_node)
+        self.visuals = self.root.attach_new_node('Visuals')
+        if self.draw:
+            self.draw_static()
+        self.step_callbacks.append(self.controllers.update)
+
+    def draw_static(self) -> None:
+        """Draw the ground and scenery, which never move."""
+        if self.geometry is None or not self.geometry.ground:
+            self.visuals.attach_new_node(wireframes.draw_grid(GROUND_GRID_SIZE))
+        if self.geometry is not None and self.geometry.model is not None:
+            self.geometry.model.instance_to(self.visuals)
+
+    def add_collision_group(self, team: int | None = None) -> CollideMask:
+        """Return the collide mask of a new collision group, which collides
+        with everything except the other groups of the same team.
+
+        Giving each fighter a group of their own keeps their parts
+        colliding with each other.
+        """
+        first = physics.STATIC_GROUP + 1
+        group = first + len(self._group_teams)
+        if group >= physics.QUERY_GROUP:
+            raise ValueError(f'An arena can have at most {group - first} fighters')
+        if team is not None:
+            for other, other_team in enumerate(self._group_teams, start=first):
+                if other_team == team:
+                    self.world.set_group_collision_flag(group, other, False)
+        self._group_teams.append(team)
+        return CollideMask.bit(group)
+
+    def start(self, *, task_chain: str | None = None) -> None:
+        """Start simulating the arena.
+
+        If `task_chain` is given, the world is stepped at a fixed rate
+        on that chain, which should have its own thread. Otherwise, it is
+        stepped once per frame on the main thread.
+        """
+        self.running = True
+        self.task_chain = task_chain
+        if task_chain is None:
+            self.task_group.add(self.update())
+        else:
+            self.task_group.add(self.fixed_update, chain=task_chain)
+        self.task_group.add(self.sync_visuals())
 
     async def update(self) -> None:
+        """Step the world by `step_size` as many times as the time since
+        the last frame allows, carrying the remainder over.
+        """
         self.running = True
         clock = ClockObject.get_global_clock()
-        prev_time = clock.frame_time
+        prev_time = last_step_time = clock.frame_time
+        accumulator = 0.0
         while self.running:
             now = clock.frame_time
-            self.handle_collisions()
-            self.world.do_physics(now - prev_time)
+            if self.paused:
+                prev_time = last_step_time = now
+                await AsyncTaskPause(0)
+                continue
+            if self.idle and not self.is_settled():
+                # Something was given a push without the arena being woken.
+                self.wake()
+            if self.idle:
+                if now - last_step_time >= self.idle_step:
+                    self.step(self.step_size)
+                    last_step_time = now
+                accumulator = 0
+            else:
+                accumulator += now - prev_time
+                steps = 0
+                while accumulator >= self.step_size:
+                    if steps == self.max_steps_per_frame:
+                        # Drop time that can't be caught up on
+                        # rather than falling further behind.
+                        accumulator %= self.step_size
+                        break
+                    self.step(self.step_size)
+                    accumulator -= self.step_size
+                    steps += 1
+                last_step_time = now
             prev_time = now
+            self.step_fraction = accumulator / self.step_size
+            await AsyncTaskPause(0)
+
+    def fixed_update(self, task: AsyncTask) -> int:
+        """Step the world every `step_size` seconds of real time.
+
+        This is a task function rather than a coroutine, as it sleeps
+        between steps and so needs a task chain with a thread to itself.
+        """
+        now = ClockObject.get_global_clock().real_time
+        if self.paused and self.running:
+            self._next_step_time = now + self.step_size
+            time.sleep(self.step_size)
+            return AsyncTask.DS_cont
+        with self.world_lock:
+            # `stop` may have been called while waiting for the lock.
+            if not self.running:
+                return AsyncTask.DS_done
+            if now >= self._next_step_time:
+                self.step(self.step_size)
+                self._last_step_time = now
+                interval = self.idle_step if self.idle else self.step_size
+                # Drop steps that can't be caught up on rather than
+                # falling behind.
+                self._next_step_time = max(self._next_step_time, now - self.step_size)
+                self._next_step_time += interval
+                return AsyncTask.DS_cont
+            if self.idle and not self.is_settled():
+                self.wake()
+                return AsyncTask.DS_cont
+        time.sleep(min(self._next_step_time - now, self.step_size))
+        return AsyncTask.DS_cont
+
+    def step(self, dt: float) -> None:
+        self.handle_collisions()
+        self.world.do_physics(dt, 1, self.step_size)
+        self.sim_time += dt
+        # Controllers run after the step, as Bullet doesn't compute
+        # joint positions until a constraint has been stepped once.
+        for callback in tuple(self.step_callbacks):
+            callback(dt)
+        self.publish_snapshot()
+        if self._wake_holds or not self.is_settled():
+            self._settled_time = 0
+        else:
+            self._settled_time += dt
+            self.idle = self._settled_time >= self.settle_time
+
+    def is_settled(self) -> bool:
+        """Return whether every dynamic body is moving slower
+        than the tolerances allow.
+        """
+        # Joint motors drive the joints at a speed proportional to their
+        # remaining error, so slow bodies also mean that motors are
+        # close to their targets.
+        max_linear = self.linear_tolerance**2
+        max_angular = self.angular_tolerance**2
+        for body in self.world.rigid_bodies:
+            if body.static:
+                continue
+            if body.linear_velocity.length_squared() > max_linear:
+                return False
+            if body.angular_velocity.length_squared() > max_angular:
+                return False
+        return True
+
+    def is_awake(self) -> bool:
+        return self.running and not self.idle
+
+    def wake(self) -> None:
+        """Resume stepping at the full rate."""
+        self.idle = False
+        self._settled_time = 0
+        self._next_step_time = ClockObject.get_global_clock().real_time
+
+    @contextlib.contextmanager
+    def keep_awake(self) -> Iterator[None]:
+        """Prevent the arena from going idle within the context."""
+        self.wake()
+        self._wake_holds += 1
+        try:
+            yield
+        finally:
+            self._wake_holds -= 1
+
+    def track(self, body: NodePath) -> NodePath:
+        """Publish the transform of the given body in future snapshots,
+        and return a node that follows it on the rendering side.
+        """
+        proxy = self.proxies.get(body)
+        if proxy is None:
+            proxy = self.visuals.attach_new_node(body.name)
+            proxy.set_transform(body.get_transform(self.root))
+            if self.draw:
+                shapes = wireframes.describe_body(body.node())
+                wireframes.draw_body(shapes).reparent_to(proxy)
+            self.proxies[body] = proxy
+        return proxy
+
+    def untrack(self, body: NodePath) -> None:
+        proxy = self.proxies.pop(body, None)
+        if proxy is not None:
+            self.call_on_main(proxy.remove_node)
+
+    def get_transform(self, body: NodePath) -> TransformState:
+        """Return the transform of a tracked body relative to the root in
+        the latest snapshot, which unlike the body itself can be read
+        while the world is stepped on another thread.
+
+        Bodies that haven't been in a snapshot yet are read directly.
+        """
+        transform = self.snapshots[1].transforms.get(body)
+        if transform is None:
+            transform = body.get_transform(self.root)
+        return transform
+
+    def call_on_main(self, callback: Callable[[], object]) -> None:
+        """Call `callback` on the main thread: right away if the world is
+        stepped there, or else at the start of the next frame. Anything
+        that touches the scene graph or sends events from a step of the
+        world, like dealing damage, should go through this.
+        """
+        if self.task_chain is None:
+            callback()
+        else:
+            self._main_calls.append(callback)
+
+    def run_main_calls(self) -> None:
+        """Make the calls queued by `call_on_main`, on the main thread."""
+        while self._main_calls:
+            self._main_calls.popleft()()
+
+    def publish_snapshot(self) -> None:
+        transforms = {
+            body: body.get_transform(self.root)
+            for body in tuple(self.proxies)
+            if not body.is_empty()
+        }
+        current = TransformSnapshot(self.sim_time, transforms)
+        self.snapshots = (self.snapshots[1], current)
+
+    async def sync_visuals(self) -> None:
+        while self.running:
+            self.run_main_calls()
+            self.present()
             await AsyncTaskPause(0)
 
+    def get_step_fraction(self) -> float:
+        """Return how far between the previous and current snapshots
+        the tracked bodies should be shown.
+        """
+        if not self.interpolate:
+            return 1
+        if self.task_chain is None:
+            return self.step_fraction
+        elapsed = ClockObject.get_global_clock().real_time - self._last_step_time
+        return min(elapsed / self.step_size, 1)
+
+    def present(self) -> None:
+        """Move the proxies of tracked bodies to their published
+        transforms, interpolating between the last two snapshots.
+        """
+        previous, current = self.snapshots
+        if current is self._presented:
+            return
+        fraction = self.get_step_fraction()
+        for body, transform in current.transforms.items():
+            proxy = self.proxies.get(body)
+            if proxy is None:
+                continue
+            prior = previous.transforms.get(body)
+            if prior is not None and fraction < 1:
+                transform = spatial.interpolate_transforms(prior, transform, fraction)
+            proxy.set_transform(transform)
+        if fraction >= 1:
+            # Nothing will change until the next snapshot is published.
+            self._presented = current
+
     def handle_collisions(self) -> None:
         for manifold in self.world.manifolds:
-            if not manifold.node0.into_collide_mask & manifold.node1.into_collide_mask:
+            # Bodies whose bounds overlap have a manifold even before
+            # they touch, so there can be many more than there are contacts.
+            if not manifold.get_num_manifold_points():
                 continue
             for node in (manifold.node0, manifold.node1):
                 impact_callback = node.python_tags.get('impact_callback')
                 if impact_callback is not None:
                     impact_callback(node, manifold)
+                contact_callback = node.python_tags.get('contact_callback')
+                if contact_callback is not None:
+                    contact_callback(node, manifold)
 
     def get_mouse_ray(self) -> bullet.BulletClosestHitRayResult:
         from direct.showbase.ShowBaseGlobal import base
@@ -53,10 +422,29 @@ class Arena:
         lens.extrude(mouse_pos, near_point, far_point)
         origin = self.root.get_relative_point(camera, near_point)
         endpoint = self.root.get_relative_point(camera, far_point)
-        return self.world.ray_test_closest(origin, endpoint)
+        with self.world_lock:
+            return self.world.ray_test_closest(origin, endpoint)
+
+    def stop(self) -> None:
+        """Stop stepping the world, waiting for a step in progress on
+        another thread to finish, so that it can be changed freely.
+        """
+        with self.world_lock:
+            self.running = False
 
     def exit(self):
-        self.running = False
+        self.stop()
+        self.task_group.close()
+        _logger.debug(self.task_group.report())
+        leaked = self.task_group.leaked()
+        if leaked:
+            _logger.warning(f'Tasks started in the arena still running: {leaked}')
+        for body in tuple(self.proxies):
+            self.untrack(body)
+        self.run_main_calls()
         self.root.detach_node()
-        self.debug_handler.destroy()
+        if self.debug_handler is not None:
+            self.debug_handler.destroy()
         self.world.remove(self.ground.node())
+        if self.scenery is not None:
+            self.world.remove(self.scenery.node())
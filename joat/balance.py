@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import logging
+import math
+import os
+from collections.abc import Iterable, Sequence
+from pathlib import Path
+from typing import Final
+
+import attrs
+from attrs import field
+
+from . import content, headless
+
+_logger: Final = logging.getLogger(__name__)
+
+# Bump this whenever a code change would alter the outcome of battles,
+# so that results cached by older versions are ignored.
+CACHE_VERSION: Final = 4
+DEFAULT_CACHE_DIR: Final = Path('.cache', 'balance')
+
+
+def wilson_interval(
+    successes: float, trials: int, *, z: float = 1.96
+) -> tuple[float, float]:
+    """Return the Wilson score interval for a proportion."""
+    if trials == 0:
+        return 0, 1
+    p = successes / trials
+    denominator = 1 + z**2 / trials
+    center = (p + z**2 / (2 * trials)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / trials + z**2 / (4 * trials**2))
+    half_width /= denominator
+    return max(center - half_width, 0), min(center + half_width, 1)
+
+
+@attrs.define
+class Cell:
+    """The results of battles between two characters, from the point of
+    view of the first.
+    """
+
+    name_1: str
+    name_2: str
+    key: str
+    results: list[headless.BattleResult] = field(factory=list)
+    cached: int = 0
+
+    @property
+    def score(self) -> float:
+        """The number of wins for the first character, counting draws
+        as half a win.
+        """
+        return sum(
+            0.5 if result.winner is None else 1 - result.winner
+            for result in self.results
+        )
+
+    @property
+    def win_rate(self) -> float:
+        return self.score / len(self.results) if self.results else 0.5
+
+    def interval(self, *, z: float = 1.96) -> tuple[float, float]:
+        return wilson_interval(self.score, len(self.results), z=z)
+
+    def is_done(self, *, min_battles: int, max_battles: int, tolerance: float) -> bool:
+        if len(self.results) >= max_battles:
+            return True
+        if len(self.results) < min_battles:
+            return False
+        low, high = self.interval()
+        return (high - low) / 2 <= tolerance
+
+
+def cell_key(
+    pack: content.ContentPack,
+    name_1: str,
+    name_2: str,
+    max_turns: int,
+    *,
+    simultaneous: bool = False,
+) -> str:
+    """Return a key identifying everything that can affect the outcome of
+    battles between the two characters.
+    """
+    return content.hash_bytes(
+        str(CACHE_VERSION).encode(),
+        pack.character_hash(name_1).encode(),
+        pack.character_hash(name_2).encode(),
+        str(max_turns).encode(),
+        str(simultaneous).encode(),
+    )
+
+
+def load_results(path: Path) -> list[headless.BattleResult]:
+    try:
+        data = json.loads(path.read_text())
+    except FileNotFoundError:
+        return []
+    return [headless.BattleResult.from_json(result) for result in data]
+
+
+def save_results(path: Path, results: Iterable[headless.BattleResult]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix('.tmp')
+    temp_path.write_text(json.dumps([result.to_json() for result in results]))
+    temp_path.replace(path)
+
+
+def _run_batch(
+    name_1: str,
+    name_2: str,
+    seeds: Sequence[int],
+    max_turns: int,
+    simultaneous: bool,
+) -> list[headless.BattleResult]:
+    pack = headless.get_worker_pack()
+    character_1 = pack.characters[name_1]
+    character_2 = pack.characters[name_2]
+    return [
+        headless.run_battle(
+            character_1,
+            character_2,
+            seed=seed,
+            max_turns=max_turns,
+            simultaneous=simultaneous,
+        )
+        for seed in seeds
+    ]
+
+
+def compute_matrix(
+    pack: content.ContentPack,
+    names: Sequence[str],
+    *,
+    cache_dir: Path = DEFAULT_CACHE_DIR,
+    min_battles: int = 20,
+    max_battles: int = 200,
+    batch_size: int = 10,
+    tolerance: float = 0.1,
+    max_turns: int = 100,
+    simultaneous: bool = False,
+    workers: int | None = None,
+) -> dict[tuple[str, str], Cell]:
+    """Run battles between every pair of the named characters until the
+    win rate of each pair is known to within `tolerance`, or
+    `max_battles` have been run.
+
+    Results are cached in `cache_dir`, so only pairs involving content
+    that changed since the last run need to fight again.
+    """
+    cells: dict[tuple[str, str], Cell] = {}
+    for name_1, name_2 in itertools.combinations(names, 2):
+        key = cell_key(pack, name_1, name_2, max_turns, simultaneous=simultaneous)
+        results = load_results(cache_dir / f'{key}.json')
+        cells[name_1, name_2] = Cell(name_1, name_2, key, results, len(results))
+
+    def is_done(cell: Cell) -> bool:
+        return cell.is_done(
+            min_battles=min_battles, max_battles=max_battles, tolerance=tolerance
+        )
+
+    pending: dict[concurrent.futures.Future[list[headless.BattleResult]], Cell] = {}
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, initializer=headless.init_worker, initargs=(pack.root,)
+    ) as executor:
+
+        def submit(cell: Cell) -> None:
+            count = min(batch_size, max_battles - len(cell.results))
+            seeds = range(len(cell.results), len(cell.results) + count)
+            future = executor.submit(
+                _run_batch, cell.name_1, cell.name_2, seeds, max_turns, simultaneous
+            )
+            pending[future] = cell
+
+        for cell in cells.values():
+            if not is_done(cell):
+                submit(cell)
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                cell = pending.pop(future)
+                cell.results += future.result()
+                save_results(cache_dir / f'{cell.key}.json', cell.results)
+                low, high = cell.interval()
+                _logger.info(
+                    f'{cell.name_1} vs. {cell.name_2}: {len(cell.results)} battles,'
+                    f' win rate in [{low:.2f}, {high:.2f}]'
+                )
+                if not is_done(cell):
+                    submit(cell)
+    return cells
+
+
+def format_matrix(names: Sequence[str], cells: dict[tuple[str, str], Cell]) -> str:
+    """Return a table of the win rate of each row's character against
+    each column's, with the half-width of its confidence interval.
+    """
+    rows = [['', *names]]
+    for name_1 in names:
+        row = [name_1]
+        for name_2 in names:
+            if (name_1, name_2) in cells:
+                cell = cells[name_1, name_2]
+                win_rate = cell.win_rate
+                low, high = cell.interval()
+            elif (name_2, name_1) in cells:
+                cell = cells[name_2, name_1]
+                win_rate = 1 - cell.win_rate
+                low, high = 1 - cell.interval()[1], 1 - cell.interval()[0]
+            else:
+                row.append('-')
+                continue
+            row.append(f'{win_rate:.0%}±{(high - low) / 2:.0%}')
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join(
+        '  '.join(entry.rjust(width) for entry, width in zip(row, widths))
+        for row in rows
+    )
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.set_defaults(command=run)
+    parser.add_argument(
+        'characters',
+        nargs='*',
+        help='the characters to include (by default, all of them)',
+    )
+    parser.add_argument('--data-dir', type=Path, default=content.DATA_DIR)
+    parser.add_argument('--cache-dir', type=Path, default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--min-battles', type=int, default=20)
+    parser.add_argument('--max-battles', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.1,
+        help='stop once the 95%% confidence interval is this narrow on each side',
+    )
+    parser.add_argument('--max-turns', type=int, default=100)
+    parser.add_argument(
+        '--simultaneous',
+        action='store_true',
+        help='have fighters act at the same time instead of taking turns',
+    )
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+
+
+def run(args: argparse.Namespace) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    _logger.setLevel(logging.INFO)
+    pack = content.ContentPack.load(args.data_dir)
+    names = args.characters or list(pack.characters)
+    cells = compute_matrix(
+        pack,
+        names,
+        cache_dir=args.cache_dir,
+        min_battles=args.min_battles,
+        max_battles=args.max_battles,
+        batch_size=args.batch_size,
+        tolerance=args.tolerance,
+        max_turns=args.max_turns,
+        simultaneous=args.simultaneous,
+        workers=args.workers,
+    )
+    cached = sum(cell.cached for cell in cells.values())
+    total = sum(len(cell.results) for cell in cells.values())
+    print(format_matrix(names, cells))
+    print(f'{total - cached} new battles, {cached} cached')
@@ -0,0 +1,245 @@
+from __future__ import annotations
+
+import logging
+import math
+from collections.abc import Awaitable, Callable, Sequence
+from typing import Final
+
+from panda3d.core import AsyncFuture, AsyncTaskPause, Vec3
+
+from . import moves, spatial, stances
+from .characters import Character, Fighter
+from .providers import ActionProvider
+
+_logger: Final = logging.getLogger(__name__)
+
+# How far apart neighbouring fighters start in battles between more than two
+RING_SPACING: Final = 3
+# Chooses which of the given opponents a fighter uses a move on
+TargetSelector = Callable[[Fighter, Sequence[Fighter]], Fighter]
+
+
+def make_fighters(
+    *characters: Character, teams: Sequence[int] | None = None
+) -> tuple[Fighter, ...]:
+    """Return fighters for the given characters, spaced evenly around
+    a circle and facing its middle in their starting positions.
+
+    Each fighter is on the corresponding team in `teams`, or on a team
+    of their own by default.
+    """
+    count = len(characters)
+    if teams is not None and len(teams) != count:
+        raise ValueError(f'Expected {count} teams, got {len(teams)}')
+    if count > 2:
+        # Skeletons are built with their arms held out to the sides, so
+        # neighbours have to start far enough apart not to hit each other.
+        radius = RING_SPACING / 2 / math.sin(math.pi / count)
+    else:
+        radius = 0.5 if count == 2 else 0
+    names = [character.name for character in characters]
+    duplicates = {name for name in names if names.count(name) > 1}
+    fighters: list[Fighter] = []
+    for i, character in enumerate(characters):
+        angle = 2 * math.pi * i / count
+        # Round so that fighters on an axis are exactly on it.
+        position = Vec3(
+            round(-radius * math.cos(angle), 9), round(-radius * math.sin(angle), 9), 0
+        )
+        fighter = character.make_fighter(
+            xform=spatial.make_rigid_transform(
+                rotation=spatial.make_rotation(angle, Vec3.unit_z()),
+                translation=position,
+            )
+        )
+        if teams is not None:
+            fighter.team = teams[i]
+        if fighter.name in duplicates:
+            fighter.name += f' ({i + 1})'
+        fighter.set_stance(stances.BOXING_STANCE)
+        fighters.append(fighter)
+    return tuple(fighters)
+
+
+def turn_order(fighters: Sequence[Fighter]) -> list[int]:
+    """Return the indices of the fighters in the order that they take
+    turns, fastest first. Ties keep the order of `fighters`.
+    """
+    return sorted(range(len(fighters)), key=lambda i: -fighters[i].speed)
+
+
+def is_alive(fighter: Fighter) -> bool:
+    return fighter.health > 0
+
+
+def opponents_of(fighter: Fighter, fighters: Sequence[Fighter]) -> list[Fighter]:
+    """Return the living fighters that aren't allies of the fighter."""
+    return [
+        other for other in fighters if not fighter.is_ally(other) and is_alive(other)
+    ]
+
+
+def nearest_opponent(fighter: Fighter, opponents: Sequence[Fighter]) -> Fighter:
+    position = fighter.get_position()
+    return min(
+        opponents,
+        key=lambda other: (other.get_position() - position).length_squared(),
+    )
+
+
+def next_turn(fighters: Sequence[Fighter], order: Sequence[int], i: int) -> int:
+    """Return the index of the living fighter whose turn comes after
+    that of the fighter at index `i`.
+    """
+    position = order.index(i)
+    for offset in range(1, len(order) + 1):
+        j = order[(position + offset) % len(order)]
+        if is_alive(fighters[j]):
+            return j
+    return i
+
+
+def check_for_winner(
+    fighters: Sequence[Fighter], last: Fighter
+) -> tuple[bool, Fighter | None]:
+    """Return whether the battle is over and, if so, a fighter on the
+    winning team, preferring `last`, or `None` if no one is left.
+    """
+    living = [f for f in fighters if is_alive(f)]
+    if any(opponents_of(f, living) for f in living):
+        return False, None
+    if not living:
+        _logger.info('Every fighter was defeated')
+        return True, None
+    winner = last if is_alive(last) else living[0]
+    _logger.info(f'{winner} won the battle')
+    return True, winner
+
+
+async def run_turns(
+    fighters: Sequence[Fighter],
+    providers: Sequence[ActionProvider],
+    *,
+    between_turns: Callable[[int], Awaitable[object]] | None = None,
+    max_turns: int | None = None,
+    select_target: TargetSelector = nearest_opponent,
+) -> Fighter | None:
+    """Have the fighters take turns in order of speed, using the moves
+    chosen by their providers, until only one team is left standing.
+    Return the fighter whose turn won the battle, who is on the winning
+    team, or `None` if no one is left.
+
+    Moves used on `Target.OTHER` are used on the opponent chosen by
+    `select_target`, which defaults to the nearest.
+
+    `between_turns` is awaited with the index of the fighter whose turn
+    just ended whenever the battle continues. If `max_turns` is given and
+    no team has won after that many turns, return `None`.
+    """
+    order = turn_order(fighters)
+    i = order[0]
+    turns = 0
+    while max_turns is None or turns < max_turns:
+        fighter = fighters[i]
+        # Effects take hold as the next fighter's turn starts, even if
+        # this turn defeats them.
+        next_fighter = fighters[next_turn(fighters, order, i)]
+        move, target = await providers[i].query_action()
+        opponents = opponents_of(fighter, fighters)
+        if target is moves.Target.SELF:
+            await fighter.use_move(move, fighter)
+        elif target is moves.Target.OTHER and opponents:
+            await fighter.use_move(move, select_target(fighter, opponents))
+        next_fighter.apply_current_effects()
+        over, winner = check_for_winner(fighters, fighter)
+        if over:
+            return winner
+        if between_turns is not None:
+            await between_turns(i)
+        i = next_turn(fighters, order, i)
+        turns += 1
+    _logger.info(f'The battle ended in a draw after {turns} turns')
+    return None
+
+
+async def run_at_once(
+    fighters: Sequence[Fighter],
+    providers: Sequence[ActionProvider],
+    *,
+    between_actions: Callable[[int], Awaitable[object]] | None = None,
+    max_actions: int | None = None,
+    select_target: TargetSelector = nearest_opponent,
+) -> Fighter | None:
+    """Like `run_turns`, but every fighter acts at the same time as the
+    others, committing to their next action as soon as their last one is
+    over instead of waiting for anyone else. Collisions decide whose blows
+    land first, and fast moves can be used more often than slow ones.
+
+    Every action lasts at least a frame, and a fighter's effects take
+    hold whenever one of their actions is over. `between_actions` is
+    awaited with the index of the fighter whose action just ended, holding
+    up only that fighter. If `max_actions` is given and no team has won
+    once every fighter has taken that many actions, return `None`.
+    """
+    order = turn_order(fighters)
+    arena = fighters[order[0]].arena
+    assert arena is not None
+    outcome: list[Fighter | None] = []
+    errors: list[Exception] = []
+    finished = AsyncFuture()
+
+    def finish() -> None:
+        if not finished.done():
+            finished.set_result(None)
+
+    async def act(i: int) -> None:
+        fighter = fighters[i]
+        actions = 0
+        while is_alive(fighter) and (max_actions is None or actions < max_actions):
+            actions += 1
+            start_time = arena.sim_time
+            try:
+                move, target = await providers[i].query_action()
+                opponents = opponents_of(fighter, fighters)
+                if not is_alive(fighter):
+                    # Defeated while deciding
+                    return
+                if target is moves.Target.SELF:
+                    await fighter.use_move(move, fighter)
+                elif target is moves.Target.OTHER and opponents:
+                    await fighter.use_move(move, select_target(fighter, opponents))
+            except Exception as e:
+                # Raised by the battle instead, since no one awaits this.
+                errors.append(e)
+                finish()
+                return
+            if arena.sim_time == start_time:
+                await AsyncTaskPause(0)
+            fighter.apply_current_effects()
+            over, winner = check_for_winner(fighters, fighter)
+            if over:
+                outcome.append(winner)
+                finish()
+                return
+            if between_actions is not None:
+                await between_actions(i)
+
+    running = [arena.task_group.add(act(i)) for i in order]
+
+    async def wait_for_all() -> None:
+        for task in running[: len(order)]:
+            await task
+        finish()
+
+    running.append(arena.task_group.add(wait_for_all()))
+    try:
+        await finished
+    finally:
+        for task in running:
+            arena.task_group.cancel(task)
+    if errors:
+        raise errors[0]
+    if outcome:
+        return outcome[0]
+    _logger.info('The battle ended in a draw')
+    return None
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import argparse
+import itertools
+import logging
+import math
+import time
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Final
+
+import attrs
+
+from . import battles, content, headless, providers
+from .characters import Character
+
+_logger: Final = logging.getLogger(__name__)
+
+DEFAULT_COUNTS: Final = (2, 4, 8, 12, 16)
+
+
+@attrs.frozen
+class FrameCost:
+    """The wall time spent on each frame of a battle between some number
+    of fighters, where a frame is a physics step and the battle logic
+    that runs after it.
+    """
+
+    fighters: int
+    frame_times: tuple[float, ...]
+    # Averages over the frames of all manifolds, which include pairs of
+    # bodies whose bounds merely overlap, and of those with contacts
+    manifolds: float
+    contacts: float
+
+    @property
+    def mean(self) -> float:
+        return math.fsum(self.frame_times) / len(self.frame_times)
+
+    @property
+    def p95(self) -> float:
+        ordered = sorted(self.frame_times)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+
+def measure_frames(
+    characters: Sequence[Character],
+    *,
+    teams: Sequence[int] | None = None,
+    seed: int = 0,
+    duration: float = 10,
+) -> FrameCost:
+    """Run a battle between bots for `duration` simulated seconds, or until
+    it ends, and return the time taken by each frame.
+    """
+    fighters = battles.make_fighters(*characters, teams=teams)
+    arena = headless.make_arena(seed=seed)
+    bots = [
+        providers.RandomProvider.for_fighter(fighter, arena.rng.stream(f'bot {i}'))
+        for i, fighter in enumerate(fighters)
+    ]
+    frame_times: list[float] = []
+    manifold_counts: list[int] = []
+    contact_counts: list[int] = []
+    last_frame = 0.0
+
+    def record(dt: float) -> None:
+        nonlocal last_frame
+        if last_frame:
+            frame_times.append(time.perf_counter() - last_frame)
+        if len(frame_times) % 30 == 0:
+            manifolds = arena.world.manifolds
+            manifold_counts.append(len(manifolds))
+            contact_counts.append(
+                sum(1 for m in manifolds if m.get_num_manifold_points())
+            )
+        # Counting manifolds is slow enough to skew the frame times.
+        last_frame = time.perf_counter()
+
+    async def battle() -> None:
+        for fighter in fighters:
+            fighter.enter_arena(arena)
+        arena.step_callbacks.append(record)
+        await battles.run_turns(fighters, bots)
+
+    try:
+        headless.simulate(arena, battle(), max_time=duration)
+    finally:
+        for fighter in fighters:
+            fighter.exit_arena()
+        arena.exit()
+    return FrameCost(
+        len(fighters),
+        tuple(frame_times),
+        manifolds=sum(manifold_counts) / len(manifold_counts),
+        contacts=sum(contact_counts) / len(contact_counts),
+    )
+
+
+def format_report(costs: Sequence[FrameCost]) -> str:
+    """Return a table of frame costs. The growth column is the exponent
+    `k` for which the mean cost grows like `fighters ** k` since the
+    previous row, so 1 is linear and 2 quadratic.
+    """
+    lines = [
+        f'{"fighters":>8} {"frames":>6} {"mean ms":>8} {"p95 ms":>8}'
+        f' {"ms/fighter":>10} {"manifolds":>9} {"contacts":>8} {"growth":>6}'
+    ]
+    for previous, cost in zip((None, *costs), costs):
+        growth = ''
+        if previous is not None:
+            exponent = math.log(cost.mean / previous.mean) / math.log(
+                cost.fighters / previous.fighters
+            )
+            growth = f'{exponent:.2f}'
+        lines.append(
+            f'{cost.fighters:>8} {len(cost.frame_times):>6}'
+            f' {cost.mean * 1000:>8.3f} {cost.p95 * 1000:>8.3f}'
+            f' {cost.mean * 1000 / cost.fighters:>10.3f}'
+            f' {cost.manifolds:>9.1f} {cost.contacts:>8.1f} {growth:>6}'
+        )
+    return '\n'.join(lines)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.set_defaults(command=run)
+    parser.add_argument(
+        'characters',
+        nargs='*',
+        help='the characters to cycle through (by default, all that bots can use)',
+    )
+    parser.add_argument(
+        '--counts', type=int, nargs='+', default=DEFAULT_COUNTS, metavar='N'
+    )
+    parser.add_argument('--teams', type=int, help='split the fighters into teams')
+    parser.add_argument(
+        '--time', type=float, default=10, help='simulated seconds per battle'
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', type=Path, default=content.DATA_DIR)
+
+
+def run(args: argparse.Namespace) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    pack = content.ContentPack.load(args.data_dir)
+    names = args.characters or sorted(pack.characters)
+    # Bots can only play characters with moves that don't need the mouse.
+    available = [
+        pack.characters[name]
+        for name in names
+        if not all(map(providers.needs_pointer, pack.characters[name].moves))
+    ]
+    costs = []
+    for count in sorted(args.counts):
+        characters = list(itertools.islice(itertools.cycle(available), count))
+        teams = None
+        if args.teams is not None:
+            teams = [i * args.teams // count for i in range(count)]
+        cost = measure_frames(
+            characters, teams=teams, seed=args.seed, duration=args.time
+        )
+        _logger.info(f'Measured {len(cost.frame_times)} frames with {count} fighters')
+        costs.append(cost)
+    print(format_report(costs))
@@ -1,8 +1,8 @@
 from __future__ import annotations
 
+import functools
 import json
 import logging
-import random
 from collections.abc import Container, Mapping
 from pathlib import Path
 from typing import Any, Final, Protocol
@@ -23,7 +23,8 @@ from panda3d.core import (
 )
 
 from . import arenas, debug, moves, stances
-from .effects import Effect, StatusEffect
+from .effects import Effect, EffectSchedule, StatusEffect
+from .rng import Jitter, RandomStreams
 from .skeletons import Skeleton
 
 _logger: Final = logging.getLogger(__name__)
@@ -74,6 +75,8 @@ class Character:
     strength: int
     defense: int
     moves: list[Action] = attrs.Factory(list)
+    # Overrides the default skeleton parameters, e.g. while tuning measures
+    skeleton_params: dict[str, dict[str, Any]] | None = field(default=None, repr=False)
     xp: int = field(default=0, init=False, repr=False)
     level: int = field(default=0, init=False, repr=False)
 
@@ -92,8 +95,10 @@ class Character:
     def make_fighter(
         self, *, xform: TransformState = TransformState.make_identity()
     ) -> Fighter:
-        with Path('data', 'skeletons', 'default.json').open() as f:
-            skeleton_params: dict[str, dict[str, Any]] = json.load(f)
+        skeleton_params = self.skeleton_params
+        if skeleton_params is None:
+            with Path('data', 'skeletons', 'default.json').open() as f:
+                skeleton_params = json.load(f)
         skeleton = Skeleton.construct(
             skeleton_params,
             transform=xform,
@@ -130,8 +135,14 @@ class Fighter:
     health: int = field(init=False)
     skeleton: Skeleton = field(repr=False)
     arena: arenas.Arena | None = None
-    status_effects: list[StatusEffect] = field(factory=list, init=False)
+    # Fighters on the same team don't collide or target each other. A
+    # fighter without a team is on one of their own.
+    team: int | None = None
+    status_effects: EffectSchedule = field(factory=EffectSchedule, init=False)
     health_bar: NodePath[PGWaitBar] = field(init=False)
+    # Replaced by streams derived from the arena's when entering one
+    rng: RandomStreams = field(factory=RandomStreams.from_entropy, repr=False)
+    aim_jitter: Jitter = field(init=False, repr=False)
 
     @property
     def base_health(self) -> int:
@@ -156,38 +167,83 @@ class Fighter:
     def __attrs_post_init__(self) -> None:
         self.health = self.base_health
         self.health_bar = make_health_bar(self)
-        for part in self.skeleton.parts.values():
-            part.node().python_tags.update(
-                fighter=self,
-                impact_callback=standard_impact_callback,
-            )
+        self.set_rng(self.rng)
 
     def __str__(self) -> str:
         return f'{type(self).__name__} {self.name!r}'
 
+    def is_ally(self, other: Fighter) -> bool:
+        return other is self or (self.team is not None and other.team == self.team)
+
+    def set_rng(self, rng: RandomStreams) -> None:
+        self.rng = rng
+        self.aim_jitter = Jitter(rng.stream('aim'))
+
     def enter_arena(self, arena: arenas.Arena) -> None:
         self.arena = arena
-        self.skeleton.enter_arena(arena)
+        self.set_rng(arena.rng.spawn(self.name))
+        # The world may be stepped on another thread.
+        with arena.world_lock:
+            collide_mask = arena.add_collision_group(self.team)
+            self.skeleton.enter_arena(arena, collide_mask=collide_mask)
+            # The tags make a cycle that the garbage collector can't see
+            # through, so they only last while the fighter is in an arena.
+            for part in self.skeleton.parts.values():
+                part.node().python_tags.update(
+                    fighter=self,
+                    impact_callback=standard_impact_callback,
+                )
+        self.health_bar.reparent_to(arena.track(self.skeleton.core))
 
     def exit_arena(self) -> None:
         if self.arena is not None:
-            self.skeleton.exit_arena(self.arena)
+            self.health_bar.reparent_to(self.skeleton.core)
+            with self.arena.world_lock:
+                for part in self.skeleton.parts.values():
+                    tags = part.node().python_tags
+                    tags.pop('fighter', None)
+                    tags.pop('impact_callback', None)
+                self.skeleton.exit_arena(self.arena)
             self.arena = None
 
     def set_stance(self, stance: stances.Stance) -> None:
         self.skeleton.stance = stance
         self.skeleton.assume_stance()
 
+    def get_position(self) -> LVecBase3:
+        """Return the position of the fighter's core, relative to the
+        arena's root if they are in one.
+        """
+        if self.arena is None:
+            return self.skeleton.core.get_pos()
+        return LVecBase3(self.arena.get_transform(self.skeleton.core).get_pos())
+
+    def get_transform_of(self, np: NodePath) -> TransformState:
+        """Return the transform of a body relative to the fighter's core,
+        from the arena's latest snapshot if they are in one.
+        """
+        if self.arena is None:
+            return np.get_transform(self.skeleton.core)
+        core = self.arena.get_transform(self.skeleton.core)
+        return core.invert_compose(self.arena.get_transform(np))
+
     def get_position_of(self, np: NodePath, inaccuracy: float = 0) -> LVecBase3:
-        target_position = np.get_pos(self.skeleton.core)
-        for i in range(3):
-            scale = 1 - 2 * random.random()
+        target_position = LVecBase3(self.get_transform_of(np).get_pos())
+        for i, scale in enumerate(self.aim_jitter.take(3)):
             target_position[i] *= 1 + inaccuracy * scale
         return target_position
 
     async def use_move(self, move: Action, target: Fighter) -> None:
         _logger.debug(f'{self} used {move} on {target}')
-        await move.use(self, target)
+        self.status_effects.notify_move(self, move)
+        if self.arena is None:
+            await move.use(self, target)
+            return
+        with self.arena.keep_awake():
+            await move.use(self, target)
+        # Let damage dealt on the physics thread land before the battle
+        # goes on.
+        self.arena.run_main_calls()
 
     def apply_damage(self, damage: int) -> None:
         if damage:
@@ -195,30 +251,25 @@ class Fighter:
         self.health -= damage
         self.health_bar.node().set_value(self.health)
         messenger.send('output_info', [f'{self.name} took {damage} damage!'])
+        if damage > 0:
+            self.status_effects.notify_hit(self, damage)
         if self.health <= 0:
             self.kill()
 
     def add_effect(self, effect: StatusEffect) -> None:
         _logger.debug(f'Added {effect} to {self}')
-        effect.on_application(self)
-        self.status_effects.append(effect)
+        self.status_effects.add(self, effect)
 
     def apply_current_effects(self) -> None:
         if self.status_effects:
-            _logger.debug(f'Applying active effects to {self} ({self.status_effects})')
-        new_effects: list[StatusEffect] = []
-        for effect in self.status_effects:
-            effect.on_turn(self)
-            effect.duration -= 1
-            if effect.is_active():
-                new_effects.append(effect)
-            else:
-                effect.on_removal(self)
-        self.status_effects = new_effects
+            _logger.debug(
+                f'Applying active effects to {self} ({list(self.status_effects)})'
+            )
+        self.status_effects.tick(self)
 
     def project_ring(self) -> NodePath[GeomNode]:
         assert self.arena is not None
-        base_pos = self.skeleton.core.get_pos()
+        base_pos = self.get_position()
         base_pos.z = 0
         radius = self.speed
         node = debug.draw_path(
@@ -246,6 +297,8 @@ def standard_impact_callback(
     fighter: Fighter | None = node.python_tags.get('fighter')
     if fighter is None:
         return
+    arena = fighter.arena
+    assert arena is not None
     if node == manifold.node0:
         other_node = manifold.node1
     else:
@@ -264,8 +317,8 @@ def standard_impact_callback(
         )
         damage = int(impulse * multiplier / (10 + fighter.defense))
         if damage:
-            fighter.apply_damage(damage)
+            arena.call_on_main(functools.partial(fighter.apply_damage, damage))
         effect: Effect | None = other_node.python_tags.pop('one_shot_effect', None)
         if effect is not None:
             _logger.debug(f'Applying {effect} to {fighter}')
-            effect.apply(fighter)
+            arena.call_on_main(functools.partial(effect.apply, fighter))
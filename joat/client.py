@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import statistics
+import time
+from collections import Counter
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any, Final
+from typing_extensions import Self
+
+import attrs
+from attrs import field
+
+_logger: Final = logging.getLogger(__name__)
+
+DEFAULT_HOST: Final = '127.0.0.1'
+DEFAULT_PORT: Final = 7878
+
+Message = dict[str, Any]
+
+
+class ServiceError(RuntimeError):
+    pass
+
+
+@attrs.define
+class ServiceClient:
+    """A connection to the battle service started by `python -m joat serve`.
+
+    This module doesn't import Panda3D, so other tools can use it to
+    submit battles cheaply. Battles can be submitted concurrently; their
+    results are matched to requests by id as they stream back, in
+    whatever order they finish.
+    """
+
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    _pending: dict[int, asyncio.Future[Message]] = field(
+        factory=dict, init=False, repr=False
+    )
+    _ids: itertools.count[int] = field(factory=itertools.count, init=False)
+    _reader_task: asyncio.Task[None] | None = field(default=None, init=False)
+
+    @classmethod
+    async def connect(
+        cls,
+        host: str = DEFAULT_HOST,
+        port: int = DEFAULT_PORT,
+        *,
+        unix: Path | None = None,
+    ) -> Self:
+        if unix is not None:
+            reader, writer = await asyncio.open_unix_connection(unix)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        client = cls(reader, writer)
+        client._reader_task = asyncio.create_task(client._read())
+        return client
+
+    async def _read(self) -> None:
+        try:
+            while line := await self.reader.readline():
+                message = json.loads(line)
+                if message['kind'] == 'queued':
+                    continue
+                request_id = message.get('id')
+                if request_id is None:
+                    # The service couldn't read a request well enough to
+                    # tell which it was, which shouldn't happen with the
+                    # requests sent from here.
+                    _logger.warning(f'Dropped a reply without an id: {message}')
+                    continue
+                future = self._pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ServiceError('Connection closed'))
+            self._pending.clear()
+
+    async def request(self, kind: str, **contents: Any) -> Message:
+        """Send a request and wait for its final reply."""
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        message = {'kind': kind, 'id': request_id, **contents}
+        self.writer.write(json.dumps(message).encode() + b'\n')
+        await self.writer.drain()
+        return await future
+
+    async def battle(
+        self,
+        characters: Sequence[str],
+        *,
+        seed: int = 0,
+        policies: Sequence[str] = ('random', 'random'),
+        max_turns: int = 100,
+        simultaneous: bool = False,
+        timeout: float | None = None,
+        replay: bool = False,
+    ) -> Message:
+        """Run a battle and return the reply, whose `status` is one of
+        `done`, `timeout`, `rejected` or `error`.
+        """
+        return await self.request(
+            'battle',
+            characters=list(characters),
+            seed=seed,
+            policies=list(policies),
+            max_turns=max_turns,
+            simultaneous=simultaneous,
+            timeout=timeout,
+            replay=replay,
+        )
+
+    async def metrics(self) -> Message:
+        return await self.request('metrics')
+
+    async def close(self) -> None:
+        self.writer.close()
+        await self.writer.wait_closed()
+        if self._reader_task is not None:
+            await self._reader_task
+
+
+async def load_test(
+    client: ServiceClient,
+    characters: Sequence[str],
+    *,
+    battles: int,
+    concurrency: int,
+    first_seed: int = 0,
+    timeout: float | None = None,
+    simultaneous: bool = False,
+) -> str:
+    """Submit battles with at most `concurrency` outstanding at a time and
+    return a report of the throughput and latencies.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    statuses: Counter[str] = Counter()
+
+    async def submit(seed: int) -> None:
+        async with semaphore:
+            start = time.perf_counter()
+            reply = await client.battle(
+                characters, seed=seed, timeout=timeout, simultaneous=simultaneous
+            )
+            latencies.append(time.perf_counter() - start)
+            statuses[reply['status']] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(submit(seed) for seed in range(first_seed, first_seed + battles))
+    )
+    elapsed = time.perf_counter() - start
+    metrics = await client.metrics()
+    latencies.sort()
+    lines = [
+        f'{battles} battles in {elapsed:.2f}s ({battles / elapsed:.1f}/s)',
+        'Statuses: ' + ', '.join(f'{k}={v}' for k, v in sorted(statuses.items())),
+        f'Latency: median {statistics.median(latencies):.3f}s,'
+        f' p95 {latencies[int(0.95 * (len(latencies) - 1))]:.3f}s,'
+        f' max {latencies[-1]:.3f}s',
+        f'Server: {json.dumps(metrics["metrics"])}',
+    ]
+    return '\n'.join(lines)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.set_defaults(command=run_load_test)
+    parser.add_argument('characters', nargs=2, help='the characters to battle')
+    parser.add_argument('--battles', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--first-seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, help='per battle, in seconds')
+    parser.add_argument(
+        '--simultaneous', action='store_true', help='have fighters act at the same time'
+    )
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', type=Path, help='connect to a Unix socket')
+
+
+def run_load_test(args: argparse.Namespace) -> None:
+    async def run() -> str:
+        client = await ServiceClient.connect(args.host, args.port, unix=args.unix)
+        try:
+            return await load_test(
+                client,
+                args.characters,
+                battles=args.battles,
+                concurrency=args.concurrency,
+                first_seed=args.first_seed,
+                timeout=args.timeout,
+                simultaneous=args.simultaneous,
+            )
+        finally:
+            await client.close()
+
+    print(asyncio.run(run()))
@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Final
+from typing_extensions import Self
+
+import attrs
+
+from . import moves
+from .characters import Action, Character
+
+DATA_DIR: Final = Path('data')
+SKELETON_PATH: Final = Path('skeletons', 'default.json')
+
+
+def hash_bytes(*chunks: bytes) -> str:
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(hashlib.sha256(chunk).digest())
+    return digest.hexdigest()
+
+
+def load_skeleton(root: Path = DATA_DIR) -> dict[str, dict[str, Any]]:
+    with Path(root, SKELETON_PATH).open() as f:
+        return json.load(f)
+
+
+def character_names(root: Path = DATA_DIR) -> list[str]:
+    return sorted(path.stem for path in Path(root, 'characters').glob('*.json'))
+
+
+@attrs.define
+class ContentPack:
+    """The moves and characters defined in a data directory, along with
+    hashes of the files that define them.
+    """
+
+    root: Path
+    moves: dict[str, Action]
+    characters: dict[str, Character]
+    # Maps paths relative to the root (without suffixes) to file hashes
+    file_hashes: dict[str, str]
+    # Maps character names to the names of the moves they use
+    character_moves: dict[str, list[str]]
+    # The parameters of the skeleton that every character is built from
+    skeleton_params: dict[str, dict[str, Any]] = attrs.field(factory=dict, repr=False)
+
+    @classmethod
+    def load(cls, root: Path = DATA_DIR) -> Self:
+        pack = cls.load_moves(root)
+        for name in character_names(root):
+            pack.load_character(name)
+        return pack
+
+    @classmethod
+    def load_moves(cls, root: Path = DATA_DIR) -> Self:
+        """Load the moves and the skeleton, but none of the characters,
+        which can then be loaded one at a time with `load_character`.
+        """
+        skeleton_data = Path(root, SKELETON_PATH).read_bytes()
+        move_dict: dict[str, Action] = {}
+        file_hashes: dict[str, str] = {}
+        for fp in sorted(Path(root, 'moves').iterdir()):
+            data = fp.read_bytes()
+            move_dict[fp.stem] = moves.make_move_from_json(json.loads(data))
+            file_hashes[f'moves/{fp.stem}'] = hash_bytes(data)
+        file_hashes['skeletons/default'] = hash_bytes(skeleton_data)
+        return cls(root, move_dict, {}, file_hashes, {}, json.loads(skeleton_data))
+
+    def load_character(self, name: str) -> Character:
+        data = Path(self.root, 'characters', f'{name}.json').read_bytes()
+        j: dict[str, Any] = json.loads(data)
+        self.character_moves[name] = list(j['basic_moves'])
+        j['skeleton_params'] = self.skeleton_params
+        character = Character.from_json(j, move_dict=self.moves)
+        self.characters[name] = character
+        self.file_hashes[f'characters/{name}'] = hash_bytes(data)
+        return character
+
+    def character_hash(self, name: str) -> str:
+        """Return a hash of everything that defines the named character
+        in battle: its own file, its moves, and its skeleton.
+        """
+        keys = [f'characters/{name}', 'skeletons/default']
+        keys += [f'moves/{move}' for move in self.character_moves[name]]
+        return hash_bytes(*(self.file_hashes[key].encode() for key in keys))
@@ -1,7 +1,15 @@
-from collections.abc import Callable, Generator
-from typing import Protocol, TypeVar, final
+from __future__ import annotations
+
+import enum
+import math
+from collections.abc import Callable
+from typing import Any, Generic, Protocol, TypeVar, final
 from typing_extensions import Self
 
+import attrs
+from attrs import field
+from panda3d.core import AsyncFuture
+
 
 @final
 class Targetable(Protocol):
@@ -14,18 +22,102 @@ class Targetable(Protocol):
     def __sub__(self, other: Self, /) -> Self:
         ...
 
+    def length(self) -> float:
+        ...
+
 
 T = TypeVar('T', bound=Targetable)
 
 
-def pid(
-    p: float = 0, i: float = 0, d: float = 0, *, zero: Callable[[], T] = float
-) -> Generator[T, tuple[T, float], None]:
-    integral_term = zero()
-    derivative_term = zero()
-    error, dt = yield zero()
-    while True:
-        previous_error = error
-        error, dt = yield (error * p) + integral_term + derivative_term
-        integral_term += (error + previous_error) * (i * dt / 2)
-        derivative_term = (error - previous_error) * (d / dt) if dt else zero()
+class Outcome(enum.Enum):
+    """How a controller finished."""
+
+    ARRIVED = enum.auto()
+    TIMED_OUT = enum.auto()
+    CANCELLED = enum.auto()
+
+
+@attrs.define(eq=False, kw_only=True)
+class Controller(Generic[T]):
+    """A PID controller that drives a measured value towards a target
+    by feeding its output to an actuator once per physics step.
+    """
+
+    measure: Callable[[], T]
+    actuate: Callable[[T], object]
+    target: T
+    p: float = 0
+    i: float = 0
+    d: float = 0
+    # The integral term is kept within this magnitude, so that it can't
+    # wind up while progress is blocked.
+    max_integral: float = math.inf
+    tolerance: float
+    # How slowly the measured value must be changing as well to have arrived
+    max_rate: float = math.inf
+    time_left: float = math.inf
+    # What the controller belongs to, so that it can be cancelled with
+    # everything else belonging to the same thing
+    owner: object = None
+    # Resolved with the `Outcome` once the controller finishes
+    outcome: AsyncFuture = field(factory=AsyncFuture, init=False)
+    _integral: T | None = field(default=None, init=False)
+    _error: T | None = field(default=None, init=False)
+
+    def step(self, dt: float) -> None:
+        error = self.target - self.measure()
+        if error.length() <= self.tolerance and self.rate(error, dt) <= self.max_rate:
+            self.finish(Outcome.ARRIVED)
+            return
+        self.time_left -= dt
+        if self.time_left <= 0:
+            self.finish(Outcome.TIMED_OUT)
+            return
+        output = error * self.p
+        if self._error is not None and dt:
+            integral = (error + self._error) * (self.i * dt / 2)
+            if self._integral is not None:
+                integral = self._integral + integral
+            magnitude = integral.length()
+            if magnitude > self.max_integral:
+                integral = integral * (self.max_integral / magnitude)
+            self._integral = integral
+            output = output + integral + (error - self._error) * (self.d / dt)
+        self._error = error
+        self.actuate(output)
+
+    def rate(self, error: T, dt: float) -> float:
+        if self._error is None or not dt:
+            return 0
+        return (error - self._error).length() / dt
+
+    def finish(self, outcome: Outcome) -> None:
+        if not self.outcome.done():
+            self.outcome.set_result(outcome)
+
+
+@attrs.define
+class ControllerBank:
+    """The active controllers of an arena, which are all stepped in one
+    pass after each physics step on the simulation clock.
+    """
+
+    controllers: list[Controller[Any]] = field(factory=list)
+
+    def add(self, controller: Controller[Any]) -> AsyncFuture:
+        """Start stepping a controller and return its outcome."""
+        self.controllers.append(controller)
+        return controller.outcome
+
+    def cancel(self, owner: object) -> None:
+        """Cancel every controller belonging to the owner."""
+        for controller in tuple(self.controllers):
+            if controller.owner is owner:
+                controller.finish(Outcome.CANCELLED)
+
+    def update(self, dt: float) -> None:
+        for controller in tuple(self.controllers):
+            if not controller.outcome.done():
+                controller.step(dt)
+            if controller.outcome.done():
+                self.controllers.remove(controller)
@@ -25,7 +25,9 @@ class DebugHandler:
         node.show_constraints(False)
         arena.world.set_debug_node(node)
         node_path = arena.root.attach_new_node(node)
-        node_path.show()
+        # The arena draws its bodies where they are shown, between physics
+        # steps, so the raw state of the world is only shown on request.
+        node_path.hide()
         return cls(node_path, event=event)
 
     def toggle_debug(self) -> None:
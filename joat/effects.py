@@ -1,14 +1,18 @@
 from __future__ import annotations
 
+import enum
+import heapq
 import logging
-import random
-from collections.abc import Callable, Iterable
-from typing import TYPE_CHECKING, Final, Protocol
+from collections.abc import Callable, Hashable, Iterable, Iterator
+from typing import TYPE_CHECKING, Any, ClassVar, Final, Protocol
 
 import attrs
+from attrs import field
 
 if TYPE_CHECKING:
-    from .characters import Fighter
+    from panda3d.core import NodePath
+
+    from .characters import Action, Fighter
 
 _logger: Final = logging.getLogger(__name__)
 
@@ -18,23 +22,141 @@ class Effect(Protocol):
         pass
 
 
+class Stacking(enum.Enum):
+    """What happens when an effect is applied to a fighter that already
+    has the same effect.
+    """
+
+    # Each application is a separate instance.
+    STACK = enum.auto()
+    # Applications that would expire on the same turn share an instance,
+    # which counts the applications in `stacks`.
+    MERGE = enum.auto()
+    # There is at most one instance, whose duration restarts.
+    REFRESH = enum.auto()
+
+
 class StatusEffect(Protocol):
+    """An effect that lasts for `duration` of the fighter's turns.
+
+    Status effects are shared between every use of a move, so they
+    shouldn't be modified once made. Anything that differs between
+    instances is kept on the `ActiveEffect` passed to each hook.
+    """
+
     duration: int
+    stacking: ClassVar[Stacking] = Stacking.STACK
 
     def apply(self, fighter: Fighter) -> None:
-        fighter.add_effect(attrs.evolve(self))
+        fighter.add_effect(self)
+
+    def on_application(self, fighter: Fighter, active: ActiveEffect) -> None:
+        pass
+
+    def on_turn(self, fighter: Fighter, active: ActiveEffect) -> None:
+        pass
 
-    def on_application(self, fighter: Fighter) -> None:
+    def on_hit(self, fighter: Fighter, active: ActiveEffect, damage: int) -> None:
         pass
 
-    def on_turn(self, fighter: Fighter) -> None:
+    def on_move(self, fighter: Fighter, active: ActiveEffect, action: Action) -> None:
         pass
 
-    def on_removal(self, fighter: Fighter) -> None:
+    def on_removal(self, fighter: Fighter, active: ActiveEffect) -> None:
         pass
 
-    def is_active(self) -> bool:
-        return self.duration > 0
+
+@attrs.define(slots=True)
+class ActiveEffect:
+    effect: StatusEffect
+    # The turn of the schedule after which the effect is removed
+    expires: int
+    stacks: int = 1
+    # Anything the effect needs to remember about this instance
+    state: Any = None
+
+
+@attrs.define
+class EffectSchedule:
+    """The status effects on a fighter, with their expiry times in a heap.
+
+    Hooks are called in the order in which the effects were applied, so
+    that battles play out the same way every time.
+    """
+
+    # The number of times `tick` has been called
+    turn: int = 0
+    _active: dict[int, ActiveEffect] = field(factory=dict, init=False, repr=False)
+    # The instances that later applications stack onto, by stacking key
+    _keys: dict[Hashable, int] = field(factory=dict, init=False, repr=False)
+    _key_of: dict[int, Hashable] = field(factory=dict, init=False, repr=False)
+    _expiry: list[tuple[int, int]] = field(factory=list, init=False, repr=False)
+    _next_id: int = field(default=0, init=False, repr=False)
+
+    def __iter__(self) -> Iterator[ActiveEffect]:
+        return iter(self._active.values())
+
+    def __len__(self) -> int:
+        return len(self._active)
+
+    def add(self, fighter: Fighter, effect: StatusEffect) -> None:
+        expires = self.turn + effect.duration
+        key: Hashable = None
+        if effect.stacking is Stacking.MERGE:
+            key = effect, expires
+        elif effect.stacking is Stacking.REFRESH:
+            key = type(effect)
+        effect_id = self._keys.get(key) if key is not None else None
+        if effect_id is not None:
+            active = self._active[effect_id]
+            if effect.stacking is Stacking.MERGE:
+                active.stacks += 1
+            elif active.expires != expires:
+                active.expires = expires
+                heapq.heappush(self._expiry, (expires, effect_id))
+            return
+        effect_id = self._next_id
+        self._next_id += 1
+        active = ActiveEffect(effect, expires)
+        self._active[effect_id] = active
+        if key is not None:
+            self._keys[key] = effect_id
+            self._key_of[effect_id] = key
+        heapq.heappush(self._expiry, (expires, effect_id))
+        effect.on_application(fighter, active)
+
+    def tick(self, fighter: Fighter) -> None:
+        """Advance by a turn, then remove the effects that have expired."""
+        self.turn += 1
+        for active in tuple(self._active.values()):
+            active.effect.on_turn(fighter, active)
+        while self._expiry and self._expiry[0][0] <= self.turn:
+            expires, effect_id = heapq.heappop(self._expiry)
+            active = self._active.get(effect_id)
+            # Refreshed effects leave their old expiry times behind.
+            if active is not None and active.expires == expires:
+                self.remove(fighter, effect_id)
+
+    def remove(self, fighter: Fighter, effect_id: int) -> None:
+        active = self._active.pop(effect_id)
+        key = self._key_of.pop(effect_id, None)
+        if key is not None:
+            del self._keys[key]
+        active.effect.on_removal(fighter, active)
+
+    def notify_hit(self, fighter: Fighter, damage: int) -> None:
+        for active in tuple(self._active.values()):
+            active.effect.on_hit(fighter, active, damage)
+
+    def notify_move(self, fighter: Fighter, action: Action) -> None:
+        for active in tuple(self._active.values()):
+            active.effect.on_move(fighter, active, action)
+
+    def clear(self, fighter: Fighter) -> None:
+        """Remove every effect, in the order they were applied."""
+        for effect_id in tuple(self._active):
+            self.remove(fighter, effect_id)
+        self._expiry.clear()
 
 
 @attrs.define
@@ -53,8 +175,9 @@ class DamageEffect:
     upper_bound: int
 
     def apply(self, fighter: Fighter) -> None:
-        damage = random.randint(self.lower_bound, self.upper_bound)
-        if random.randint(1, 100) <= 2:
+        rng = fighter.rng.stream('damage')
+        damage = rng.randint(self.lower_bound, self.upper_bound)
+        if rng.randint(1, 100) <= 2:
             damage = 3 * damage // 2
         fighter.apply_damage(damage)
 
@@ -62,33 +185,54 @@ class DamageEffect:
 @attrs.define
 class CleanseEffect:
     def apply(self, fighter: Fighter) -> None:
-        for effect in fighter.status_effects:
-            effect.on_removal(fighter)
-        fighter.status_effects.clear()
+        fighter.status_effects.clear(fighter)
 
 
-@attrs.define
+@attrs.frozen
 class PoisonEffect(StatusEffect):
     strength: int
     duration: int
+    # Poison damage adds up, so doses ending together can share an instance.
+    stacking: ClassVar[Stacking] = Stacking.MERGE
 
-    def on_turn(self, fighter: Fighter) -> None:
-        fighter.apply_damage(self.strength)
+    def on_turn(self, fighter: Fighter, active: ActiveEffect) -> None:
+        fighter.apply_damage(self.strength * active.stacks)
 
 
-@attrs.define
+@attrs.frozen
 class InvisibilityEffect(StatusEffect):
     duration: int
-    _old_debug_values: dict[str, bool] = attrs.field(factory=dict, init=False)
-
-    def on_application(self, fighter: Fighter) -> object:
-        for name, part in fighter.skeleton.parts.items():
-            self._old_debug_values[name] = part.node().debug_enabled
+    stacking: ClassVar[Stacking] = Stacking.REFRESH
+
+    def on_application(self, fighter: Fighter, active: ActiveEffect) -> None:
+        # The parts are drawn by their proxies (the health bar hangs off
+        # the torso's), and by the debug node when that is shown.
+        active.state = {}
+        for name, proxy, part in self._parts(fighter):
+            active.state[name] = part.node().debug_enabled, proxy.is_hidden()
             part.node().debug_enabled = False
-
-    def on_removal(self, fighter: Fighter) -> object:
+            proxy.hide()
+
+    def on_removal(self, fighter: Fighter, active: ActiveEffect) -> None:
+        for name, proxy, part in self._parts(fighter):
+            if name not in active.state:
+                continue
+            debug_enabled, hidden = active.state[name]
+            part.node().debug_enabled = debug_enabled
+            if not hidden:
+                proxy.show()
+
+    @staticmethod
+    def _parts(fighter: Fighter) -> Iterator[tuple[str, NodePath, NodePath]]:
+        """Yield the name, proxy and body of each part of a fighter that
+        is in an arena.
+        """
+        if fighter.arena is None:
+            return
         for name, part in fighter.skeleton.parts.items():
-            part.node().debug_enabled = self._old_debug_values[name]
+            proxy = fighter.arena.proxies.get(part)
+            if proxy is not None:
+                yield name, proxy, part
 
 
 EFFECT_CONSTRUCTORS: dict[str, Callable[..., Effect]] = {
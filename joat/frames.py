@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import contextlib
+import gc
+import logging
+import time
+from collections.abc import Iterator
+from typing import Any, Final
+
+import attrs
+from attrs import field
+
+from . import moves
+from .characters import Action
+from .providers import ActionProvider
+
+_logger: Final = logging.getLogger(__name__)
+
+# A threshold that the number of collections of the younger generations
+# never reaches, since `gc.set_threshold` takes C ints
+NEVER: Final = 2**31 - 1
+
+
+def freeze() -> None:
+    """Move everything alive into the permanent generation, which the
+    garbage collector never looks at again. Meant for content loaded
+    once at startup, which lives as long as the process anyway.
+    """
+    gc.collect()
+    gc.freeze()
+    _logger.info(f'Froze {gc.get_freeze_count()} objects')
+
+
+@attrs.define
+class PauseStats:
+    count: int = 0
+    total: float = 0
+    longest: float = 0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.longest = max(self.longest, seconds)
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            **attrs.asdict(self),
+            'mean': self.total / max(self.count, 1),
+        }
+
+
+@attrs.define(eq=False)
+class FrameBudget:
+    """Keeps full garbage collections out of battle frames.
+
+    Within `battle`, the oldest generation is only collected when
+    `collect_idle` is called at a quiet moment, like between turns or
+    while waiting for a decision. Every collection is timed, by
+    generation for those that happened on their own, and separately for
+    those in idle time.
+    """
+
+    automatic: tuple[PauseStats, ...] = field(
+        factory=lambda: tuple(PauseStats() for _ in range(3)), init=False
+    )
+    idle: PauseStats = field(factory=PauseStats, init=False)
+    _threshold: int | None = field(default=None, init=False, repr=False)
+    _collecting: bool = field(default=False, init=False, repr=False)
+    _start: float = field(default=0, init=False, repr=False)
+
+    def __attrs_post_init__(self) -> None:
+        gc.callbacks.append(self._on_collection)
+
+    def destroy(self) -> None:
+        gc.callbacks.remove(self._on_collection)
+
+    @contextlib.contextmanager
+    def battle(self) -> Iterator[None]:
+        """Put off full collections until `collect_idle` is called."""
+        threshold_0, threshold_1, threshold_2 = gc.get_threshold()
+        self._threshold = threshold_2
+        gc.set_threshold(threshold_0, threshold_1, NEVER)
+        try:
+            yield
+        finally:
+            gc.set_threshold(threshold_0, threshold_1, threshold_2)
+            self._threshold = None
+
+    def collect_idle(self) -> None:
+        """Run the full collection that was put off, if one is due."""
+        if self._threshold is None or gc.get_count()[2] < self._threshold:
+            return
+        self._collecting = True
+        try:
+            gc.collect()
+        finally:
+            self._collecting = False
+
+    def _on_collection(self, phase: str, info: dict[str, Any]) -> None:
+        if phase == 'start':
+            self._start = time.perf_counter()
+            return
+        seconds = time.perf_counter() - self._start
+        if self._collecting:
+            self.idle.add(seconds)
+        else:
+            self.automatic[info['generation']].add(seconds)
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            'automatic': [stats.to_json() for stats in self.automatic],
+            'idle': self.idle.to_json(),
+        }
+
+    def report(self) -> str:
+        """Return a line of pause statistics for each kind of collection."""
+        lines = []
+        for name, stats in (
+            *((f'generation {i}', s) for i, s in enumerate(self.automatic)),
+            ('idle', self.idle),
+        ):
+            lines.append(
+                f'GC {name}: {stats.count} pauses, {stats.total * 1000:.1f}ms in'
+                f' total, {stats.longest * 1000:.1f}ms longest'
+            )
+        return '\n'.join(lines)
+
+
+@attrs.define
+class IdleProvider:
+    """Collect garbage that's due before waiting on another provider."""
+
+    provider: ActionProvider
+    budget: FrameBudget
+
+    async def query_action(self) -> tuple[Action, moves.Target]:
+        self.budget.collect_idle()
+        return await self.provider.query_action()
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import random
+import time
+from collections.abc import Callable, Coroutine, Sequence
+from pathlib import Path
+from typing import Any
+from typing_extensions import Self
+
+import attrs
+from panda3d.core import (
+    ClockObject,
+    NodePath,
+    Notify,
+    NSError,
+    RenderState,
+    TransformState,
+)
+
+from . import arenas, battles, content, frames, physics, tasks
+from .characters import Character, Fighter
+from .providers import ActionProvider, RandomProvider
+from .rng import RandomStreams
+from .scenery import StaticGeometry
+
+ProviderFactory = Callable[[Fighter, random.Random], ActionProvider]
+
+_worker_pack: content.ContentPack | None = None
+
+
+@attrs.frozen
+class BattleResult:
+    seed: int
+    # The index of the winning character as passed to `run_battle`,
+    # or `None` if the battle was a draw
+    winner: int | None
+    # The number of turns taken, or of actions in a simultaneous battle
+    turns: int
+    health: tuple[int, int]
+    sim_time: float
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> Self:
+        return cls(**{**data, 'health': tuple(data['health'])})
+
+    def to_json(self) -> dict[str, Any]:
+        return attrs.asdict(self)
+
+
+def make_arena(
+    *,
+    seed: int | str,
+    step_size: float = 1 / 60,
+    geometry: StaticGeometry | None = None,
+) -> arenas.Arena:
+    """Return an arena for simulating without a window."""
+    return arenas.Arena(
+        NodePath('Arena Root'),
+        physics.make_world(gravity=physics.GRAVITY),
+        debug_handler=None,
+        rng=RandomStreams(seed),
+        geometry=geometry,
+        step_size=step_size,
+        interpolate=False,
+        draw=False,
+    )
+
+
+def simulate(
+    arena: arenas.Arena, coroutine: Coroutine[Any, Any, object], *, max_time: float
+) -> bool:
+    """Step the arena as fast as possible until the coroutine finishes or
+    `max_time` simulated seconds have passed, and return whether it
+    finished. Exceptions raised by the coroutine are propagated.
+
+    The global clock is switched to non-real-time mode for the duration,
+    so this should not be used while a window is open.
+    """
+    done = False
+    errors: list[BaseException] = []
+
+    async def run() -> None:
+        nonlocal done
+        try:
+            await coroutine
+        except GeneratorExit:
+            # The task was cancelled
+            raise
+        except BaseException as e:
+            errors.append(e)
+            raise
+        done = True
+
+    # Every simulation starts from the same clock time, so that rounding
+    # can't make the same seed play out differently.
+    clock = ClockObject.get_global_clock()
+    previous_mode = clock.mode
+    clock.set_mode(ClockObject.M_non_real_time)
+    # Resetting the clock warns about the adjustment every time.
+    util_notify = Notify.ptr().get_category(':util')
+    previous_severity = util_notify.get_severity()
+    util_notify.set_severity(NSError)
+    clock.reset()
+    util_notify.set_severity(previous_severity)
+    clock.set_dt(arena.step_size)
+    arena.running = True
+    start_time = arena.sim_time
+    task = arena.task_group.add(run())
+    try:
+        while not done and not errors and arena.sim_time - start_time < max_time:
+            if arena.paused:
+                # Waiting on something outside the simulation
+                time.sleep(0.001)
+            else:
+                arena.step(arena.step_size)
+                clock.tick()
+            tasks.TASK_MANAGER.poll()
+            # Without a window, nothing else frees the cached states that
+            # are no longer used, as ShowBase does every frame.
+            TransformState.garbage_collect()
+            RenderState.garbage_collect()
+    finally:
+        arena.task_group.cancel(task)
+        arena.running = False
+        clock.set_mode(previous_mode)
+    if errors:
+        raise errors[0]
+    return done
+
+
+def run_battle(
+    character_1: Character,
+    character_2: Character,
+    *,
+    seed: int = 0,
+    max_turns: int = 100,
+    max_time: float = 600,
+    step_size: float = 1 / 60,
+    geometry: StaticGeometry | None = None,
+    simultaneous: bool = False,
+    provider_factories: Sequence[ProviderFactory] = (
+        RandomProvider.for_fighter,
+        RandomProvider.for_fighter,
+    ),
+) -> BattleResult:
+    """Simulate a battle without a window, as fast as possible.
+
+    Every random roll in the battle comes from streams derived from
+    `seed`, so the result only depends on the seed, the content and the
+    decisions of the providers.
+
+    This should not be used while a window is open (see `simulate`).
+    A battle lasting longer than `max_turns` turns or `max_time` simulated
+    seconds is a draw. If `simultaneous`, the fighters act at the same
+    time (see `battles.run_at_once`), each taking up to half of the turns.
+    """
+    order = [0, 1]
+    if character_2.speed > character_1.speed:
+        order.reverse()
+    characters = (character_1, character_2)
+    fighters = battles.make_fighters(*(characters[i] for i in order))
+    arena = make_arena(seed=seed, step_size=step_size, geometry=geometry)
+    providers = [
+        provider_factories[i](fighter, arena.rng.stream(f'provider {i}'))
+        for i, fighter in zip(order, fighters)
+    ]
+    turns = 0
+    outcome: list[Fighter | None] = []
+
+    async def count_turn(*args: object) -> None:
+        nonlocal turns
+        turns += 1
+
+    async def battle() -> None:
+        for fighter in fighters:
+            fighter.enter_arena(arena)
+        if simultaneous:
+            winner = await battles.run_at_once(
+                fighters,
+                providers,
+                between_actions=count_turn,
+                max_actions=max_turns // len(fighters),
+            )
+        else:
+            winner = await battles.run_turns(
+                fighters, providers, between_turns=count_turn, max_turns=max_turns
+            )
+        outcome.append(winner)
+
+    try:
+        simulate(arena, battle(), max_time=max_time)
+    finally:
+        for fighter in fighters:
+            fighter.exit_arena()
+        arena.exit()
+
+    winner = outcome[0] if outcome else None
+    winner_index: int | None = None
+    if winner is not None:
+        turns += 1
+        winner_index = order[0 if winner is fighters[0] else 1]
+    health = [0, 0]
+    for i, fighter in zip(order, fighters):
+        health[i] = fighter.health
+    return BattleResult(
+        seed=seed,
+        winner=winner_index,
+        turns=turns,
+        health=(health[0], health[1]),
+        sim_time=arena.sim_time,
+    )
+
+
+def init_worker(root: Path) -> None:
+    """Load the content used by battles in a worker process.
+
+    Meant as the initializer of a process pool running battles.
+    """
+    global _worker_pack
+    _worker_pack = content.ContentPack.load(root)
+    frames.freeze()
+
+
+def get_worker_pack() -> content.ContentPack:
+    if _worker_pack is None:
+        raise RuntimeError('init_worker was not called in this process')
+    return _worker_pack
@@ -0,0 +1,474 @@
+from __future__ import annotations
+
+import argparse
+import array
+import base64
+import bisect
+import concurrent.futures
+import itertools
+import json
+import logging
+import math
+import os
+from collections.abc import Iterator, Sequence
+from pathlib import Path
+from typing import Any, Final
+from typing_extensions import Self
+
+import attrs
+from attrs import field
+from panda3d.core import AsyncTaskPause, Vec3
+
+from . import content, headless, moves, spatial, stances
+from .characters import Action, Character, Fighter
+from .providers import ActionProvider
+
+_logger: Final = logging.getLogger(__name__)
+
+DEFAULT_DIR: Final = Path('.cache', 'hitmaps')
+DEFAULT_TARGET: Final = 'dummy'
+
+
+def is_mappable(action: Action) -> bool:
+    """Return whether the outcome of the action depends on where
+    the fighters are.
+    """
+    return isinstance(action, (moves.MeleeMove, moves.RangedMove, moves.AreaMove))
+
+
+@attrs.frozen
+class Placement:
+    """Where a target is relative to a user.
+
+    `bearing` is the angle from the user's facing direction to the target,
+    and `facing` is the angle from the target's facing direction to the
+    user. Both are in degrees, counterclockwise.
+    """
+
+    distance: float
+    bearing: float
+    facing: float
+
+    @classmethod
+    def between(cls, user: Fighter, target: Fighter) -> Self:
+        transform = user.get_transform_of(target.skeleton.core)
+        offset = transform.get_pos()
+        target_forward = transform.get_mat().xform_vec(Vec3.unit_x())
+        bearing = math.atan2(offset.y, offset.x)
+        facing = math.atan2(-offset.y, -offset.x) - math.atan2(
+            target_forward.y, target_forward.x
+        )
+        return cls(
+            math.hypot(offset.x, offset.y),
+            math.degrees(bearing),
+            math.degrees(facing) % 360,
+        )
+
+    def place(self, user: Character, target: Character) -> tuple[Fighter, Fighter]:
+        """Return a fighter for the user at the origin and one for
+        the target in this placement relative to it.
+        """
+        bearing = math.radians(self.bearing)
+        yaw = bearing + math.pi - math.radians(self.facing)
+        user_fighter = user.make_fighter()
+        target_fighter = target.make_fighter(
+            xform=spatial.make_rigid_transform(
+                rotation=spatial.make_rotation(yaw, Vec3.unit_z()),
+                translation=Vec3(
+                    self.distance * math.cos(bearing),
+                    self.distance * math.sin(bearing),
+                    0,
+                ),
+            )
+        )
+        if user_fighter.name == target_fighter.name:
+            user_fighter.name += ' (1)'
+            target_fighter.name += ' (2)'
+        user_fighter.set_stance(stances.BOXING_STANCE)
+        target_fighter.set_stance(stances.BOXING_STANCE)
+        return user_fighter, target_fighter
+
+
+@attrs.frozen
+class Grid:
+    distances: tuple[float, ...] = (0.6, 0.9, 1.2, 1.6, 2.2, 3.0, 4.0)
+    bearings: tuple[float, ...] = (-60, -30, 0, 30, 60)
+    # Facings wrap around, so they should evenly divide the circle.
+    facings: tuple[float, ...] = (0, 90, 180, 270)
+
+    def __iter__(self) -> Iterator[Placement]:
+        for distance, bearing, facing in itertools.product(
+            self.distances, self.bearings, self.facings
+        ):
+            yield Placement(distance, bearing, facing)
+
+    def __len__(self) -> int:
+        return len(self.distances) * len(self.bearings) * len(self.facings)
+
+    def weights(self, placement: Placement) -> list[tuple[int, float]]:
+        """Return the indices of the grid points around the placement,
+        along with their weights for interpolation.
+        """
+        d_weights = _axis_weights(self.distances, placement.distance)
+        b_weights = _axis_weights(self.bearings, placement.bearing)
+        f_weights = _axis_weights(self.facings, placement.facing % 360, period=360)
+        n_b = len(self.bearings)
+        n_f = len(self.facings)
+        return [
+            ((d * n_b + b) * n_f + f, w_d * w_b * w_f)
+            for d, w_d in d_weights
+            for b, w_b in b_weights
+            for f, w_f in f_weights
+        ]
+
+
+def _axis_weights(
+    values: Sequence[float], x: float, *, period: float | None = None
+) -> list[tuple[int, float]]:
+    if period is not None:
+        i = bisect.bisect_right(values, x) - 1
+        j = (i + 1) % len(values)
+        span = (values[j] - values[i]) % period or period
+        t = ((x - values[i]) % period) / span
+        return [(i % len(values), 1 - t), (j, t)]
+    if x <= values[0]:
+        return [(0, 1)]
+    if x >= values[-1]:
+        return [(len(values) - 1, 1)]
+    i = bisect.bisect_right(values, x) - 1
+    t = (x - values[i]) / (values[i + 1] - values[i])
+    return [(i, 1 - t), (i + 1, t)]
+
+
+def _pack_floats(values: Sequence[float]) -> str:
+    return base64.b64encode(array.array('f', values).tobytes()).decode()
+
+
+def _unpack_floats(data: str) -> array.array[float]:
+    values = array.array('f')
+    values.frombytes(base64.b64decode(data))
+    return values
+
+
+@attrs.frozen
+class HitMap:
+    """The chance that a move hits and the damage it deals on average,
+    for each placement of the target in a grid.
+    """
+
+    grid: Grid
+    hit_chances: Sequence[float]
+    expected_damage: Sequence[float]
+    # The defense of the character the map was measured against
+    target_defense: int
+
+    def lookup(
+        self, placement: Placement, *, defense: int | None = None
+    ) -> tuple[float, float]:
+        """Return the interpolated hit chance and expected damage, scaled
+        to a target with the given defense like impacts are.
+        """
+        hit_chance = 0.0
+        damage = 0.0
+        for i, weight in self.grid.weights(placement):
+            hit_chance += weight * self.hit_chances[i]
+            damage += weight * self.expected_damage[i]
+        if defense is not None:
+            damage *= (10 + self.target_defense) / (10 + defense)
+        return hit_chance, damage
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> Self:
+        grid = Grid(**{key: tuple(value) for key, value in data['grid'].items()})
+        return cls(
+            grid,
+            _unpack_floats(data['hit_chances']),
+            _unpack_floats(data['expected_damage']),
+            data['target_defense'],
+        )
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            'grid': attrs.asdict(self.grid),
+            'hit_chances': _pack_floats(self.hit_chances),
+            'expected_damage': _pack_floats(self.expected_damage),
+            'target_defense': self.target_defense,
+        }
+
+
+def sample_move(
+    user: Character,
+    target: Character,
+    move: Action,
+    placement: Placement,
+    *,
+    seed: int | str,
+    settle_time: float = 2,
+) -> tuple[bool, int]:
+    """Use a move once on a target in the given placement and return
+    whether it hit and how much damage it dealt.
+    """
+    user_fighter, target_fighter = placement.place(user, target)
+    arena = headless.make_arena(seed=seed)
+
+    async def use_move() -> None:
+        user_fighter.enter_arena(arena)
+        target_fighter.enter_arena(arena)
+        await user_fighter.use_move(move, target_fighter)
+        # Give anything knocked about time to hit something else.
+        await AsyncTaskPause(settle_time)
+
+    try:
+        headless.simulate(arena, use_move(), max_time=30)
+    finally:
+        user_fighter.exit_arena()
+        target_fighter.exit_arena()
+        arena.exit()
+    damage = target_fighter.base_health - target_fighter.health
+    return damage > 0 or bool(target_fighter.status_effects), damage
+
+
+def _sample_batch(
+    user: str,
+    target: str,
+    move_name: str,
+    placements: Sequence[Placement],
+    samples: int,
+) -> list[tuple[float, float]]:
+    pack = headless.get_worker_pack()
+    user_character = pack.characters[user]
+    move = next(move for move in user_character.moves if move.name == move_name)
+    results: list[tuple[float, float]] = []
+    for placement in placements:
+        hits = 0
+        damage = 0
+        for i in range(samples):
+            seed = f'{placement.distance}:{placement.bearing}:{placement.facing}:{i}'
+            hit, dealt = sample_move(
+                user_character, pack.characters[target], move, placement, seed=seed
+            )
+            hits += hit
+            damage += dealt
+        results.append((hits / samples, damage / samples))
+    return results
+
+
+def maps_path(directory: Path, user: str, target: str) -> Path:
+    return Path(directory, user, f'{target}.json')
+
+
+def load_character_maps(
+    pack: content.ContentPack, name: str, directory: Path = DEFAULT_DIR
+) -> dict[tuple[str, str, str], HitMap]:
+    """Load the maps of a character in the pack against every target they
+    were built for, if they are up to date.
+    """
+    character = pack.characters[name]
+    maps = {}
+    for path in sorted(Path(directory, name).glob('*.json')):
+        data = json.loads(path.read_text())
+        target = data['target']
+        if target not in pack.characters or data['content_hash'] != map_hash(
+            pack, name, target
+        ):
+            _logger.info(f'Ignoring outdated hit maps in {path}')
+            continue
+        target_name = pack.characters[target].name
+        maps.update(
+            ((character.name, target_name, move_name), HitMap.from_json(map_data))
+            for move_name, map_data in data['moves'].items()
+        )
+    return maps
+
+
+@attrs.define
+class HitMaps:
+    """Hit maps for the moves of some characters, keyed by the names of
+    the user, the target and the move.
+    """
+
+    maps: dict[tuple[str, str, str], HitMap] = field(factory=dict)
+
+    @classmethod
+    def load(cls, pack: content.ContentPack, directory: Path = DEFAULT_DIR) -> Self:
+        """Load the maps in the directory that are up to date with the
+        content pack.
+        """
+        hit_maps = cls()
+        for name in pack.characters:
+            hit_maps.maps.update(load_character_maps(pack, name, directory))
+        return hit_maps
+
+    def get(
+        self, character: Character, target: Character, action: Action
+    ) -> HitMap | None:
+        return self.maps.get((character.name, target.name, action.name))
+
+    def find(
+        self, character: Character, target: Character, action: Action
+    ) -> HitMap | None:
+        """Return the map of the action against the target, or else one
+        against any other target.
+        """
+        hit_map = self.get(character, target, action)
+        if hit_map is not None:
+            return hit_map
+        return next(
+            (
+                hit_map
+                for (user, _, move), hit_map in self.maps.items()
+                if user == character.name and move == action.name
+            ),
+            None,
+        )
+
+    def estimate(
+        self, user: Fighter, target: Fighter, action: Action
+    ) -> tuple[float, float] | None:
+        """Return the chance that the action hits the target and the damage
+        it should deal, or `None` if there is no map for the action.
+
+        Without a map against the target's character, one against another
+        character stands in, with the damage scaled to the target's defense.
+        """
+        hit_map = self.find(user.character, target.character, action)
+        if hit_map is None:
+            return None
+        return hit_map.lookup(Placement.between(user, target), defense=target.defense)
+
+
+@attrs.define
+class HitMapProvider:
+    """Choose the move expected to deal the most damage from the current
+    placement, deferring to another provider for fighters without maps.
+    """
+
+    fighter: Fighter
+    opponent: Fighter
+    hit_maps: HitMaps
+    fallback: ActionProvider
+
+    async def query_action(self) -> tuple[Action, moves.Target]:
+        best: tuple[float, Action] | None = None
+        for action in self.fighter.moves:
+            if moves.Target.OTHER not in action.valid_targets:
+                continue
+            estimate = self.hit_maps.estimate(self.fighter, self.opponent, action)
+            if estimate is not None and (best is None or estimate[1] > best[0]):
+                best = estimate[1], action
+        if best is None:
+            return await self.fallback.query_action()
+        return best[1], moves.Target.OTHER
+
+
+def map_hash(pack: content.ContentPack, user: str, target: str) -> str:
+    return content.hash_bytes(
+        pack.character_hash(user).encode(), pack.character_hash(target).encode()
+    )
+
+
+def build_maps(
+    pack: content.ContentPack,
+    name: str,
+    *,
+    target: str = DEFAULT_TARGET,
+    grid: Grid = Grid(),
+    samples: int = 8,
+    workers: int | None = None,
+    directory: Path = DEFAULT_DIR,
+) -> dict[str, HitMap]:
+    """Sample the moves of the named character against the target over
+    the grid, and save the resulting maps in the directory.
+    """
+    character = pack.characters[name]
+    target_defense = pack.characters[target].defense
+    placements = list(grid)
+    batch_size = len(grid.facings)
+    hit_maps: dict[str, HitMap] = {}
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, initializer=headless.init_worker, initargs=(pack.root,)
+    ) as executor:
+        futures = {
+            action.name: [
+                executor.submit(
+                    _sample_batch,
+                    name,
+                    target,
+                    action.name,
+                    placements[i : i + batch_size],
+                    samples,
+                )
+                for i in range(0, len(placements), batch_size)
+            ]
+            for action in character.moves
+            if is_mappable(action)
+        }
+        for move_name, batch_futures in futures.items():
+            cells = [cell for future in batch_futures for cell in future.result()]
+            hit_maps[move_name] = HitMap(
+                grid,
+                array.array('f', (hit_chance for hit_chance, _ in cells)),
+                array.array('f', (damage for _, damage in cells)),
+                target_defense,
+            )
+            _logger.info(f'Mapped {move_name} for {character} against {target}')
+    path = maps_path(directory, name, target)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = {
+        'content_hash': map_hash(pack, name, target),
+        'target': target,
+        'moves': {move: hit_map.to_json() for move, hit_map in hit_maps.items()},
+    }
+    path.write_text(json.dumps(data))
+    return hit_maps
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.set_defaults(command=run)
+    parser.add_argument(
+        'characters',
+        nargs='*',
+        help='the characters whose moves to map (by default, all of them)',
+    )
+    parser.add_argument(
+        '--target',
+        dest='targets',
+        action='append',
+        metavar='TARGET',
+        help=f'a character to map moves against (by default, {DEFAULT_TARGET})',
+    )
+    parser.add_argument('--samples', type=int, default=8)
+    parser.add_argument('--data-dir', type=Path, default=content.DATA_DIR)
+    parser.add_argument('--output-dir', type=Path, default=DEFAULT_DIR)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument(
+        '--force', action='store_true', help='rebuild maps that are up to date'
+    )
+
+
+def run(args: argparse.Namespace) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    _logger.setLevel(logging.INFO)
+    pack = content.ContentPack.load(args.data_dir)
+    existing = HitMaps.load(pack, args.output_dir)
+    for name in args.characters or pack.characters:
+        character = pack.characters[name]
+        mappable = [action for action in character.moves if is_mappable(action)]
+        if not mappable:
+            continue
+        for target in args.targets or [DEFAULT_TARGET]:
+            target_character = pack.characters[target]
+            if not args.force and all(
+                existing.get(character, target_character, a) for a in mappable
+            ):
+                print(f'Hit maps for {name} against {target} are up to date')
+                continue
+            build_maps(
+                pack,
+                name,
+                target=target,
+                samples=args.samples,
+                workers=args.workers,
+                directory=args.output_dir,
+            )
+            print(f'Built hit maps for {name} against {target}')
@@ -1,25 +1,48 @@
 from __future__ import annotations
 
-import itertools
-import json
+import argparse
+import contextlib
+import functools
 import logging
 import math
-from collections.abc import Iterable
+import time
+from collections.abc import Iterable, Sequence
 from pathlib import Path
 from typing import Final, Protocol
 
 import imgui
 from direct.showbase.ShowBase import ShowBase
-from panda3d.core import AsyncTaskPause, ClockObject, GraphicsWindow, Vec3
+from panda3d.core import AsyncTaskPause, GraphicsWindow
 
-from . import arenas, moves, physics, spatial, stances, tasks, ui
+from . import (
+    arenas,
+    balance,
+    battles,
+    benchmark,
+    client,
+    content,
+    frames,
+    hitmaps,
+    netplay,
+    physics,
+    presentation,
+    rendering,
+    scenery,
+    service,
+    soak,
+    spectate,
+    surrogate,
+    tasks,
+    tuning,
+    ui,
+)
 from .characters import Action, Character, Fighter
 from .panda_imgui import Panda3DRenderer
+from .providers import ActionProvider
+from .rng import RandomStreams
 
 _logger: Final = logging.getLogger(__name__)
 
-GRAVITY: Final = Vec3(0, 0, -9.81)
-
 
 class SupportsDraw(Protocol):
     def draw(self) -> object:
@@ -33,15 +56,53 @@ class App:
     character_menu: ui.CharacterMenu
     fighter_menu: ui.CharacterMenu
     main_menu: ui.MainMenu
+    render_scheduler: rendering.RenderScheduler
+    presentation: presentation.Presentation
+    frame_budget: frames.FrameBudget
+    physics_chain: str | None = None
+    hit_maps: hitmaps.HitMaps | None = None
+    arena_geometry: scenery.StaticGeometry | None = None
+    # The port to broadcast battles to spectators on, if any
+    broadcast_port: int | None = None
+    broadcast_rate: float = 20
+    # How many fighters take part in each battle, split between this many
+    # teams or all fighting each other if `team_count` is `None`
+    fighter_count: int = 2
+    team_count: int | None = None
+    # Whether fighters act at the same time instead of taking turns
+    simultaneous: bool = False
     drawing: bool = True
+    in_battle: bool = False
+    # Whether content finished loading during a battle and has yet to be
+    # frozen (see `freeze_content`)
+    freeze_pending: bool = False
 
     def __init__(
         self,
         *,
         available_characters: Iterable[Character] = (),
         base: ShowBase | None = None,
+        threaded_physics: bool = False,
+        hit_maps: hitmaps.HitMaps | None = None,
+        arena_geometry: scenery.StaticGeometry | None = None,
+        broadcast_port: int | None = None,
+        broadcast_rate: float = 20,
+        fighter_count: int = 2,
+        team_count: int | None = None,
+        simultaneous: bool = False,
+        pace: presentation.Pace = presentation.Pace.NORMAL,
     ) -> None:
         self.base = base or ShowBase()
+        self.hit_maps = hit_maps
+        self.arena_geometry = arena_geometry
+        self.broadcast_port = broadcast_port
+        self.broadcast_rate = broadcast_rate
+        self.fighter_count = fighter_count
+        self.team_count = team_count
+        self.simultaneous = simultaneous
+        if threaded_physics:
+            tasks.make_thread_chain(tasks.PHYSICS_CHAIN)
+            self.physics_chain = tasks.PHYSICS_CHAIN
         self.available_characters = list(available_characters)
         self.selected_characters = []
         self.main_menu = ui.MainMenu.construct(
@@ -58,11 +119,61 @@ class App:
             confirmation_callback=self.select_character,
             back_callback=self.enter_main_menu,
         )
+        self.render_scheduler = rendering.RenderScheduler(self.base)
+        self.presentation = presentation.Presentation(pace)
+        self.frame_budget = frames.FrameBudget()
+        tasks.add_task(self.render_scheduler.run())
         self.enter_main_menu()
 
     def run(self) -> None:
         self.base.run()
 
+    async def load_content(
+        self, root: Path = content.DATA_DIR, *, arena: str | None = None
+    ) -> None:
+        """Load the content pack on a thread of its own, along with the
+        geometry of an arena to fight in and the hit maps, making each
+        character available in the menus as soon as it's ready.
+        """
+        start = time.perf_counter()
+        tasks.make_thread_chain(tasks.LOADING_CHAIN)
+        # Loading takes a frame for each step, so frames mustn't be slowed.
+        with self.render_scheduler.keep_active():
+            names = await tasks.run_on_chain(content.character_names, root)
+            for name in names:
+                self.character_menu.add_loading(name)
+                self.fighter_menu.add_loading(name)
+            pack = await tasks.run_on_chain(content.ContentPack.load_moves, root)
+            # Characters are only ready to fight once the arena is.
+            if arena is not None:
+                self.arena_geometry = await tasks.run_on_chain(
+                    scenery.load_geometry, arena, root
+                )
+            for name in names:
+                character = await tasks.run_on_chain(pack.load_character, name)
+                self.available_characters.append(character)
+                self.character_menu.set_ready(name, character)
+                self.fighter_menu.set_ready(name, character)
+            # Maps depend on the characters they were measured against.
+            self.hit_maps = hitmaps.HitMaps()
+            for name in names:
+                maps = await tasks.run_on_chain(hitmaps.load_character_maps, pack, name)
+                self.hit_maps.maps.update(maps)
+        self.freeze_pending = True
+        if not self.in_battle:
+            self.freeze_content()
+        elapsed = time.perf_counter() - start
+        _logger.info(f'Loaded {len(names)} characters in {elapsed * 1000:.0f}ms')
+
+    def freeze_content(self) -> None:
+        """Freeze the loaded content if that's still to be done. Content
+        lasts as long as the game, so collections needn't look at it, but
+        nothing belonging to a battle may be frozen along with it.
+        """
+        if self.freeze_pending:
+            frames.freeze()
+            self.freeze_pending = False
+
     def enter_main_menu(self) -> None:
         self.character_menu.hide()
         self.fighter_menu.hide()
@@ -80,56 +191,71 @@ class App:
 
     def select_character(self, character: Character) -> None:
         self.selected_characters.append(character)
-        if len(self.selected_characters) > 1:
+        if len(self.selected_characters) >= self.fighter_count:
             self.enter_battle(*self.selected_characters)
             self.selected_characters.clear()
 
-    def enter_battle(self, character_1: Character, character_2: Character) -> None:
+    def enter_battle(self, *characters: Character) -> None:
+        # Content that finished loading during the last battle can be
+        # frozen now that nothing is left of it.
+        self.freeze_content()
+        self.in_battle = True
         self.main_menu.hide()
         self.character_menu.hide()
         self.fighter_menu.hide()
-        if character_2.speed > character_1.speed:
-            character_1, character_2 = character_2, character_1
-        _logger.info(f'Starting battle with {character_1} and {character_2}')
+        # The fastest fighter goes first, in front of the camera.
+        characters = tuple(sorted(characters, key=lambda c: -c.speed))
+        _logger.info(f'Starting battle with {", ".join(map(str, characters))}')
+        teams = None
+        if self.team_count is not None:
+            # Teammates start next to each other.
+            count = len(characters)
+            teams = [i * self.team_count // count for i in range(count)]
         self.set_camera_pos(r=10, theta=1.2 * math.pi, height=3)
         root = self.base.render.attach_new_node('Arena Root')
-        world = physics.make_world(gravity=GRAVITY)
-        arena = arenas.Arena(root, world)
+        world = physics.make_world(gravity=physics.GRAVITY)
+        arena = arenas.Arena(root, world, geometry=self.arena_geometry)
+        _logger.info(f'Battle seed: {arena.rng.seed}')
+        fighters = battles.make_fighters(*characters, teams=teams)
 
-        fighter_1 = character_1.make_fighter(
-            xform=spatial.make_rigid_transform(translation=Vec3(-0.5, 0, 0))
-        )
-        fighter_2 = character_2.make_fighter(
-            xform=spatial.make_rigid_transform(
-                rotation=spatial.make_rotation(math.pi, Vec3.unit_z()),
-                translation=Vec3(0.5, 0, 0),
-            )
-        )
-        if fighter_1.name == fighter_2.name:
-            fighter_1.name += ' (1)'
-            fighter_2.name += ' (2)'
-        fighter_1.set_stance(stances.BOXING_STANCE)
-        fighter_2.set_stance(stances.BOXING_STANCE)
+        arena.start(task_chain=self.physics_chain)
+        tasks.add_task(self.do_battle(arena, fighters))
 
-        tasks.add_task(arena.update())
-        tasks.add_task(self.do_battle(arena, fighter_1, fighter_2))
+    def enter_network_battle(
+        self, session: netplay.LockstepSession, pack: content.ContentPack
+    ) -> None:
+        """Start a lockstep battle with a peer."""
+        self.freeze_content()
+        self.in_battle = True
+        self.main_menu.hide()
+        self.character_menu.hide()
+        self.fighter_menu.hide()
+        _logger.info(f'Starting a network battle with seed {session.seed}')
+        self.set_camera_pos(r=10, theta=1.2 * math.pi, height=3)
+        root = self.base.render.attach_new_node('Arena Root')
+        world = physics.make_world(gravity=physics.GRAVITY)
+        # Peers step their arenas in lockstep, which needs the main thread.
+        arena = arenas.Arena(root, world, rng=RandomStreams(session.seed))
+        session.arena = arena
+        fighters = session.make_fighters(pack)
+        arena.start()
+        tasks.add_task(self.do_battle(arena, fighters, session=session))
 
     def set_camera_pos(self, *, r: float, theta: float, height: float) -> None:
         self.base.cam.set_pos(r * math.cos(theta), r * math.sin(theta), height)
         self.base.cam.look_at(0, 0, 0)
 
     async def move_camera(self, to_angle: float, *, time: float = 1) -> None:
-        clock = ClockObject.get_global_clock()
-        start_time = clock.frame_time
         x, y, height = self.base.cam.get_pos()
         from_angle = math.atan2(y, x)
         r = math.hypot(x, y)
-        speed = (to_angle - from_angle) / time
-        while (dt := clock.frame_time - start_time) < time:
-            current_angle = from_angle + speed * dt
+
+        def update(fraction: float) -> None:
+            current_angle = from_angle + (to_angle - from_angle) * fraction
             self.set_camera_pos(r=r, theta=current_angle, height=height)
-            await AsyncTaskPause(0)
-        self.set_camera_pos(r=r, theta=to_angle, height=height)
+
+        with self.render_scheduler.keep_active():
+            await self.presentation.play(time, update)
 
     async def draw(self, menu: SupportsDraw) -> None:
         assert isinstance(self.base.win, GraphicsWindow)
@@ -143,44 +269,149 @@ class App:
             await AsyncTaskPause(0)
 
     async def do_battle(
-        self, arena: arenas.Arena, fighter_1: Fighter, fighter_2: Fighter
+        self,
+        arena: arenas.Arena,
+        fighters: Sequence[Fighter],
+        providers: Sequence[ActionProvider | None] | None = None,
+        *,
+        session: netplay.LockstepSession | None = None,
     ) -> None:
-        fighter_1.enter_arena(arena)
-        fighter_2.enter_arena(arena)
+        """Run a battle between the fighters. Each fighter's moves are
+        chosen by the corresponding provider, or through the battle menu
+        if that provider is `None` or not given.
+
+        In a network battle, the moves of the peer's fighter come from
+        the `session` instead.
+        """
+        self.render_scheduler.activity_checks.append(arena.is_awake)
+        battle_menu = ui.BattleMenu.from_fighters(*fighters)
+        try:
+            await self.fight(arena, fighters, battle_menu, providers, session=session)
+        finally:
+            # The arena is torn down however the battle ends.
+            self.drawing = False
+            battle_menu.destroy()
+            # Stop the world before taking fighters out of it, since it may
+            # be stepped on another thread.
+            arena.stop()
+            for fighter in fighters:
+                fighter.exit_arena()
+            self.render_scheduler.activity_checks.remove(arena.is_awake)
+            arena.exit()
+            self.in_battle = False
+        _logger.info(self.frame_budget.report())
+        self.enter_main_menu()
+
+    async def fight(
+        self,
+        arena: arenas.Arena,
+        fighters: Sequence[Fighter],
+        battle_menu: ui.BattleMenu,
+        providers: Sequence[ActionProvider | None] | None = None,
+        *,
+        session: netplay.LockstepSession | None = None,
+    ) -> None:
+        """Run the battle of `do_battle` up to the end of the pause after
+        its result.
+        """
+        for fighter in fighters:
+            fighter.enter_arena(arena)
+        broadcaster: spectate.Broadcaster | None = None
+        if self.broadcast_port is not None:
+            broadcaster = spectate.Broadcaster.listen(
+                arena, fighters, port=self.broadcast_port, rate=self.broadcast_rate
+            )
+            broadcaster.start()
         self.drawing = True
-        battle_menu = ui.BattleMenu.from_fighters(fighter_1, fighter_2)
-        tasks.add_task(self.draw(battle_menu))
-        fighters = (fighter_1, fighter_2)
-        interfaces = tuple(battle_menu.interfaces)
-        for i in itertools.cycle(range(2)):
-            interface = interfaces[i]
-            fighter = fighters[i]
-            opponent = fighters[1 - i]
-            move, target = await interface.query_action()
-            interface.hide()
-            if target is moves.Target.SELF:
-                await fighter.use_move(move, fighter)
-            elif target is moves.Target.OTHER:
-                await fighter.use_move(move, opponent)
-            opponent.apply_current_effects()
-            if opponent.health <= 0:
-                _logger.info(f'{fighter} won the battle')
-                battle_menu.output_info(f'{fighter.name} wins!')
-                break
+        interfaces = list(battle_menu.interfaces)
+
+        def select_target(fighter: Fighter, opponents: Sequence[Fighter]) -> Fighter:
+            # Use the opponent picked in the menu if it's still standing.
+            for other, interface in zip(fighters, interfaces):
+                focus = interface.focus
+                if other is fighter and any(focus is o for o in opponents):
+                    assert focus is not None
+                    return focus
+            return battles.nearest_opponent(fighter, opponents)
+
+        def estimate(fighter: Fighter, action: Action) -> tuple[float, float] | None:
+            assert self.hit_maps is not None
+            opponents = battles.opponents_of(fighter, fighters)
+            if not opponents:
+                return None
+            opponent = select_target(fighter, opponents)
+            return self.hit_maps.estimate(fighter, opponent, action)
+
+        if self.hit_maps is not None:
+            for interface, fighter in zip(interfaces, fighters):
+                interface.estimate = functools.partial(estimate, fighter)
+        arena.task_group.add(self.draw(battle_menu))
+        order = battles.turn_order(fighters)
+
+        async def between_turns(i: int) -> None:
+            self.frame_budget.collect_idle()
+            if session is not None:
+                await session.between_turns(i)
+            await self.presentation.play(0.5)
+            # Look over the shoulder of whoever goes next.
+            next_fighter = fighters[battles.next_turn(fighters, order, i)]
+            x, y, _ = next_fighter.get_position()
+            await self.move_camera(math.atan2(y, x) + 0.2 * math.pi)
+
+        async def between_actions(i: int) -> None:
+            self.frame_budget.collect_idle()
+            await self.presentation.play(0.5)
+
+        if providers is None:
+            providers = [None] * len(fighters)
+        turn_providers: list[ActionProvider] = [
+            interface if provider is None else provider
+            for provider, interface in zip(providers, interfaces)
+        ]
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(self.frame_budget.battle())
+            if session is not None:
+                turn_providers = session.wrap_providers(turn_providers)
+                # The frame rate must not change while in lockstep.
+                stack.enter_context(self.render_scheduler.keep_active())
+                stack.enter_context(session.fixed_rate_clock())
+                # The world keeps stepping through pauses, so peers have
+                # to pause for just as long as each other.
+                stack.enter_context(self.presentation.fixed())
+            turn_providers = [
+                frames.IdleProvider(provider, self.frame_budget)
+                for provider in turn_providers
+            ]
+            # Lockstep peers would have to agree on the mode, so battles
+            # over the network always take turns.
+            if self.simultaneous and session is None:
+                winner = await battles.run_at_once(
+                    fighters,
+                    turn_providers,
+                    between_actions=between_actions,
+                    select_target=select_target,
+                )
             else:
-                await AsyncTaskPause(0.5)
-                await self.move_camera((1.2 if i else 0.2) * math.pi)
-        await AsyncTaskPause(5)
-        self.drawing = False
-        battle_menu.destroy()
-        fighter_1.exit_arena()
-        fighter_2.exit_arena()
-        arena.exit()
-        self.enter_main_menu()
+                winner = await battles.run_turns(
+                    fighters,
+                    turn_providers,
+                    between_turns=between_turns,
+                    select_target=select_target,
+                )
+            if session is not None:
+                await session.check_sync()
+                session.connection.close()
+        if winner is None:
+            result = 'The battle is a draw!'
+        else:
+            result = f'{winner.name} wins!'
+        battle_menu.output_info(result)
+        if broadcaster is not None:
+            arena.task_group.add(broadcaster.finish(result))
+        await self.presentation.play(5)
 
 
-def main() -> None:
-    """Run an instance of the app."""
+def setup_logging() -> None:
     logger = logging.getLogger('joat')
     logger.setLevel(logging.DEBUG)
     file_handler = logging.FileHandler('log.log', mode='w')
@@ -192,15 +423,117 @@ def main() -> None:
     stream_handler.setLevel(logging.WARNING)
     logger.addHandler(file_handler)
     logger.addHandler(stream_handler)
-    move_dict: dict[str, Action] = {}
-    characters: list[Character] = []
-    for fp in Path('data', 'moves').iterdir():
-        j = json.loads(fp.read_text())
-        move = moves.make_move_from_json(j)
-        move_dict[fp.stem] = move
-    for fp in Path('data', 'characters').iterdir():
-        j = json.loads(fp.read_text())
-        character = Character.from_json(j, move_dict=move_dict)
-        characters.append(character)
-    app = App(available_characters=characters)
+
+
+def play(args: argparse.Namespace) -> None:
+    """Run an instance of the app."""
+    setup_logging()
+    app = App(
+        broadcast_port=args.broadcast,
+        broadcast_rate=args.broadcast_rate,
+        fighter_count=args.fighters,
+        team_count=args.teams,
+        simultaneous=args.simultaneous,
+        pace=presentation.Pace[args.pace.upper()],
+        threaded_physics=args.threaded_physics,
+    )
+    tasks.add_task(app.load_content(arena=args.arena))
     app.run()
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog='joat')
+    parser.set_defaults(
+        command=play,
+        arena=None,
+        broadcast=None,
+        broadcast_rate=20,
+        fighters=2,
+        teams=None,
+        simultaneous=False,
+        pace='normal',
+        threaded_physics=False,
+    )
+    subparsers = parser.add_subparsers()
+    play_parser = subparsers.add_parser('play', help='play the game (the default)')
+    play_parser.add_argument(
+        '--arena',
+        choices=scenery.available_arenas(),
+        help='fight in an arena from data/arenas instead of on an open plane',
+    )
+    play_parser.add_argument(
+        '--broadcast',
+        type=int,
+        nargs='?',
+        const=spectate.DEFAULT_PORT,
+        metavar='PORT',
+        help='broadcast battles to spectators',
+    )
+    play_parser.add_argument(
+        '--broadcast-rate', type=float, default=20, help='frames per second'
+    )
+    play_parser.add_argument(
+        '--fighters',
+        type=int,
+        default=2,
+        choices=range(2, physics.QUERY_GROUP),
+        metavar='N',
+        help='how many fighters battle at once',
+    )
+    play_parser.add_argument(
+        '--teams',
+        type=int,
+        choices=range(2, physics.QUERY_GROUP),
+        metavar='N',
+        help='split the fighters into teams instead of having a free-for-all',
+    )
+    play_parser.add_argument(
+        '--simultaneous',
+        action='store_true',
+        help='have fighters act at the same time instead of taking turns',
+    )
+    play_parser.add_argument(
+        '--pace',
+        choices=[pace.name.lower() for pace in presentation.Pace],
+        default='normal',
+        help='how fast pauses and camera moves go by (F2 cycles through them)',
+    )
+    play_parser.add_argument(
+        '--threaded-physics',
+        action='store_true',
+        help='step physics on a thread of its own at a fixed rate',
+    )
+    balance.add_arguments(
+        subparsers.add_parser('balance', help='compute a win-rate matrix')
+    )
+    netplay.add_arguments(
+        subparsers.add_parser('netplay', help='battle a peer over the network')
+    )
+    hitmaps.add_arguments(
+        subparsers.add_parser('hitmaps', help='precompute hit chances of moves')
+    )
+    surrogate.add_arguments(
+        subparsers.add_parser('surrogate', help='model battles without physics')
+    )
+    tuning.add_arguments(
+        subparsers.add_parser('tune', help='tune the parameters of a character')
+    )
+    service.add_arguments(
+        subparsers.add_parser('serve', help='run battles requested over a socket')
+    )
+    spectate.add_arguments(
+        subparsers.add_parser('spectate', help='watch a broadcast battle')
+    )
+    client.add_arguments(
+        subparsers.add_parser('load-test', help='submit battles to a running server')
+    )
+    benchmark.add_arguments(
+        subparsers.add_parser(
+            'benchmark', help='measure how frame cost grows with the fighter count'
+        )
+    )
+    soak.add_arguments(
+        subparsers.add_parser('soak', help='check for memory growth over many battles')
+    )
+    args = parser.parse_args(argv)
+    args.command(args)
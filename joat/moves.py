@@ -2,11 +2,14 @@ from __future__ import annotations
 
 import enum
 import logging
+import math
 from collections.abc import Container
 from typing import Any, Final
+from typing_extensions import Self
 
 import attrs
-from panda3d.core import AsyncTaskPause, CollideMask, EventHandler
+from panda3d import bullet
+from panda3d.core import EventHandler, NodePath, TransformState, Vec3
 
 from . import physics
 from .characters import Action, Fighter
@@ -15,6 +18,11 @@ from .skeletons import Side
 
 _logger: Final = logging.getLogger(__name__)
 
+# The longest a punch can take, in simulated seconds
+SWING_TIMEOUT: Final = 1
+# How far a projectile travels before it can hit anything
+PROJECTILE_CLEARANCE: Final = 0.5
+
 
 class Target(enum.Enum):
     SELF = 'self'
@@ -26,6 +34,19 @@ class MoveType(enum.Enum):
     RANGED = 'ranged'
     INSTANT = 'instant'
     REPOSITIONING = 'repositioning'
+    AREA = 'area'
+
+
+class Origin(enum.Enum):
+    """Where the area of an area move starts."""
+
+    USER = 'user'
+    TARGET = 'target'
+
+
+def wind_up_time(user: Fighter) -> float:
+    """Return the longest the user takes to wind up a throw."""
+    return 1 / (1 + user.speed) / 8
 
 
 @attrs.define
@@ -54,9 +75,10 @@ class MeleeMove:
         arm = user.skeleton.get_arm(self.side)
         fist = arm.forearm.node()
         fist.python_tags['one_shot_effect'] = self.effect
-        arm.set_target(target - arm.origin)
-        await AsyncTaskPause(1 / (1 + user.speed))
-        user.skeleton.assume_stance()
+        motion = await user.skeleton.swing(
+            self.side, target - arm.origin, timeout=SWING_TIMEOUT
+        )
+        _logger.debug(f'{user} ended {self.name} with {motion}')
         fist.python_tags.pop('one_shot_effect', None)
 
 
@@ -73,18 +95,21 @@ class RangedMove:
         target_part = using_on.skeleton.parts[self.target_part]
         target = user.get_position_of(target_part, (1 - self.accuracy / 100))
         assert user.arena is not None
-        root = user.arena.root
+        arena = user.arena
         if self.side is None:
             using_part = user.skeleton.parts['head']
-            from_position = using_part.get_pos(root)
+            from_position = arena.get_transform(using_part).get_pos()
         else:
             arm = user.skeleton.get_arm(self.side)
             using_part = arm.forearm
-            from_position = root.get_relative_point(using_part, (0, -0.25, 0))
-            arm.set_target(target - arm.origin)
-            await AsyncTaskPause(1 / (1 + user.speed) / 8)
-            user.skeleton.assume_stance()
-        global_target_position = root.get_relative_point(user.skeleton.core, target)
+            from_position = (
+                arena.get_transform(using_part).get_mat().xform_point(Vec3(0, -0.25, 0))
+            )
+            await user.skeleton.swing(
+                self.side, target - arm.origin, timeout=wind_up_time(user)
+            )
+        core = arena.get_transform(user.skeleton.core)
+        global_target_position = core.get_mat().xform_point(target)
         projectile = physics.spawn_projectile(
             name=self.name,
             arena=user.arena,
@@ -93,12 +118,121 @@ class RangedMove:
                 global_target_position - from_position,
                 user.strength * 4,
             ),
-            collision_mask=~using_part.get_collide_mask(),
+            # Join the user's group so as to miss their teammates.
+            collision_mask=using_part.get_collide_mask(),
+            clearance=PROJECTILE_CLEARANCE,
+        )
+        projectile.body.node().python_tags.update(
+            one_shot_effect=self.effect, min_impulse=1
         )
-        projectile.node().python_tags.update(one_shot_effect=self.effect, min_impulse=1)
-        await AsyncTaskPause(0.2 / user.strength)
-        if not projectile.is_empty():
-            projectile.set_collide_mask(CollideMask.all_on())
+        landing = await projectile.landing
+        _logger.debug(f'{self.name} from {user} ended with {landing}')
+
+
+@attrs.frozen
+class Area:
+    """The region covered by an area move, which starts at the origin of
+    the move and extends along the +Y axis, towards where it's aimed.
+    """
+
+    shape: bullet.BulletShape
+    transform: TransformState
+    # How far the furthest point of the area is from its start
+    reach: float
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> Self:
+        kind = data['shape']
+        if kind == 'sphere':
+            radius = data['radius']
+            return cls(
+                bullet.BulletSphereShape(radius),
+                TransformState.make_identity(),
+                radius,
+            )
+        if kind == 'cone':
+            radius = data['radius']
+            length = data['length']
+            # Bullet's cones are centred on their axis and point up it.
+            return cls(
+                bullet.BulletConeShape(radius, length, bullet.Y_up),
+                TransformState.make_pos_hpr(Vec3(0, length / 2, 0), Vec3(180, 0, 0)),
+                math.hypot(radius, length),
+            )
+        if kind == 'box':
+            half_extents = Vec3(*data['half_extents'])
+            return cls(
+                bullet.BulletBoxShape(half_extents),
+                TransformState.make_pos(Vec3(0, half_extents.y, 0)),
+                Vec3(half_extents.x, 2 * half_extents.y, half_extents.z).length(),
+            )
+        raise ValueError(f'Unknown area shape {kind!r}')
+
+
+@attrs.define(kw_only=True)
+class AreaMove:
+    """A move that hits every opponent in an area at once, dealing less
+    damage the further they are from where the area starts.
+    """
+
+    name: str
+    area: Area
+    origin: Origin = Origin.TARGET
+    damage: int = 0
+    # The fraction of the damage lost at the edge of the area
+    falloff: float = 1
+    accuracy: int = 100
+    effect: Effect | None = None
+    side: Side | None = None
+    valid_targets: Container[Target] = frozenset()
+    target_part: str = 'torso'
+
+    async def use(self, user: Fighter, using_on: Fighter) -> None:
+        target_part = using_on.skeleton.parts[self.target_part]
+        target = user.get_position_of(target_part, (1 - self.accuracy / 100))
+        assert user.arena is not None
+        root = user.arena.root
+        if self.side is not None:
+            arm = user.skeleton.get_arm(self.side)
+            await user.skeleton.swing(
+                self.side, target - arm.origin, timeout=wind_up_time(user)
+            )
+        core = user.arena.get_transform(user.skeleton.core)
+        if using_on is user:
+            target = Vec3.unit_x()
+        global_target = core.get_mat().xform_point(target)
+        user_position = core.get_pos()
+        if self.origin is Origin.USER:
+            start = user_position
+        else:
+            start = global_target
+        ghost = root.attach_new_node(bullet.BulletGhostNode(self.name))
+        ghost.node().add_shape(self.area.shape, self.area.transform)
+        ghost.set_pos(start)
+        ghost.look_at(start + global_target - user_position)
+        try:
+            with user.arena.world_lock:
+                touching = physics.find_touching(user.arena.world, ghost)
+        finally:
+            ghost.remove_node()
+        # Each fighter is hit once, as far away as their nearest part.
+        distances: dict[str, tuple[float, Fighter]] = {}
+        for node in touching:
+            fighter: Fighter | None = node.python_tags.get('fighter')
+            if fighter is None or user.is_ally(fighter):
+                continue
+            part = user.arena.get_transform(NodePath.any_path(node))
+            distance = (part.get_pos() - start).length()
+            if fighter.name not in distances or distance < distances[fighter.name][0]:
+                distances[fighter.name] = distance, fighter
+        for distance, fighter in sorted(distances.values(), key=lambda x: x[0]):
+            fraction = min(distance / self.area.reach, 1)
+            damage = round(self.damage * (1 - self.falloff * fraction))
+            _logger.debug(f'{self.name} hit {fighter} at a distance of {distance}')
+            if damage:
+                fighter.apply_damage(damage)
+            if self.effect is not None:
+                self.effect.apply(fighter)
 
 
 @attrs.define
@@ -115,14 +249,15 @@ class RepositioningMove:
             if result.node == user.arena.ground.node():
                 target = result.hit_pos.xy
                 break
-        displacement = target - user.skeleton.core.get_pos().xy
+        displacement = target - user.get_position().xy
         if displacement.length_squared() > user.speed**2:
             target -= displacement
             displacement.normalize()
             displacement *= user.speed
             target += displacement
         ring_path.remove_node()
-        await user.skeleton.slide_to(target)
+        outcome = await user.skeleton.slide_to(user.arena, target)
+        _logger.debug(f'{user} ended {self.name} with {outcome}')
 
 
 def make_move_from_json(data: dict[str, Any]) -> Action:
@@ -153,6 +288,16 @@ def make_move_from_json(data: dict[str, Any]) -> Action:
         return RangedMove(
             name=name, effect=effect, side=side, valid_targets=valid_targets, **data
         )
+    elif move_type is MoveType.AREA:
+        return AreaMove(
+            name=name,
+            area=Area.from_json(data.pop('area')),
+            origin=Origin(data.pop('origin', 'target')),
+            effect=effect,
+            side=side,
+            valid_targets=valid_targets,
+            **data,
+        )
     elif move_type is MoveType.REPOSITIONING:
         return RepositioningMove(name, valid_targets)
     else:
@@ -0,0 +1,411 @@
+from __future__ import annotations
+
+import argparse
+import contextlib
+import hashlib
+import json
+import logging
+import secrets
+import select
+import socket
+import time
+from collections.abc import Awaitable, Callable, Iterator, Sequence
+from pathlib import Path
+from typing import Any, Final
+from typing_extensions import Self
+
+import attrs
+from attrs import field
+from panda3d.core import AsyncTaskPause, ClockObject
+
+from . import arenas, battles, content, frames, headless, moves
+from .characters import Action, Fighter
+from .providers import ActionProvider, RandomProvider
+
+_logger: Final = logging.getLogger(__name__)
+
+DEFAULT_PORT: Final = 7777
+PROTOCOL_VERSION: Final = 1
+
+Message = dict[str, Any]
+
+
+class DesyncError(RuntimeError):
+    pass
+
+
+@attrs.define
+class Connection:
+    """Newline-delimited JSON messages over a TCP socket, received by
+    polling so that waiting never blocks the task manager.
+    """
+
+    sock: socket.socket
+    timeout: float = 60
+    closed: bool = field(default=False, init=False)
+    _buffer: bytes = field(default=b'', init=False, repr=False)
+    _inbox: list[Message] = field(factory=list, init=False, repr=False)
+
+    def __attrs_post_init__(self) -> None:
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Sends block for at most this long; receives are polled.
+        self.sock.settimeout(self.timeout)
+
+    @classmethod
+    async def accept(cls, host: str = '', port: int = DEFAULT_PORT) -> Self:
+        """Wait for a peer to connect on the given port."""
+        with socket.create_server((host, port)) as listener:
+            _logger.info(f'Waiting for a peer on port {port}')
+            while not select.select([listener], [], [], 0)[0]:
+                await AsyncTaskPause(0.05)
+            sock, address = listener.accept()
+        _logger.info(f'Connected to {address}')
+        return cls(sock)
+
+    @classmethod
+    def connect(cls, host: str, port: int = DEFAULT_PORT) -> Self:
+        return cls(socket.create_connection((host, port), timeout=10))
+
+    def send(self, kind: str, **contents: Any) -> None:
+        message = json.dumps({'kind': kind, **contents}, separators=(',', ':'))
+        self.sock.sendall(message.encode() + b'\n')
+
+    def poll(self) -> None:
+        """Read any messages that have arrived without blocking."""
+        while not self.closed and select.select([self.sock], [], [], 0)[0]:
+            data = self.sock.recv(4096)
+            if not data:
+                self.closed = True
+                break
+            self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        self._inbox += [json.loads(line) for line in lines]
+
+    async def receive(self, kind: str) -> Message:
+        """Wait for the next message of the given kind. Messages of other
+        kinds are kept until they are asked for.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            self.poll()
+            for i, message in enumerate(self._inbox):
+                if message['kind'] == kind:
+                    return self._inbox.pop(i)
+            if self.closed:
+                raise ConnectionError('The peer disconnected')
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'Timed out waiting for a {kind!r} message')
+            await AsyncTaskPause(0)
+
+    def close(self) -> None:
+        self.closed = True
+        self.sock.close()
+
+
+def state_checksum(fighters: Sequence[Fighter]) -> str:
+    """Return a digest of the parts of the battle's state that peers need
+    to agree on. Positions are rounded to the millimetre, so that only
+    real divergence is reported.
+    """
+    digest = hashlib.sha256()
+    for fighter in fighters:
+        digest.update(f'{fighter.name}:{fighter.health};'.encode())
+        for effect in fighter.status_effects:
+            digest.update(f'{effect!r};'.encode())
+        assert fighter.arena is not None
+        for name, part in sorted(fighter.skeleton.parts.items()):
+            x, y, z = fighter.arena.get_transform(part).get_pos()
+            digest.update(f'{name}:{x:.3f},{y:.3f},{z:.3f};'.encode())
+    return digest.hexdigest()
+
+
+@attrs.define
+class LockstepSession:
+    """A battle kept in sync between two peers by exchanging only the
+    choices of each player, after agreeing on the content and the seed.
+
+    The arena is paused whenever a peer waits for a choice, and stepped
+    exactly once per frame of a fixed-rate clock otherwise, so that both
+    peers run the same steps between the same inputs. A checksum of the
+    battle's state is compared after every turn.
+    """
+
+    connection: Connection
+    seed: int
+    # The names of the characters, with the host's first
+    names: tuple[str, str]
+    # 0 for the host, 1 for the guest
+    player: int
+    arena: arenas.Arena | None = field(default=None, init=False)
+    # The fighters in turn order, and the players they belong to
+    fighters: Sequence[Fighter] = field(default=(), init=False)
+    players: tuple[int, int] = field(default=(0, 1), init=False)
+    turn: int = field(default=0, init=False)
+
+    @classmethod
+    async def host(
+        cls,
+        connection: Connection,
+        pack: content.ContentPack,
+        names: tuple[str, str],
+        *,
+        seed: int | None = None,
+    ) -> Self:
+        if seed is None:
+            seed = secrets.randbits(63)
+        connection.send(
+            'hello',
+            version=PROTOCOL_VERSION,
+            seed=seed,
+            names=names,
+            content_hash=_content_hash(pack, names),
+        )
+        reply = await connection.receive('ready')
+        if not reply['ok']:
+            raise ConnectionError(f'The guest refused the battle: {reply["reason"]}')
+        return cls(connection, seed, names, 0)
+
+    @classmethod
+    async def join(cls, connection: Connection, pack: content.ContentPack) -> Self:
+        hello = await connection.receive('hello')
+        names = hello['names'][0], hello['names'][1]
+        reason = None
+        if hello['version'] != PROTOCOL_VERSION:
+            reason = f'protocol version {hello["version"]} is not supported'
+        elif not all(name in pack.characters for name in names):
+            reason = f'unknown characters {names}'
+        elif hello['content_hash'] != _content_hash(pack, names):
+            reason = 'the content of the characters differs'
+        connection.send('ready', ok=reason is None, reason=reason)
+        if reason is not None:
+            raise ConnectionError(f'Refused the battle: {reason}')
+        return cls(connection, hello['seed'], names, 1)
+
+    def make_fighters(self, pack: content.ContentPack) -> tuple[Fighter, Fighter]:
+        """Return the fighters in turn order, remembering which player
+        each of them belongs to.
+        """
+        characters = [pack.characters[name] for name in self.names]
+        players = [0, 1]
+        if characters[1].speed > characters[0].speed:
+            players.reverse()
+        self.players = players[0], players[1]
+        self.fighters = battles.make_fighters(*(characters[p] for p in players))
+        return self.fighters
+
+    def wrap_providers(
+        self, providers: Sequence[ActionProvider]
+    ) -> list[ActionProvider]:
+        """Send the choices of the local player's provider to the peer,
+        and replace the other provider with the peer's choices.
+        """
+        return [
+            _SendingProvider(self, provider)
+            if player == self.player
+            else _ReceivingProvider(self, fighter)
+            for fighter, player, provider in zip(self.fighters, self.players, providers)
+        ]
+
+    @contextlib.contextmanager
+    def paused(self) -> Iterator[None]:
+        assert self.arena is not None
+        self.arena.paused = True
+        try:
+            yield
+        finally:
+            self.arena.paused = False
+
+    async def check_sync(self) -> None:
+        """Compare the state of the battle with the peer's."""
+        checksum = state_checksum(self.fighters)
+        self.connection.send('checksum', turn=self.turn, value=checksum)
+        with self.paused():
+            message = await self.connection.receive('checksum')
+        if message['turn'] != self.turn or message['value'] != checksum:
+            raise DesyncError(f'The battle went out of sync on turn {self.turn}')
+        self.turn += 1
+
+    async def between_turns(self, i: int) -> None:
+        await self.check_sync()
+
+    @contextlib.contextmanager
+    def fixed_rate_clock(self) -> Iterator[None]:
+        """Advance the clock by exactly one step per frame within the
+        context, sleeping to keep to real time, so that waits in moves
+        take the same number of steps for both peers.
+        """
+        assert self.arena is not None
+        clock = ClockObject.get_global_clock()
+        previous_mode = clock.mode
+        previous_rate = clock.frame_rate
+        clock.set_mode(ClockObject.M_forced)
+        clock.set_frame_rate(1 / self.arena.step_size)
+        try:
+            yield
+        finally:
+            clock.set_mode(previous_mode)
+            clock.set_frame_rate(previous_rate)
+
+
+@attrs.define
+class _SendingProvider:
+    session: LockstepSession
+    provider: ActionProvider
+
+    async def query_action(self) -> tuple[Action, moves.Target]:
+        with self.session.paused():
+            action, target = await self.provider.query_action()
+        self.session.connection.send(
+            'action', turn=self.session.turn, move=action.name, target=target.value
+        )
+        return action, target
+
+
+@attrs.define
+class _ReceivingProvider:
+    session: LockstepSession
+    fighter: Fighter
+
+    async def query_action(self) -> tuple[Action, moves.Target]:
+        with self.session.paused():
+            message = await self.session.connection.receive('action')
+        if message['turn'] != self.session.turn:
+            raise DesyncError(
+                f'Expected an action for turn {self.session.turn},'
+                f' got one for turn {message["turn"]}'
+            )
+        move_dict = {move.name: move for move in self.fighter.moves}
+        return move_dict[message['move']], moves.Target(message['target'])
+
+
+def _content_hash(pack: content.ContentPack, names: Sequence[str]) -> str:
+    return content.hash_bytes(*(pack.character_hash(name).encode() for name in names))
+
+
+async def _bot_battle(
+    session: LockstepSession, pack: content.ContentPack, arena: arenas.Arena
+) -> Fighter | None:
+    session.arena = arena
+    fighters = session.make_fighters(pack)
+    for fighter in fighters:
+        fighter.enter_arena(arena)
+    bots = [
+        RandomProvider.for_fighter(fighter, arena.rng.stream(f'player {player}'))
+        for fighter, player in zip(fighters, session.players)
+    ]
+    try:
+        winner = await battles.run_turns(
+            fighters,
+            session.wrap_providers(bots),
+            between_turns=session.between_turns,
+            max_turns=100,
+        )
+        await session.check_sync()
+    finally:
+        for fighter in fighters:
+            fighter.exit_arena()
+    return winner
+
+
+def run_bot_battle(session: LockstepSession, pack: content.ContentPack) -> str:
+    """Play a lockstep battle headlessly with a bot choosing the local
+    player's moves, and return a description of the outcome.
+    """
+    arena = headless.make_arena(seed=session.seed)
+    outcome: list[Fighter | None] = []
+
+    async def battle() -> None:
+        outcome.append(await _bot_battle(session, pack, arena))
+
+    try:
+        headless.simulate(arena, battle(), max_time=600)
+    finally:
+        arena.exit()
+    if not outcome:
+        return 'The battle timed out'
+    winner = outcome[0]
+    if winner is None:
+        return f'The battle was a draw after {session.turn} turns'
+    return f'{winner} won after {session.turn} turns'
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    subparsers = parser.add_subparsers(required=True)
+    host_parser = subparsers.add_parser('host', help='wait for a peer to join')
+    host_parser.set_defaults(command=host)
+    host_parser.add_argument('character', help='the character to play as')
+    host_parser.add_argument('opponent', help="the peer's character")
+    host_parser.add_argument('--seed', type=int)
+    join_parser = subparsers.add_parser('join', help='join a waiting peer')
+    join_parser.set_defaults(command=join)
+    join_parser.add_argument('address', nargs='?', default='127.0.0.1')
+    for subparser in (host_parser, join_parser):
+        subparser.add_argument('--port', type=int, default=DEFAULT_PORT)
+        subparser.add_argument(
+            '--bot',
+            action='store_true',
+            help='let a bot play without a window, e.g. for testing',
+        )
+        subparser.add_argument('--data-dir', type=Path, default=content.DATA_DIR)
+
+
+def _start(
+    args: argparse.Namespace,
+    make_session: Callable[[content.ContentPack], Awaitable[LockstepSession]],
+) -> None:
+    from . import main, tasks
+
+    logging.basicConfig(level=logging.INFO)
+    pack = content.ContentPack.load(args.data_dir)
+    frames.freeze()
+    if args.bot:
+        session_holder: list[LockstepSession] = []
+        errors: list[Exception] = []
+
+        async def connect() -> None:
+            try:
+                session_holder.append(await make_session(pack))
+            except Exception as e:
+                errors.append(e)
+
+        task = tasks.add_task(connect())
+        clock = ClockObject.get_global_clock()
+        while not session_holder and not task.done():
+            clock.tick()
+            tasks.TASK_MANAGER.poll()
+            time.sleep(0.01)
+        if not session_holder:
+            error = errors[0] if errors else 'the connection task stopped'
+            raise SystemExit(f'Could not start a session: {error}')
+        session = session_holder[0]
+        try:
+            print(run_bot_battle(session, pack))
+        finally:
+            session.connection.close()
+        return
+    main.setup_logging()
+    app = main.App(available_characters=pack.characters.values())
+
+    async def start() -> None:
+        session = await make_session(pack)
+        app.enter_network_battle(session, pack)
+
+    tasks.add_task(start())
+    app.run()
+
+
+def host(args: argparse.Namespace) -> None:
+    async def make_session(pack: content.ContentPack) -> LockstepSession:
+        connection = await Connection.accept(port=args.port)
+        names = args.character, args.opponent
+        return await LockstepSession.host(connection, pack, names, seed=args.seed)
+
+    _start(args, make_session)
+
+
+def join(args: argparse.Namespace) -> None:
+    async def make_session(pack: content.ContentPack) -> LockstepSession:
+        connection = Connection.connect(args.address, args.port)
+        return await LockstepSession.join(connection, pack)
+
+    _start(args, make_session)
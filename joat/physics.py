@@ -1,12 +1,15 @@
 from __future__ import annotations
 
+import enum
 import logging
 import math
 from typing import Final
 
+import attrs
 from panda3d.bullet import (
     BulletConeTwistConstraint,
     BulletGenericConstraint,
+    BulletGhostNode,
     BulletHingeConstraint,
     BulletPersistentManifold,
     BulletRigidBodyNode,
@@ -15,13 +18,39 @@ from panda3d.bullet import (
     BulletSphereShape,
     BulletWorld,
 )
-from panda3d.core import CollideMask, Mat3, NodePath, PandaNode, VBase3, Vec3
+from panda3d.core import (
+    AsyncFuture,
+    CollideMask,
+    Mat3,
+    NodePath,
+    PandaNode,
+    VBase3,
+    Vec3,
+    load_prc_file_data,
+)
 
 from . import arenas
 from .spatial import make_rigid_transform, required_rotation
 
 _logger: Final = logging.getLogger(__name__)
 
+GRAVITY: Final = Vec3(0, 0, -9.81)
+# Each bit of a body's collide mask puts it in a collision group, and two
+# bodies collide if any of their groups do. Every pair of groups collides
+# in a new world, except that ghosts used for queries in `QUERY_GROUP`
+# skip static geometry in `STATIC_GROUP` and each other. Arenas also stop
+# the groups of teammates from colliding.
+COLLISION_GROUPS: Final = 32
+STATIC_GROUP: Final = 0
+QUERY_GROUP: Final = COLLISION_GROUPS - 1
+
+load_prc_file_data('', 'bullet-filter-algorithm groups-mask')
+
+# Manifold points further apart than this are near each other, not touching
+CONTACT_DISTANCE: Final = 0.01
+# How many simulated seconds a projectile can fly for without landing
+PROJECTILE_LIFETIME: Final = 5
+
 
 def make_body(
     *,
@@ -134,7 +163,7 @@ def required_projectile_velocity(
     delta_position: VBase3,
     speed: float,
     *,
-    gravity: VBase3 = Vec3(0, 0, -9.81),
+    gravity: VBase3 = GRAVITY,
 ) -> Vec3:
     g_squared = gravity.length_squared()
     d_squared = delta_position.length_squared()
@@ -147,6 +176,64 @@ def required_projectile_velocity(
     return Vec3(direction.normalized() * speed)
 
 
+class Landing(enum.Enum):
+    """How the flight of a projectile ended."""
+
+    LANDED = enum.auto()
+    EXPIRED = enum.auto()
+
+
+@attrs.define(eq=False, kw_only=True)
+class Projectile:
+    """A body in flight until it touches something or its time runs out."""
+
+    body: NodePath[BulletRigidBodyNode]
+    arena: arenas.Arena
+    collision_mask: CollideMask
+    # The projectile passes through everything until it's this far from
+    # where it started, so as to get clear of whoever threw it.
+    clearance: float = 0
+    time_left: float
+    landing: AsyncFuture = attrs.field(factory=AsyncFuture, init=False)
+    _start: Vec3 = attrs.field(init=False)
+
+    def __attrs_post_init__(self) -> None:
+        self._start = Vec3(self.body.get_pos())
+        if self.clearance > 0:
+            self.body.set_collide_mask(CollideMask.all_off())
+        else:
+            self.body.set_collide_mask(self.collision_mask)
+
+    def update(self, dt: float) -> None:
+        if self.landing.done():
+            # Other bodies' impact callbacks may still want the tags
+            # until the collisions of the last step are handled.
+            self.body.node().python_tags.clear()
+            self.arena.step_callbacks.remove(self.update)
+            return
+        self.time_left -= dt
+        if self.time_left <= 0:
+            self.finish(Landing.EXPIRED)
+        elif (self.body.get_pos() - self._start).length() >= self.clearance:
+            self.body.set_collide_mask(self.collision_mask)
+
+    def on_impact(self, node: PandaNode, manifold: BulletPersistentManifold) -> None:
+        if is_touching(manifold):
+            self.finish(Landing.LANDED)
+
+    def finish(self, landing: Landing) -> None:
+        if self.landing.done():
+            return
+        self.arena.world.remove(self.body.node())
+        self.arena.untrack(self.body)
+        self.body.detach_node()
+        self.landing.set_result(landing)
+
+
+def is_touching(manifold: BulletPersistentManifold) -> bool:
+    return any(p.distance < CONTACT_DISTANCE for p in manifold.manifold_points)
+
+
 def spawn_projectile(
     *,
     name: str = 'projectile',
@@ -155,29 +242,65 @@ def spawn_projectile(
     velocity: VBase3 = Vec3.zero(),
     arena: arenas.Arena,
     collision_mask: CollideMask | int = CollideMask.all_on(),
-) -> NodePath[BulletRigidBodyNode]:
-    projectile = make_body(
-        name=name,
-        shape=BulletSphereShape(0.1),
-        mass=mass,
-        position=position,
-        parent=arena.root,
-        world=arena.world,
-        collision_mask=collision_mask,
-    )
+    clearance: float = 0,
+    lifetime: float = PROJECTILE_LIFETIME,
+) -> Projectile:
+    # The world may be stepped on another thread.
+    with arena.world_lock:
+        body = make_body(
+            name=name,
+            shape=BulletSphereShape(0.1),
+            mass=mass,
+            position=position,
+            parent=arena.root,
+            world=arena.world,
+        )
+        projectile = Projectile(
+            body=body,
+            arena=arena,
+            collision_mask=CollideMask(collision_mask),
+            clearance=clearance,
+            time_left=lifetime,
+        )
+        node = body.node()
+        node.python_tags['impact_callback'] = projectile.on_impact
+        node.linear_velocity = Vec3(velocity)
+        arena.track(body)
+        arena.step_callbacks.append(projectile.update)
+    return projectile
 
-    def impact_callback(node: PandaNode, manifold: BulletPersistentManifold) -> None:
-        if any(p.distance < 0.01 for p in manifold.manifold_points):
-            arena.world.remove(node)
-            projectile.remove_node()
 
-    projectile_node = projectile.node()
-    projectile_node.python_tags['impact_callback'] = impact_callback
-    projectile_node.linear_velocity = Vec3(velocity)
-    return projectile
+def find_touching(
+    world: BulletWorld, ghost: NodePath[BulletGhostNode]
+) -> set[PandaNode]:
+    """Return the nodes of the dynamic bodies in the world that touch
+    the ghost.
+
+    Candidates come from the world's broadphase, and static geometry is
+    filtered out before testing them in detail, so the cost depends on how
+    many bodies are near the ghost rather than how many there are.
+    """
+    ghost_node = ghost.node()
+    ghost.set_collide_mask(CollideMask.bit(QUERY_GROUP))
+    # The filter needs the ghost to be in the broadphase.
+    world.attach(ghost_node)
+    try:
+        contacts = world.contact_test(ghost_node, True).contacts
+    finally:
+        world.remove(ghost_node)
+    # The points of the contacts can't be used once the test is over.
+    return {
+        contact.node1 if contact.node0 == ghost_node else contact.node0
+        for contact in contacts
+    }
 
 
 def make_world(*, gravity: VBase3) -> BulletWorld:
     world = BulletWorld()
     world.set_gravity(gravity)
+    for i in range(COLLISION_GROUPS):
+        for j in range(i, COLLISION_GROUPS):
+            world.set_group_collision_flag(i, j, True)
+    world.set_group_collision_flag(QUERY_GROUP, STATIC_GROUP, False)
+    world.set_group_collision_flag(QUERY_GROUP, QUERY_GROUP, False)
     return world
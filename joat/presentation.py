@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import contextlib
+import enum
+import math
+from collections.abc import Callable, Iterator
+
+import attrs
+from attrs import field
+from direct.showbase.DirectObject import DirectObject
+from direct.showbase.MessengerGlobal import messenger
+from panda3d.core import AsyncTaskPause, ClockObject
+
+
+class Pace(enum.Enum):
+    """How many times faster than normal cosmetic waits go by."""
+
+    NORMAL = 1
+    FAST = 4
+    INSTANT = math.inf
+
+
+@attrs.define
+class Presentation:
+    """The pace of the cosmetic parts of a battle, like pauses between
+    turns and camera sweeps, which can be changed at any time with a
+    hotkey. The physics of a battle isn't affected.
+    """
+
+    pace: Pace = Pace.NORMAL
+    acceptor: DirectObject = field(factory=DirectObject, kw_only=True)
+    event: str = field(default='f2', kw_only=True)
+    _fixed: Pace | None = field(default=None, init=False, repr=False)
+
+    def __attrs_post_init__(self) -> None:
+        self.acceptor.accept(self.event, self.cycle_pace)
+
+    @property
+    def current_pace(self) -> Pace:
+        return self.pace if self._fixed is None else self._fixed
+
+    def cycle_pace(self) -> None:
+        paces = list(Pace)
+        self.pace = paces[(paces.index(self.pace) + 1) % len(paces)]
+        if self._fixed is None:
+            messenger.send('output_info', [f'Presentation: {self.pace.name.lower()}'])
+
+    @contextlib.contextmanager
+    def fixed(self, pace: Pace = Pace.NORMAL) -> Iterator[None]:
+        """Keep to a pace within the context, whatever the hotkey says."""
+        previous = self._fixed
+        self._fixed = pace
+        try:
+            yield
+        finally:
+            self._fixed = previous
+
+    async def play(
+        self, duration: float, update: Callable[[float], object] | None = None
+    ) -> None:
+        """Spend what would be `duration` seconds at normal pace, calling
+        `update` with the fraction done after every frame, and finally
+        with 1. Changes of pace take effect straight away.
+        """
+        clock = ClockObject.get_global_clock()
+        fraction = 0.0
+        last_time = clock.frame_time
+        while duration > 0 and fraction < 1:
+            speed = self.current_pace.value
+            if speed == math.inf:
+                break
+            await AsyncTaskPause(0)
+            now = clock.frame_time
+            fraction += (now - last_time) * speed / duration
+            last_time = now
+            if update is not None and fraction < 1:
+                update(fraction)
+        if update is not None:
+            update(1)
+
+    def destroy(self) -> None:
+        self.acceptor.ignore_all()
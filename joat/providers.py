@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import random
+from collections.abc import Iterable, Iterator
+from typing import Protocol
+from typing_extensions import Self
+
+import attrs
+from attrs import field
+
+from . import moves
+from .characters import Action, Fighter
+
+
+class ActionProvider(Protocol):
+    """A source of decisions for a fighter in battle.
+
+    `query_action` should resolve once a decision is available rather
+    than polling for one every frame.
+    """
+
+    async def query_action(self) -> tuple[Action, moves.Target]:
+        raise NotImplementedError
+
+
+def needs_pointer(action: Action) -> bool:
+    """Return whether using the action requires input from the mouse."""
+    return isinstance(action, moves.RepositioningMove)
+
+
+@attrs.define
+class ScriptedProvider:
+    """Provide actions from a predetermined sequence."""
+
+    script: Iterator[tuple[Action, moves.Target]]
+
+    @classmethod
+    def from_names(cls, fighter: Fighter, entries: Iterable[tuple[str, str]]) -> Self:
+        """Make a provider from pairs of move names and target values,
+        such as those stored by a `RecordingProvider`.
+        """
+        move_dict = {move.name: move for move in fighter.moves}
+        script = [(move_dict[name], moves.Target(target)) for name, target in entries]
+        return cls(iter(script))
+
+    async def query_action(self) -> tuple[Action, moves.Target]:
+        try:
+            return next(self.script)
+        except StopIteration:
+            raise RuntimeError('Ran out of scripted actions') from None
+
+
+@attrs.define
+class RecordingProvider:
+    """Record the actions chosen by another provider."""
+
+    provider: ActionProvider
+    record: list[tuple[str, str]] = field(factory=list, init=False)
+
+    async def query_action(self) -> tuple[Action, moves.Target]:
+        action, target = await self.provider.query_action()
+        self.record.append((action.name, target.value))
+        return action, target
+
+
+@attrs.define
+class RandomProvider:
+    """Choose uniformly at random from the moves available to a fighter,
+    preferring to use them on the opponent when possible.
+    """
+
+    available_moves: list[Action]
+    rng: random.Random = field(factory=random.Random)
+
+    @classmethod
+    def for_fighter(cls, fighter: Fighter, rng: random.Random | None = None) -> Self:
+        # Moves that need the mouse can't be used without a human player.
+        available_moves = [move for move in fighter.moves if not needs_pointer(move)]
+        if not available_moves:
+            raise ValueError(f'{fighter} has no moves that a bot can use')
+        return cls(available_moves, rng or random.Random())
+
+    async def query_action(self) -> tuple[Action, moves.Target]:
+        action = self.rng.choice(self.available_moves)
+        if moves.Target.OTHER in action.valid_targets:
+            return action, moves.Target.OTHER
+        return action, moves.Target.SELF
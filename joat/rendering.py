@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import contextlib
+from collections.abc import Callable, Iterator
+
+import attrs
+from attrs import field
+from direct.showbase.DirectObject import DirectObject
+from direct.showbase.ShowBase import ShowBase
+from panda3d.core import AsyncTaskPause, ButtonThrower, ClockObject, LPoint2
+
+INPUT_EVENT = 'render-scheduler-input'
+
+
+@attrs.define
+class RenderScheduler:
+    """Lower the frame rate while nothing on screen is changing.
+
+    The scheduler counts as active for `linger` seconds after any input,
+    while any of the `activity_checks` returns true, or while a
+    `keep_active` context is open. Otherwise, the global clock is limited
+    to `idle_frame_rate`, which throttles the whole frame, including the
+    3D scene and the imgui frame drawn by `App.draw`.
+    """
+
+    base: ShowBase
+    idle_frame_rate: float = 10
+    # `None` leaves the frame rate uncapped while active.
+    active_frame_rate: float | None = None
+    linger: float = 1
+    activity_checks: list[Callable[[], bool]] = field(factory=list)
+    running: bool = field(default=False, init=False)
+    throttled: bool = field(default=False, init=False)
+    acceptor: DirectObject = field(factory=DirectObject, kw_only=True)
+    _last_activity: float = field(default=0, init=False, repr=False)
+    _last_mouse: LPoint2 | None = field(default=None, init=False, repr=False)
+    _holds: int = field(default=0, init=False, repr=False)
+
+    def __attrs_post_init__(self) -> None:
+        for button_thrower in self.base.buttonThrowers or ():
+            node = button_thrower.node()
+            assert isinstance(node, ButtonThrower)
+            node.set_button_down_event(INPUT_EVENT)
+            node.set_button_up_event(INPUT_EVENT)
+        self.acceptor.accept(INPUT_EVENT, self.notify_activity)
+        if self.base.win is not None:
+            self.acceptor.accept(self.base.win.window_event, self.notify_activity)
+        self.notify_activity()
+
+    def notify_activity(self, *args: object) -> None:
+        """Render at the full rate for at least the next `linger` seconds."""
+        self._last_activity = ClockObject.get_global_clock().real_time
+        if self.throttled:
+            self.set_throttled(False)
+
+    @contextlib.contextmanager
+    def keep_active(self) -> Iterator[None]:
+        """Render at the full rate within the context."""
+        self._holds += 1
+        self.notify_activity()
+        try:
+            yield
+        finally:
+            self._holds -= 1
+            self.notify_activity()
+
+    def is_active(self) -> bool:
+        clock = ClockObject.get_global_clock()
+        if self._holds or clock.real_time - self._last_activity < self.linger:
+            return True
+        return any(check() for check in self.activity_checks)
+
+    def check_mouse(self) -> None:
+        watcher = self.base.mouseWatcherNode
+        if watcher is None or not watcher.has_mouse():
+            return
+        mouse = LPoint2(watcher.get_mouse())
+        if self._last_mouse is not None and mouse != self._last_mouse:
+            self.notify_activity()
+        self._last_mouse = mouse
+
+    def set_throttled(self, throttled: bool) -> None:
+        self.throttled = throttled
+        clock = ClockObject.get_global_clock()
+        frame_rate = self.idle_frame_rate if throttled else self.active_frame_rate
+        if frame_rate is None:
+            clock.set_mode(ClockObject.M_normal)
+        else:
+            clock.set_mode(ClockObject.M_limited)
+            clock.set_frame_rate(frame_rate)
+
+    async def run(self) -> None:
+        self.running = True
+        self.set_throttled(False)
+        while self.running:
+            self.check_mouse()
+            throttled = not self.is_active()
+            if throttled != self.throttled:
+                self.set_throttled(throttled)
+            await AsyncTaskPause(0)
+
+    def destroy(self) -> None:
+        self.running = False
+        self.set_throttled(False)
+        self.acceptor.ignore_all()
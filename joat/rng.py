@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import hashlib
+import random
+import secrets
+from typing_extensions import Self
+
+import attrs
+from attrs import field
+
+
+def derive_seed(seed: int | str, *names: str) -> int:
+    """Return a seed for the stream with the given path under `seed`.
+
+    Seeds are derived by hashing, so streams with different names are
+    independent no matter how many values are drawn from each.
+    """
+    digest = hashlib.sha256(repr((seed, *names)).encode()).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+@attrs.define
+class RandomStreams:
+    """A tree of independent random number generators derived from a
+    single seed, so that each fighter and subsystem can draw from its own
+    stream without affecting the others.
+    """
+
+    seed: int | str
+    _streams: dict[str, random.Random] = field(factory=dict, init=False, repr=False)
+
+    @classmethod
+    def from_entropy(cls) -> Self:
+        return cls(secrets.randbits(64))
+
+    def stream(self, name: str) -> random.Random:
+        """Return the generator with the given name, creating it if needed."""
+        if name not in self._streams:
+            self._streams[name] = random.Random(derive_seed(self.seed, name))
+        return self._streams[name]
+
+    def spawn(self, name: str) -> Self:
+        """Return a new set of streams derived from this one."""
+        return type(self)(derive_seed(self.seed, 'spawn', name))
+
+
+@attrs.define
+class Jitter:
+    """Uniform samples in (-1, 1], drawn from a generator in batches."""
+
+    rng: random.Random
+    batch_size: int = 48
+    _buffer: list[float] = field(factory=list, init=False, repr=False)
+
+    def take(self, count: int) -> list[float]:
+        """Return the next `count` samples."""
+        while len(self._buffer) < count:
+            self.refill(max(self.batch_size, count - len(self._buffer)))
+        samples = self._buffer[:count]
+        del self._buffer[:count]
+        return samples
+
+    def refill(self, count: int) -> None:
+        rng = self.rng.random
+        self._buffer += [1 - 2 * rng() for _ in range(count)]
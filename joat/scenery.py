@@ -0,0 +1,316 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import logging
+import math
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Final
+from typing_extensions import Self
+
+import attrs
+from panda3d import bullet
+from panda3d.core import (
+    GeomNode,
+    LineSegs,
+    Loader,
+    LVecBase3,
+    NodePath,
+    PTA_int,
+    PTA_LVecBase3f,
+    TransformState,
+    Vec3,
+)
+
+from . import content, wireframes
+
+_logger: Final = logging.getLogger(__name__)
+
+ARENA_DIR: Final = Path('arenas')
+DEFAULT_CACHE_DIR: Final = Path('.cache', 'arenas')
+# Bump this whenever the way geometry is built changes.
+GEOMETRY_VERSION: Final = 2
+
+Shapes = tuple[tuple[bullet.BulletShape, TransformState], ...]
+
+# Geometry loaded in this process, by source hash
+_loaded: dict[str, StaticGeometry] = {}
+
+
+@attrs.frozen
+class StaticGeometry:
+    """The collision shapes of an arena's ground and scenery, and a model
+    to draw them with.
+
+    Static shapes are never modified, so the same geometry can be used
+    by any number of arenas at once. The model should be instanced.
+    """
+
+    name: str
+    ground: Shapes = ()
+    scenery: Shapes = ()
+    model: NodePath | None = None
+
+    @classmethod
+    def from_node_path(cls, node_path: NodePath) -> Self:
+        def shapes(name: str) -> Shapes:
+            body = node_path.find(name)
+            if body.is_empty():
+                return ()
+            node = body.node()
+            return tuple(
+                (node.get_shape(i), node.get_shape_transform(i))
+                for i in range(node.get_num_shapes())
+            )
+
+        model = node_path.find('Model')
+        return cls(
+            node_path.name,
+            shapes('Ground'),
+            shapes('Scenery'),
+            None if model.is_empty() else model,
+        )
+
+    def to_node_path(self) -> NodePath:
+        root = NodePath(self.name)
+        root.attach_new_node(make_body('Ground', self.ground))
+        root.attach_new_node(make_body('Scenery', self.scenery))
+        if self.model is not None:
+            self.model.instance_to(root)
+        return root
+
+
+def make_body(name: str, shapes: Shapes) -> bullet.BulletRigidBodyNode:
+    """Return a static body made of the given shapes."""
+    body = bullet.BulletRigidBodyNode(name)
+    for shape, transform in shapes:
+        body.add_shape(shape, transform)
+    return body
+
+
+def make_transform(data: dict[str, Any]) -> TransformState:
+    """Return the transform given by the optional `position`, `heading`
+    (in degrees) and `scale` of an entry.
+    """
+    return TransformState.make_pos_hpr_scale(
+        Vec3(*data.get('position', (0, 0, 0))),
+        Vec3(data.get('heading', 0), 0, 0),
+        Vec3(data.get('scale', 1)),
+    )
+
+
+def make_solid(data: dict[str, Any]) -> bullet.BulletShape:
+    kind = data['shape']
+    if kind == 'box':
+        return bullet.BulletBoxShape(Vec3(*data['half_extents']))
+    if kind == 'sphere':
+        return bullet.BulletSphereShape(data['radius'])
+    if kind == 'cylinder':
+        return bullet.BulletCylinderShape(data['radius'], data['height'])
+    raise ValueError(f'Unknown shape {kind!r}')
+
+
+def floor_height(data: dict[str, Any], x: float, y: float) -> float:
+    """Return the height of a floor at a point. Floors are flat except
+    for smooth bumps, which fade out towards `flat_radius` from the
+    middle of the arena so that fighters always start on level ground.
+    """
+    flat_radius = data.get('flat_radius', 0)
+    t = min(math.hypot(x, y) / flat_radius - 1, 1) if flat_radius else 1
+    if t <= 0:
+        return 0
+    height = 0.0
+    for bump in data.get('bumps', ()):
+        cx, cy = bump['center']
+        distance_squared = (x - cx) ** 2 + (y - cy) ** 2
+        height += bump['height'] * math.exp(-distance_squared / bump['radius'] ** 2)
+    # Smoothstep from the flat middle out to twice its radius
+    return height * t * t * (3 - 2 * t)
+
+
+def floor_grid(data: dict[str, Any]) -> list[list[LVecBase3]]:
+    """Return the points of a floor sampled on a regular grid, in columns
+    running along y.
+    """
+    size_x, size_y = data['size']
+    spacing = data.get('spacing', 0.25)
+    columns = max(round(size_x / spacing), 1)
+    rows = max(round(size_y / spacing), 1)
+    grid = []
+    for i in range(columns + 1):
+        x = (i / columns - 0.5) * size_x
+        column = []
+        for j in range(rows + 1):
+            y = (j / rows - 0.5) * size_y
+            column.append(LVecBase3(x, y, floor_height(data, x, y)))
+        grid.append(column)
+    return grid
+
+
+def make_floor(data: dict[str, Any]) -> bullet.BulletTriangleMeshShape:
+    """Return a triangle mesh of a floor sampled on a regular grid."""
+    grid = floor_grid(data)
+    columns, rows = len(grid) - 1, len(grid[0]) - 1
+    points = PTA_LVecBase3f()
+    for column in grid:
+        for point in column:
+            points.push_back(point)
+    indices = PTA_int()
+    for i in range(columns):
+        for j in range(rows):
+            a = i * (rows + 1) + j
+            b = a + rows + 1
+            for index in (a, b, b + 1, a, b + 1, a + 1):
+                indices.push_back(index)
+    mesh = bullet.BulletTriangleMesh()
+    mesh.add_array(points, indices)
+    return bullet.BulletTriangleMeshShape(mesh, dynamic=False)
+
+
+def draw_floor(data: dict[str, Any]) -> GeomNode:
+    """Return a wireframe of a floor, with a line along each row and
+    column of its grid.
+    """
+    grid = floor_grid(data)
+    segments = LineSegs()
+    for line in (*grid, *zip(*grid)):
+        segments.move_to(line[0])
+        for point in line[1:]:
+            segments.draw_to(point)
+    return segments.create()
+
+
+def load_model(path: Path) -> NodePath:
+    node = Loader.get_global_ptr().load_sync(path)
+    if node is None:
+        raise FileNotFoundError(f'Could not load model {path}')
+    model = NodePath(node)
+    model.flatten_strong()
+    return model
+
+
+def make_model_mesh(model: NodePath) -> bullet.BulletTriangleMeshShape:
+    """Return a triangle mesh of every piece of geometry in a model."""
+    mesh = bullet.BulletTriangleMesh()
+    mesh.set_welding_distance(1e-4)
+    for geom_node_path in model.find_all_matches('**/+GeomNode'):
+        geom_node = geom_node_path.node()
+        assert isinstance(geom_node, GeomNode)
+        transform = geom_node_path.get_transform(model)
+        for geom in geom_node.get_geoms():
+            mesh.add_geom(geom, True, transform)
+    return bullet.BulletTriangleMeshShape(mesh, dynamic=False)
+
+
+def model_paths(root: Path, data: dict[str, Any]) -> list[Path]:
+    return [Path(root, model['path']) for model in data.get('models', ())]
+
+
+def build_geometry(root: Path, name: str, data: dict[str, Any]) -> StaticGeometry:
+    """Build the collision shapes defined by an arena file.
+
+    The ground is the floor, if there is one; walls, props and models
+    make up the scenery. The floor and solids are drawn as wireframes.
+    """
+    ground: list[tuple[bullet.BulletShape, TransformState]] = []
+    scenery: list[tuple[bullet.BulletShape, TransformState]] = []
+    drawing = NodePath('Model')
+    if 'floor' in data:
+        ground.append((make_floor(data['floor']), TransformState.make_identity()))
+        drawing.attach_new_node(draw_floor(data['floor']))
+    for solid in data.get('solids', ()):
+        shape, transform = make_solid(solid), make_transform(solid)
+        scenery.append((shape, transform))
+        wireframe = wireframes.draw_shape(wireframes.describe_shape(shape))
+        drawing.attach_new_node(wireframe).set_transform(transform)
+    for entry, path in zip(data.get('models', ()), model_paths(root, data)):
+        model, transform = load_model(path), make_transform(entry)
+        scenery.append((make_model_mesh(model), transform))
+        model.reparent_to(drawing)
+        model.set_transform(transform)
+    drawing.flatten_strong()
+    return StaticGeometry(name, tuple(ground), tuple(scenery), drawing)
+
+
+def source_hash(root: Path, source: bytes) -> str:
+    data = json.loads(source)
+    return content.hash_bytes(
+        str(GEOMETRY_VERSION).encode(),
+        source,
+        *(path.read_bytes() for path in model_paths(root, data)),
+    )
+
+
+def available_arenas(root: Path = content.DATA_DIR) -> list[str]:
+    directory = Path(root, ARENA_DIR)
+    if not directory.is_dir():
+        return []
+    return sorted(path.stem for path in directory.glob('*.json'))
+
+
+def _write_cache(cache_path: Path, name: str, data: bytes) -> None:
+    """Save built geometry in place of any built from older sources.
+
+    Processes building the same arena at once may race to do this, so
+    each writes a file of its own first, and failing to replace or clean
+    up files only costs a rebuild later.
+    """
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    for stale_path in cache_path.parent.glob(f'{name}-*.bam'):
+        if stale_path != cache_path:
+            try:
+                stale_path.unlink(missing_ok=True)
+            except OSError as e:
+                _logger.warning(f'Could not remove stale geometry: {e}')
+    with tempfile.NamedTemporaryFile(
+        dir=cache_path.parent, prefix=f'{name}-', suffix='.tmp', delete=False
+    ) as file:
+        file.write(data)
+    temp_path = Path(file.name)
+    try:
+        temp_path.replace(cache_path)
+    except OSError as e:
+        _logger.warning(f'Could not save geometry to {cache_path}: {e}')
+        with contextlib.suppress(OSError):
+            temp_path.unlink()
+
+
+def load_geometry(
+    name: str,
+    root: Path = content.DATA_DIR,
+    *,
+    cache_dir: Path | None = DEFAULT_CACHE_DIR,
+) -> StaticGeometry:
+    """Return the geometry of the named arena.
+
+    Built geometry is saved to `cache_dir`, keyed by a hash of its
+    sources, and kept in memory for other arenas in the same process.
+    """
+    source = Path(root, ARENA_DIR, f'{name}.json').read_bytes()
+    key = source_hash(root, source)
+    geometry = _loaded.get(key)
+    if geometry is not None:
+        return geometry
+    start = time.perf_counter()
+    cache_path = None if cache_dir is None else Path(cache_dir, f'{name}-{key}.bam')
+    cached = None
+    if cache_path is not None:
+        # Another process may remove the file at any time.
+        with contextlib.suppress(FileNotFoundError):
+            cached = cache_path.read_bytes()
+    if cached is not None:
+        node_path = NodePath.decode_from_bam_stream(cached)
+        geometry = StaticGeometry.from_node_path(node_path)
+        action = 'Loaded'
+    else:
+        geometry = build_geometry(root, name, json.loads(source))
+        if cache_path is not None:
+            data = geometry.to_node_path().encode_to_bam_stream()
+            _write_cache(cache_path, name, data)
+        action = 'Built'
+    elapsed = time.perf_counter() - start
+    _logger.info(f'{action} the geometry of arena {name!r} in {elapsed * 1000:.1f}ms')
+    _loaded[key] = geometry
+    return geometry
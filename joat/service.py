@@ -0,0 +1,424 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import json
+import logging
+import os
+import random
+from collections.abc import Callable, Mapping, Sequence
+from pathlib import Path
+from typing import Any, Final
+from typing_extensions import Self
+
+import attrs
+from attrs import field
+
+from . import content, headless, hitmaps, moves
+from .characters import Action, Fighter
+from .client import DEFAULT_HOST, DEFAULT_PORT, Message
+from .providers import (
+    ActionProvider,
+    RandomProvider,
+    RecordingProvider,
+    ScriptedProvider,
+)
+
+_logger: Final = logging.getLogger(__name__)
+
+POLICIES: Final = ('random', 'hitmap')
+
+_worker_hit_maps: hitmaps.HitMaps | None = None
+
+
+@attrs.frozen
+class BattleSpec:
+    characters: tuple[str, str]
+    seed: int = 0
+    policies: tuple[str, str] = ('random', 'random')
+    max_turns: int = 100
+    simultaneous: bool = False
+    replay: bool = False
+
+    @classmethod
+    def from_json(cls, data: Mapping[str, Any], pack: content.ContentPack) -> Self:
+        """Read a spec from a request, raising `ValueError` if it is invalid."""
+        characters = tuple(data['characters'])
+        policies = tuple(data.get('policies', ('random', 'random')))
+        if len(characters) != 2 or len(policies) != 2:
+            raise ValueError('Battles need exactly two characters and policies')
+        for name in characters:
+            if name not in pack.characters:
+                raise ValueError(f'Unknown character {name!r}')
+        for policy in policies:
+            if policy not in POLICIES:
+                raise ValueError(f'Unknown policy {policy!r}')
+        return cls(
+            (characters[0], characters[1]),
+            seed=int(data.get('seed', 0)),
+            policies=(policies[0], policies[1]),
+            max_turns=int(data.get('max_turns', 100)),
+            simultaneous=bool(data.get('simultaneous', False)),
+            replay=bool(data.get('replay', False)),
+        )
+
+
+@attrs.define
+class _HitMapPolicy:
+    """Choose moves using hit maps against the other fighter in the battle."""
+
+    fighter: Fighter
+    fighters: Sequence[Fighter]
+    hit_maps: hitmaps.HitMaps
+    fallback: ActionProvider
+
+    async def query_action(self) -> tuple[Action, moves.Target]:
+        opponent = next(f for f in self.fighters if f is not self.fighter)
+        provider = hitmaps.HitMapProvider(
+            self.fighter, opponent, self.hit_maps, self.fallback
+        )
+        return await provider.query_action()
+
+
+@attrs.define
+class _PolicyProviders:
+    """Make the providers of a battle from policy names, recording the
+    actions they choose.
+    """
+
+    policies: Sequence[str]
+    hit_maps: hitmaps.HitMaps
+    fighters: list[Fighter] = field(factory=list, init=False)
+    records: dict[int, list[tuple[str, str]]] = field(factory=dict, init=False)
+
+    def factory(self, index: int) -> headless.ProviderFactory:
+        return functools.partial(self.make_provider, index)
+
+    def make_provider(
+        self, index: int, fighter: Fighter, rng: random.Random
+    ) -> ActionProvider:
+        self.fighters.append(fighter)
+        provider: ActionProvider = RandomProvider.for_fighter(fighter, rng)
+        if self.policies[index] == 'hitmap':
+            provider = _HitMapPolicy(fighter, self.fighters, self.hit_maps, provider)
+        recorder = RecordingProvider(provider)
+        self.records[index] = recorder.record
+        return recorder
+
+
+def replay_battle(pack: content.ContentPack, replay: Mapping[str, Any]) -> Message:
+    """Play back a replay returned by the service and return the result."""
+    factories = [
+        lambda fighter, rng, actions=actions: ScriptedProvider.from_names(
+            fighter, actions
+        )
+        for actions in replay['actions']
+    ]
+    name_1, name_2 = replay['characters']
+    result = headless.run_battle(
+        pack.characters[name_1],
+        pack.characters[name_2],
+        seed=replay['seed'],
+        max_turns=replay['max_turns'],
+        simultaneous=replay.get('simultaneous', False),
+        provider_factories=factories,
+    )
+    return result.to_json()
+
+
+def init_worker(root: Path, hit_map_dir: Path) -> None:
+    global _worker_hit_maps
+    headless.init_worker(root)
+    _worker_hit_maps = hitmaps.HitMaps.load(headless.get_worker_pack(), hit_map_dir)
+
+
+def _warm_up() -> int:
+    return os.getpid()
+
+
+def _run_battle(spec: BattleSpec) -> Message:
+    pack = headless.get_worker_pack()
+    assert _worker_hit_maps is not None
+    policies = _PolicyProviders(spec.policies, _worker_hit_maps)
+    name_1, name_2 = spec.characters
+    result = headless.run_battle(
+        pack.characters[name_1],
+        pack.characters[name_2],
+        seed=spec.seed,
+        max_turns=spec.max_turns,
+        simultaneous=spec.simultaneous,
+        provider_factories=(policies.factory(0), policies.factory(1)),
+    )
+    reply: Message = {'result': result.to_json()}
+    if spec.replay:
+        reply['replay'] = {
+            'characters': list(spec.characters),
+            'seed': spec.seed,
+            'max_turns': spec.max_turns,
+            'simultaneous': spec.simultaneous,
+            'actions': [policies.records[0], policies.records[1]],
+        }
+    return reply
+
+
+@attrs.define
+class Metrics:
+    completed: int = 0
+    failed: int = 0
+    timed_out: int = 0
+    rejected: int = 0
+    running: int = 0
+    max_queue_depth: int = 0
+    total_wait: float = 0
+    total_run: float = 0
+
+    def to_json(self, queue_depth: int) -> dict[str, Any]:
+        finished = self.completed + self.failed + self.timed_out
+        return {
+            **attrs.asdict(self),
+            'queue_depth': queue_depth,
+            'mean_wait': self.total_wait / max(finished, 1),
+            'mean_run': self.total_run / max(self.completed, 1),
+        }
+
+
+@attrs.define
+class _Job:
+    request_id: Any
+    spec: BattleSpec
+    writer: asyncio.StreamWriter
+    enqueued: float
+    deadline: float
+    release: Callable[[], None]
+
+    async def send(self, status: str, **contents: Any) -> None:
+        if self.writer.is_closing():
+            return
+        message = {'kind': 'result', 'id': self.request_id, 'status': status}
+        self.writer.write(json.dumps({**message, **contents}).encode() + b'\n')
+        with contextlib.suppress(ConnectionError):
+            await self.writer.drain()
+
+
+@attrs.define
+class BattleService:
+    """Run battles requested over a socket in a pool of headless workers.
+
+    Requests and replies are newline-delimited JSON. Battles are queued
+    and run by `workers` processes, which load the content once when the
+    service starts. A reply is streamed back as soon as its battle is
+    done, so replies may arrive out of order.
+
+    A client can have at most `max_per_client` battles queued or running
+    at once; the service stops reading its requests until one finishes.
+    Requests arriving while `max_queue` battles are waiting are rejected.
+    """
+
+    pack: content.ContentPack
+    workers: int
+    hit_map_dir: Path = hitmaps.DEFAULT_DIR
+    max_queue: int = 256
+    max_per_client: int = 32
+    default_timeout: float = 60
+    metrics: Metrics = field(factory=Metrics, init=False)
+    _queue: asyncio.Queue[_Job] = field(init=False, repr=False)
+
+    async def serve(
+        self,
+        host: str = DEFAULT_HOST,
+        port: int = DEFAULT_PORT,
+        *,
+        unix: Path | None = None,
+        metrics_interval: float = 60,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self.max_queue)
+        with concurrent.futures.ProcessPoolExecutor(
+            self.workers,
+            initializer=init_worker,
+            initargs=(self.pack.root, self.hit_map_dir),
+        ) as executor:
+            # Start every worker up front, so that requests never wait for
+            # content to load.
+            await asyncio.gather(
+                *(loop.run_in_executor(executor, _warm_up) for _ in range(self.workers))
+            )
+            dispatchers = [
+                asyncio.create_task(self._dispatch(executor))
+                for _ in range(self.workers)
+            ]
+            if unix is not None:
+                server = await asyncio.start_unix_server(self._handle, unix)
+                _logger.info(f'Serving battles on {unix}')
+            else:
+                server = await asyncio.start_server(self._handle, host, port)
+                _logger.info(f'Serving battles on {host}:{port}')
+            reporter = asyncio.create_task(self._log_metrics(metrics_interval))
+            try:
+                async with server:
+                    await server.serve_forever()
+            finally:
+                reporter.cancel()
+                for dispatcher in dispatchers:
+                    dispatcher.cancel()
+
+    async def _log_metrics(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            _logger.info(json.dumps(self.metrics.to_json(self._queue.qsize())))
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_per_client)
+
+        def send(message: Message) -> None:
+            writer.write(json.dumps(message).encode() + b'\n')
+
+        def send_error(request_id: Any, error: str) -> None:
+            message = {'kind': 'result', 'id': request_id, 'status': 'error'}
+            send({**message, 'error': error})
+
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    send_error(None, 'Invalid request')
+                    continue
+                # Errors echo the id whenever there is one to echo, since
+                # clients can't tell which request a reply is for without.
+                if not isinstance(request, dict):
+                    send_error(None, 'Invalid request')
+                    continue
+                request_id = request.get('id')
+                kind = request.get('kind')
+                if kind is None:
+                    send_error(request_id, 'Invalid request')
+                    continue
+                if kind == 'metrics':
+                    metrics = self.metrics.to_json(self._queue.qsize())
+                    send({'kind': 'metrics', 'id': request_id, 'metrics': metrics})
+                elif kind == 'battle':
+                    try:
+                        spec = BattleSpec.from_json(request, self.pack)
+                        timeout = float(request.get('timeout') or self.default_timeout)
+                    except (ValueError, KeyError, TypeError) as e:
+                        send_error(request_id, str(e))
+                        continue
+                    await semaphore.acquire()
+                    now = loop.time()
+                    job = _Job(
+                        request_id, spec, writer, now, now + timeout, semaphore.release
+                    )
+                    try:
+                        self._queue.put_nowait(job)
+                    except asyncio.QueueFull:
+                        semaphore.release()
+                        self.metrics.rejected += 1
+                        await job.send('rejected', error='The queue is full')
+                        continue
+                    depth = self._queue.qsize()
+                    self.metrics.max_queue_depth = max(
+                        self.metrics.max_queue_depth, depth
+                    )
+                    send({'kind': 'queued', 'id': request_id, 'queue_depth': depth})
+                else:
+                    send_error(request_id, f'Unknown request kind {kind!r}')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, executor: concurrent.futures.Executor) -> None:
+        """Run queued battles one at a time. There is a dispatcher for each
+        worker, so battles never wait inside the pool itself.
+        """
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run_job(executor, job)
+            finally:
+                job.release()
+
+    async def _run_job(self, executor: concurrent.futures.Executor, job: _Job) -> None:
+        loop = asyncio.get_running_loop()
+        if job.writer.is_closing():
+            return
+        start = loop.time()
+        self.metrics.total_wait += start - job.enqueued
+        if start >= job.deadline:
+            self.metrics.timed_out += 1
+            await job.send('timeout', error='Timed out in the queue')
+            return
+        future = loop.run_in_executor(executor, _run_battle, job.spec)
+        self.metrics.running += 1
+        try:
+            reply = await asyncio.wait_for(asyncio.shield(future), job.deadline - start)
+        except asyncio.TimeoutError:
+            self.metrics.timed_out += 1
+            await job.send('timeout', error='Timed out while running')
+            # A worker can't be interrupted mid-battle, so this dispatcher
+            # stays busy until the battle finishes anyway.
+            with contextlib.suppress(Exception):
+                await future
+            return
+        except Exception as e:
+            _logger.exception(f'Battle {job.spec} failed')
+            self.metrics.failed += 1
+            await job.send('error', error=str(e))
+            return
+        finally:
+            self.metrics.running -= 1
+        run_time = loop.time() - start
+        self.metrics.completed += 1
+        self.metrics.total_run += run_time
+        await job.send(
+            'done',
+            **reply,
+            queue_time=start - job.enqueued,
+            run_time=run_time,
+        )
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.set_defaults(command=run)
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', type=Path, help='listen on a Unix socket instead')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--max-queue', type=int, default=256)
+    parser.add_argument('--max-per-client', type=int, default=32)
+    parser.add_argument(
+        '--timeout', type=float, default=60, help='the default per battle'
+    )
+    parser.add_argument('--metrics-interval', type=float, default=60)
+    parser.add_argument('--data-dir', type=Path, default=content.DATA_DIR)
+    parser.add_argument('--hit-maps', type=Path, default=hitmaps.DEFAULT_DIR)
+
+
+def run(args: argparse.Namespace) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    _logger.setLevel(logging.INFO)
+    service = BattleService(
+        content.ContentPack.load(args.data_dir),
+        args.workers or 1,
+        hit_map_dir=args.hit_maps,
+        max_queue=args.max_queue,
+        max_per_client=args.max_per_client,
+        default_timeout=args.timeout,
+    )
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(
+            service.serve(
+                args.host,
+                args.port,
+                unix=args.unix,
+                metrics_interval=args.metrics_interval,
+            )
+        )
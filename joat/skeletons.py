@@ -1,8 +1,9 @@
 from __future__ import annotations
 
 import enum
+import functools
 import math
-from typing import Any, cast
+from typing import Any, Final, cast
 from typing_extensions import Self
 
 import attrs
@@ -12,21 +13,39 @@ from panda3d.bullet import (
     BulletConstraint,
     BulletGenericConstraint,
     BulletHingeConstraint,
+    BulletPersistentManifold,
     BulletRigidBodyNode,
     BulletSphereShape,
 )
 from panda3d.core import (
-    AsyncTaskPause,
-    ClockObject,
+    AsyncFuture,
+    CollideMask,
     LVecBase2,
     Mat3,
     NodePath,
+    PandaNode,
     TransformState,
     VBase3,
     Vec3,
 )
 
-from . import arenas, control, physics, stances, tasks
+from . import arenas, control, physics, stances
+
+# How close, in radians, each joint must be to its target for an arm to
+# have reached it. Gravity keeps the shoulder from closing the last few
+# hundredths of a radian.
+JOINT_TOLERANCE: Final = 0.1
+# How slowly, in radians per second, an arm must be turning to have settled
+SETTLED_SPEED: Final = 0.5
+# How hard a forearm must strike something for a swing to end there,
+# which is as hard as a blow must be to hurt
+STRIKE_IMPULSE: Final = 20
+# The longest a slide can take, in simulated seconds
+SLIDE_TIMEOUT: Final = 5
+# Enough for the integral term to overcome the friction on a base
+SLIDE_MAX_INTEGRAL: Final = 100
+# How slowly a slide must be moving by the time it reaches its target
+SLIDE_MAX_SPEED: Final = 1
 
 
 class Side(enum.Enum):
@@ -34,6 +53,15 @@ class Side(enum.Enum):
     RIGHT = enum.auto()
 
 
+class Motion(enum.Enum):
+    """How a motion of an arm ended."""
+
+    # The arm came to rest at its target, or as near to it as it can get
+    REACHED = enum.auto()
+    CONTACT = enum.auto()
+    TIMED_OUT = enum.auto()
+
+
 def shoulder_angles(
     target: VBase3,
     theta: float,
@@ -94,6 +122,9 @@ class HingeJointController:
     def move(self, speed: float) -> None:
         self.constraint.set_motor_target(self.target_angle, 1 / speed)
 
+    def error(self) -> float:
+        return math.radians(self.constraint.hinge_angle) - self.target_angle
+
 
 @attrs.define
 class BallJointController:
@@ -112,6 +143,13 @@ class BallJointController:
             diff = target_angle - motor.current_position
             motor.set_target_velocity(diff * speed)
 
+    def errors(self) -> list[float]:
+        return [
+            self.constraint.get_rotational_limit_motor(i).current_position
+            - self.target_angles[i]
+            for i in range(3)
+        ]
+
 
 @attrs.define(kw_only=True, repr=False)
 class Arm:
@@ -123,6 +161,10 @@ class Arm:
     transform: Mat3
     speed: float  # proportional to maximum angular velocity of joint motors
     _enabled: bool = True
+    _motion: AsyncFuture | None = attrs.field(default=None, init=False)
+    _time_left: float = attrs.field(default=0, init=False)
+    _has_moved: bool = attrs.field(default=False, init=False)
+    _return_to: tuple[VBase3, float] | None = attrs.field(default=None, init=False)
 
     def __attrs_post_init__(self) -> None:
         self.enabled = self._enabled
@@ -170,7 +212,9 @@ class Arm:
 
         for axis in range(3):
             shoulder.get_rotational_limit_motor(axis).set_max_motor_force(strength)
-        elbow.set_max_motor_impulse(strength)
+        # Bullet leaves the target velocity of hinge motors uninitialized,
+        # which makes the simulation depend on whatever was in memory.
+        elbow.enable_angular_motor(False, 0, strength)
         elbow.set_limit(0, 180)
         # limits for moving outward from down by side
         shoulder.set_angular_limit(0, -175, 90)
@@ -218,14 +262,60 @@ class Arm:
         self.shoulder.target_angles = angles[:3]
         self.elbow.target_angle = angles[3]
 
-    async def move(self) -> None:
-        """Move the arm."""
-        self.enabled = True
-        while self.enabled:
-            await AsyncTaskPause(0)
-            self.shoulder.move(self.speed)
-            self.elbow.move(self.speed)
-            self.bicep.node().active = True
+    def move_to(
+        self,
+        point: VBase3,
+        angle: float = 0,
+        *,
+        timeout: float,
+        return_to: tuple[VBase3, float] | None = None,
+    ) -> AsyncFuture:
+        """Set a target and return a future of the `Motion` that ends once
+        the arm reaches it, the forearm strikes something, or `timeout`
+        simulated seconds pass. The arm then sets off for `return_to`,
+        if given, within the same physics step.
+
+        A motion already in progress ends as timed out.
+        """
+        self.end_motion(Motion.TIMED_OUT)
+        self.set_target(point, angle)
+        self._motion = AsyncFuture()
+        self._time_left = timeout
+        self._has_moved = False
+        self._return_to = return_to
+        return self._motion
+
+    def end_motion(self, motion: Motion) -> None:
+        future = self._motion
+        if future is None:
+            return
+        self._motion = None
+        if self._return_to is not None:
+            self.set_target(*self._return_to)
+        future.set_result(motion)
+
+    def _has_settled(self) -> bool:
+        if self.forearm.node().angular_velocity.length() >= SETTLED_SPEED:
+            self._has_moved = True
+            return False
+        if self._has_moved:
+            return True
+        errors = [*self.shoulder.errors(), self.elbow.error()]
+        return all(abs(error) < JOINT_TOLERANCE for error in errors)
+
+    def update(self, dt: float) -> None:
+        """Drive the joint motors towards their targets."""
+        if self._motion is not None:
+            self._time_left -= dt
+            if self.enabled and self._has_settled():
+                self.end_motion(Motion.REACHED)
+            elif self._time_left <= 0:
+                self.end_motion(Motion.TIMED_OUT)
+        if not self.enabled:
+            return
+        self.shoulder.move(self.speed)
+        self.elbow.move(self.speed)
+        self.bicep.node().active = True
 
 
 @attrs.define(repr=False, kw_only=True)
@@ -346,13 +436,26 @@ class Skeleton:
         else:
             return self.right_arm
 
-    def enter_arena(self, arena: arenas.Arena) -> None:
+    def enter_arena(
+        self,
+        arena: arenas.Arena,
+        *,
+        collide_mask: CollideMask = CollideMask.all_on(),
+    ) -> None:
+        arena.wake()
         self.assume_stance()
-        tasks.add_task(self.left_arm.move())
-        tasks.add_task(self.right_arm.move())
+        own_nodes = {part.node() for part in self.parts.values()}
+        for arm in (self.left_arm, self.right_arm):
+            arm.enabled = True
+            arena.step_callbacks.append(arm.update)
+            arm.forearm.node().python_tags['contact_callback'] = functools.partial(
+                self._on_contact, arm, own_nodes
+            )
         self.core.reparent_to(arena.root)
         for part in self.parts.values():
+            part.set_collide_mask(collide_mask)
             arena.world.attach(part.node())
+            arena.track(part)
         for name, joint in self.joints.items():
             if name == 'neck' or name == 'waist':
                 arena.world.attach(joint)
@@ -360,15 +463,18 @@ class Skeleton:
                 arena.world.attach_constraint(joint, linked_collision=True)
 
     def exit_arena(self, arena: arenas.Arena) -> None:
-        self.left_arm.enabled = False
-        self.right_arm.enabled = False
+        arena.controllers.cancel(self)
+        for arm in (self.left_arm, self.right_arm):
+            arm.enabled = False
+            arena.step_callbacks.remove(arm.update)
+            arm.end_motion(Motion.TIMED_OUT)
+            arm.forearm.node().python_tags.pop('contact_callback', None)
         self.core.detach_node()
         for joint in self.joints.values():
             arena.world.remove(joint)
         for part in self.parts.values():
+            arena.untrack(part)
             arena.world.remove(part.node())
-            if part.python_tags:
-                part.python_tags.clear()
 
     def assume_stance(self) -> None:
         self.left_arm.set_target(
@@ -378,21 +484,61 @@ class Skeleton:
             self.stance.right_hand_pos, self.stance.right_arm_angle
         )
 
-    async def slide_to(self, target: LVecBase2, *, tol: float = 0.1) -> None:
-        clock = ClockObject.get_global_clock()
-        t0 = clock.frame_time
-        base = self.parts['base']
-        controller = control.pid(100, 1, 10, zero=LVecBase2)
-        next(controller)
-        while True:
-            t1 = clock.frame_time
-            here = self.core.get_pos().xy
-            if here.almost_equal(target, threshold=tol):
-                break
-            impulse = controller.send((target - here, t1 - t0))
-            base.node().apply_central_impulse(Vec3(impulse, 0))
-            t0 = t1
-            await AsyncTaskPause(0)
+    def swing(self, side: Side, point: VBase3, *, timeout: float) -> AsyncFuture:
+        """Move a hand towards a point and then back to the stance, and
+        return a future of the `Motion` that ends the swing.
+        """
+        if side is Side.LEFT:
+            return_to = (self.stance.left_hand_pos, self.stance.left_arm_angle)
+        else:
+            return_to = (self.stance.right_hand_pos, self.stance.right_arm_angle)
+        return self.get_arm(side).move_to(point, timeout=timeout, return_to=return_to)
+
+    @staticmethod
+    def _on_contact(
+        arm: Arm,
+        own_nodes: set[PandaNode],
+        node: PandaNode,
+        manifold: BulletPersistentManifold,
+    ) -> None:
+        other = manifold.node1 if node == manifold.node0 else manifold.node0
+        if other in own_nodes:
+            return
+        if any(p.applied_impulse >= STRIKE_IMPULSE for p in manifold.manifold_points):
+            arm.end_motion(Motion.CONTACT)
+
+    def slide_to(
+        self,
+        arena: arenas.Arena,
+        target: LVecBase2,
+        *,
+        tol: float = 0.1,
+        timeout: float = SLIDE_TIMEOUT,
+    ) -> AsyncFuture:
+        """Push the skeleton along the ground towards a point and return
+        a future of the `control.Outcome` of the slide.
+        """
+        arena.wake()
+        base = self.parts['base'].node()
+
+        def push(impulse: LVecBase2) -> None:
+            base.apply_central_impulse(Vec3(impulse, 0))
+
+        return arena.controllers.add(
+            control.Controller(
+                measure=lambda: self.core.get_pos().xy,
+                actuate=push,
+                target=LVecBase2(target),
+                p=100,
+                i=200,
+                d=60,
+                max_integral=SLIDE_MAX_INTEGRAL,
+                tolerance=tol,
+                max_rate=SLIDE_MAX_SPEED,
+                time_left=timeout,
+                owner=self,
+            )
+        )
 
     def kill(self) -> None:
         self.left_arm.enabled = False
@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+import argparse
+import gc
+import logging
+import os
+import random
+import statistics
+import time
+from collections import Counter
+from collections.abc import Iterable, Mapping, Sequence
+from pathlib import Path
+from typing import Final
+
+import attrs
+from attrs import field
+from panda3d.core import NodePath, RenderState, TransformState, WeakNodePath
+
+from . import battles, content, headless, providers
+from .characters import Character
+
+_logger: Final = logging.getLogger(__name__)
+
+
+@attrs.frozen
+class Budget:
+    """How much may be left behind by each battle, once warmed up."""
+
+    rss: float = 256 * 1024  # bytes
+    # Per type, for Python objects and for Panda3D objects
+    objects: float = 0.5
+    panda: float = 0.5
+
+
+DEFAULT_BUDGET: Final = Budget()
+
+
+@attrs.frozen
+class MemorySample:
+    rss: int  # bytes
+    # Live Python objects tracked by the garbage collector, by type
+    objects: Counter[str]
+    # Live nodes made by battles by type, including Bullet bodies, and
+    # the render and transform states cached by Panda3D
+    panda: Counter[str]
+
+
+@attrs.frozen
+class SoakResult:
+    # The resident set size after the warm-up and after every battle since
+    rss: tuple[int, ...]
+    # Only the ends are kept, so that samples don't add up to a leak.
+    first: MemorySample
+    last: MemorySample
+
+    @property
+    def battles(self) -> int:
+        return len(self.rss) - 1
+
+    def rss_growth(self) -> float:
+        """Return the growth of the resident set size per battle, fitted
+        over every battle, since it's too noisy to take from the ends.
+        """
+        return statistics.linear_regression(range(len(self.rss)), self.rss).slope
+
+    def object_growth(self) -> dict[str, float]:
+        return _growth(self.first.objects, self.last.objects, self.battles)
+
+    def panda_growth(self) -> dict[str, float]:
+        return _growth(self.first.panda, self.last.panda, self.battles)
+
+    def failures(self, budget: Budget) -> list[str]:
+        """Return a line for every measure that grew faster than allowed."""
+        lines = []
+        rss_growth = self.rss_growth()
+        if rss_growth > budget.rss:
+            lines.append(f'RSS: {rss_growth / 1024:+.1f}KiB per battle')
+        for kind, growth, limit in (
+            ('Object', self.object_growth(), budget.objects),
+            ('Panda3D', self.panda_growth(), budget.panda),
+        ):
+            lines.extend(
+                f'{kind} {name}: {rate:+.2f} per battle'
+                for name, rate in growth.items()
+                if rate > limit
+            )
+        return lines
+
+
+def _growth(
+    first: Mapping[str, int], last: Mapping[str, int], battles: int
+) -> dict[str, float]:
+    """Return the change in each count per battle, most first."""
+    growth = {
+        name: (last.get(name, 0) - first.get(name, 0)) / battles
+        for name in first.keys() | last.keys()
+    }
+    return dict(sorted(growth.items(), key=lambda item: item[1], reverse=True))
+
+
+@attrs.define
+class NodeTracker:
+    """Keeps track of nodes without keeping them alive."""
+
+    _nodes: list[WeakNodePath] = field(factory=list, init=False)
+
+    def track(self, node_paths: Iterable[NodePath]) -> None:
+        """Track some nodes and all of their descendants."""
+        for node_path in node_paths:
+            self._nodes.append(WeakNodePath(node_path))
+            for descendant in node_path.find_all_matches('**'):
+                self._nodes.append(WeakNodePath(descendant))
+
+    def count(self) -> Counter[str]:
+        self._nodes = [node for node in self._nodes if not node.was_deleted()]
+        # The same node may have been tracked more than once.
+        types = {node.get_key(): node.node().get_type().name for node in self._nodes}
+        return Counter(types.values())
+
+
+def resident_set_size() -> int:
+    """Return how much memory the process holds in bytes, or 0 if the
+    platform doesn't say.
+    """
+    try:
+        pages = int(Path('/proc/self/statm').read_text().split()[1])
+    except OSError:
+        return 0
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def count_objects() -> Counter[str]:
+    gc.collect()
+    return Counter(
+        f'{type(o).__module__}.{type(o).__qualname__}' for o in gc.get_objects()
+    )
+
+
+def count_panda_objects(tracker: NodeTracker) -> Counter[str]:
+    counts = tracker.count()
+    counts['RenderState'] = RenderState.get_num_states()
+    counts['TransformState'] = TransformState.get_num_states()
+    return counts
+
+
+def take_sample(tracker: NodeTracker) -> MemorySample:
+    objects = count_objects()
+    return MemorySample(resident_set_size(), objects, count_panda_objects(tracker))
+
+
+def run_battle(
+    characters: Sequence[Character],
+    tracker: NodeTracker,
+    *,
+    seed: int,
+    max_turns: int,
+    max_time: float,
+) -> None:
+    """Run a battle between bots and tear it down the way the rest of the
+    game does, tracking the nodes it made.
+    """
+    fighters = battles.make_fighters(*characters)
+    arena = headless.make_arena(seed=seed)
+    bots = [
+        providers.RandomProvider.for_fighter(fighter, arena.rng.stream(f'bot {i}'))
+        for i, fighter in enumerate(fighters)
+    ]
+    tracker.track(fighter.skeleton.core for fighter in fighters)
+    tracker.track(fighter.health_bar for fighter in fighters)
+    tracker.track([arena.root])
+
+    async def battle() -> None:
+        for fighter in fighters:
+            fighter.enter_arena(arena)
+        await battles.run_turns(fighters, bots, max_turns=max_turns)
+
+    try:
+        headless.simulate(arena, battle(), max_time=max_time)
+    finally:
+        # Projectiles and anything else made during the battle
+        tracker.track([arena.root])
+        for fighter in fighters:
+            fighter.exit_arena()
+        arena.exit()
+
+
+def soak(
+    characters: Sequence[Character],
+    *,
+    battles: int,
+    warmup: int = 10,
+    seed: int = 0,
+    max_turns: int = 100,
+    max_time: float = 600,
+) -> SoakResult:
+    """Run battles between random pairs of characters back to back,
+    sampling memory after the warm-up battles and after each battle
+    following them. There must be at least one warm-up battle, one
+    battle after it and two characters.
+    """
+    if warmup < 1 or battles < 1:
+        raise ValueError('Soaking needs at least one warm-up battle and one more')
+    if len(characters) < 2:
+        raise ValueError('Soaking needs at least two characters')
+    rng = random.Random(seed)
+    tracker = NodeTracker()
+    start = time.perf_counter()
+    first = last = None
+    rss = []
+    for i in range(warmup + battles):
+        run_battle(
+            rng.sample(characters, 2),
+            tracker,
+            seed=seed + i,
+            max_turns=max_turns,
+            max_time=max_time,
+        )
+        # Samples are taken during the warm-up too, since taking the first
+        # one makes some objects, and the previous one is dropped so that
+        # it isn't counted.
+        last = None
+        last = take_sample(tracker)
+        _logger.info(
+            f'Battle {i + 1}: {last.rss / 2**20:.1f}MiB,'
+            f' {last.objects.total()} objects, {last.panda.total()} Panda3D objects'
+            f' ({time.perf_counter() - start:.0f}s)'
+        )
+        if i == warmup - 1:
+            first = last
+        if first is not None:
+            rss.append(last.rss)
+    assert first is not None and last is not None
+    return SoakResult(tuple(rss), first, last)
+
+
+def format_report(result: SoakResult, *, top: int = 10) -> str:
+    lines = [
+        f'{result.battles} battles',
+        f'RSS: {result.rss_growth() / 1024:+.1f}KiB per battle',
+    ]
+    for kind, growth in (
+        ('Objects', result.object_growth()),
+        ('Panda3D objects', result.panda_growth()),
+    ):
+        growing = [(name, rate) for name, rate in growth.items() if rate > 0]
+        lines.append(f'{kind} growing per battle:' if growing else f'{kind}: stable')
+        lines.extend(f'  {rate:+8.2f} {name}' for name, rate in growing[:top])
+    return '\n'.join(lines)
+
+
+def positive_int(text: str) -> int:
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, not {value}')
+    return value
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.set_defaults(command=run)
+    parser.add_argument(
+        'characters',
+        nargs='*',
+        help='the characters to pick from (by default, all that bots can use)',
+    )
+    parser.add_argument('--battles', type=positive_int, default=100)
+    parser.add_argument(
+        '--warmup',
+        type=positive_int,
+        default=10,
+        help='battles to run before measuring, to fill caches',
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-turns', type=int, default=100)
+    parser.add_argument(
+        '--time', type=float, default=600, help='simulated seconds per battle'
+    )
+    parser.add_argument(
+        '--rss-budget',
+        type=float,
+        default=DEFAULT_BUDGET.rss / 1024,
+        metavar='KIB',
+        help='allowed growth of the resident set size per battle',
+    )
+    parser.add_argument(
+        '--object-budget',
+        type=float,
+        default=DEFAULT_BUDGET.objects,
+        metavar='N',
+        help='allowed growth per battle of the objects of any one type',
+    )
+    parser.add_argument(
+        '--panda-budget',
+        type=float,
+        default=DEFAULT_BUDGET.panda,
+        metavar='N',
+        help='allowed growth per battle of the Panda3D objects of any one type',
+    )
+    parser.add_argument('--data-dir', type=Path, default=content.DATA_DIR)
+
+
+def run(args: argparse.Namespace) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    _logger.setLevel(logging.INFO)
+    pack = content.ContentPack.load(args.data_dir)
+    names = args.characters or sorted(pack.characters)
+    unknown = [name for name in names if name not in pack.characters]
+    if unknown:
+        raise SystemExit(f'Unknown characters: {", ".join(unknown)}')
+    # Bots can only play characters with moves that don't need the mouse.
+    available = [
+        pack.characters[name]
+        for name in names
+        if not all(map(providers.needs_pointer, pack.characters[name].moves))
+    ]
+    if len(available) < 2:
+        raise SystemExit(
+            f'Need at least two characters that bots can play, got {len(available)}'
+        )
+    result = soak(
+        available,
+        battles=args.battles,
+        warmup=args.warmup,
+        seed=args.seed,
+        max_turns=args.max_turns,
+        max_time=args.time,
+    )
+    print(format_report(result))
+    failures = result.failures(
+        Budget(args.rss_budget * 1024, args.object_budget, args.panda_budget)
+    )
+    if failures:
+        raise SystemExit('Over budget:\n' + '\n'.join(failures))
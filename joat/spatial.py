@@ -37,3 +37,17 @@ def make_rigid_transform(
         return TransformState.make_pos_quat_scale(translation, rotation, LVecBase3(1))
     else:
         return TransformState.make_mat(LMatrix4(rotation, translation))
+
+
+def interpolate_transforms(
+    a: TransformState, b: TransformState, t: float
+) -> TransformState:
+    """Return a rigid transform a fraction `t` of the way from `a` to `b`."""
+    translation = a.get_pos() + (b.get_pos() - a.get_pos()) * t
+    rotation_a, rotation_b = a.get_quat(), b.get_quat()
+    if rotation_a.dot(rotation_b) < 0:
+        # Take the shorter way around.
+        rotation_b = -rotation_b
+    rotation = rotation_a * (1 - t) + rotation_b * t
+    rotation.normalize()
+    return make_rigid_transform(rotation, translation)
@@ -0,0 +1,562 @@
+from __future__ import annotations
+
+import argparse
+import base64
+import collections
+import enum
+import json
+import logging
+import math
+import select
+import socket
+import struct
+import time
+import zlib
+from collections.abc import Iterable, Sequence
+from typing import TYPE_CHECKING, Any, Final
+from typing_extensions import Self
+
+import attrs
+from attrs import field
+from direct.gui.OnscreenText import OnscreenText
+from direct.showbase.DirectObject import DirectObject
+from direct.showbase.ShowBase import ShowBase
+from panda3d.core import (
+    AsyncTaskPause,
+    ClockObject,
+    LQuaternion,
+    LVecBase3,
+    NodePath,
+    TextNode,
+    TransformState,
+)
+
+from . import arenas, spatial, tasks, wireframes
+
+if TYPE_CHECKING:
+    from .characters import Fighter
+
+_logger: Final = logging.getLogger(__name__)
+
+DEFAULT_PORT: Final = 7779
+# Positions are sent in units of 1/1024 m and quaternion components in
+# units of 1/32767, which is well below what can be seen on screen.
+POSITION_SCALE: Final = 1024
+ROTATION_SCALE: Final = 32767
+# Viewers that fall this far behind are dropped; they can rejoin and
+# catch up from a keyframe.
+MAX_BACKLOG: Final = 1 << 20
+# How long viewers have to take the end of a battle before being dropped
+FINISH_TIMEOUT: Final = 2
+
+Quantized = tuple[int, ...]
+Event = dict[str, Any]
+
+_HEADER: Final = struct.Struct('<BI')
+_DELTA_HEADER: Final = struct.Struct('<dH')
+_DELTA_ENTRY: Final = struct.Struct('<HB')
+
+
+class MessageKind(enum.IntEnum):
+    # The full state, as JSON, sent to each viewer when it joins
+    KEYFRAME = 1
+    # Changes to body transforms since the previous frame, in binary
+    DELTA = 2
+    # A list of battle events, as JSON
+    EVENTS = 3
+
+
+def quantize(transform: TransformState) -> Quantized:
+    quat = transform.get_quat()
+    if quat.get_r() < 0:
+        # q and -q are the same rotation; pick one so that deltas stay small.
+        quat = -quat
+    position = (round(c * POSITION_SCALE) for c in transform.get_pos())
+    rotation = (round(c * ROTATION_SCALE) for c in quat)
+    return (*position, *rotation)
+
+
+def dequantize(values: Quantized) -> TransformState:
+    position = LVecBase3(*(c / POSITION_SCALE for c in values[:3]))
+    rotation = LQuaternion(*(c / ROTATION_SCALE for c in values[3:]))
+    rotation.normalize()
+    return spatial.make_rigid_transform(rotation, position)
+
+
+def _write_varint(buffer: bytearray, value: int) -> None:
+    """Append a signed integer, zigzag- and LEB128-encoded."""
+    value = value * 2 if value >= 0 else -value * 2 - 1
+    while value >= 0x80:
+        buffer.append(value & 0x7F | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varint(data: bytes, offset: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            break
+    return (value >> 1) ^ -(value & 1), offset
+
+
+def encode_delta(
+    sim_time: float, changes: Iterable[tuple[int, Quantized, Quantized]]
+) -> bytes:
+    """Encode the changed components of each body's transform as
+    differences from its previous values.
+    """
+    changes = list(changes)
+    buffer = bytearray(_DELTA_HEADER.pack(sim_time, len(changes)))
+    for body_id, old, new in changes:
+        mask = 0
+        differences = []
+        for i, (a, b) in enumerate(zip(old, new)):
+            if a != b:
+                mask |= 1 << i
+                differences.append(b - a)
+        buffer += _DELTA_ENTRY.pack(body_id, mask)
+        for difference in differences:
+            _write_varint(buffer, difference)
+    return bytes(buffer)
+
+
+def apply_delta(payload: bytes, states: dict[int, Quantized]) -> float:
+    """Apply an encoded delta to the states in place and return its time."""
+    sim_time, count = _DELTA_HEADER.unpack_from(payload)
+    offset = _DELTA_HEADER.size
+    for _ in range(count):
+        body_id, mask = _DELTA_ENTRY.unpack_from(payload, offset)
+        offset += _DELTA_ENTRY.size
+        values = list(states[body_id])
+        for i in range(7):
+            if mask & 1 << i:
+                difference, offset = _read_varint(payload, offset)
+                values[i] += difference
+        states[body_id] = tuple(values)
+    return sim_time
+
+
+def encode_message(kind: MessageKind, payload: bytes) -> bytes:
+    return _HEADER.pack(kind, len(payload)) + payload
+
+
+def encode_json(kind: MessageKind, data: object) -> bytes:
+    return encode_message(kind, json.dumps(data, separators=(',', ':')).encode())
+
+
+@attrs.define
+class _Viewer:
+    sock: socket.socket
+    backlog: bytearray = field(factory=bytearray)
+
+    def flush(self) -> bool:
+        """Send as much of the backlog as possible without blocking, and
+        return whether the viewer is still connected.
+        """
+        try:
+            while self.backlog:
+                sent = self.sock.send(self.backlog)
+                del self.backlog[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            return False
+        return len(self.backlog) <= MAX_BACKLOG
+
+
+@attrs.define
+class Broadcaster:
+    """Send the state of an arena to any number of spectators.
+
+    Every `1 / rate` seconds, the transforms of the arena's tracked
+    bodies are quantized and sent as differences from the previous
+    frame, along with the battle events since then. Viewers joining
+    partway through get a keyframe of the current state first.
+    """
+
+    arena: arenas.Arena
+    fighters: Sequence[Fighter]
+    listener: socket.socket
+    rate: float = 20
+    running: bool = field(default=False, init=False)
+    viewers: list[_Viewer] = field(factory=list, init=False)
+    acceptor: DirectObject = field(factory=DirectObject, kw_only=True)
+    # The last state sent for each body, which every viewer shares
+    states: dict[int, Quantized] = field(factory=dict, init=False)
+    bodies: dict[int, dict[str, Any]] = field(factory=dict, init=False)
+    health: list[int] = field(factory=list, init=False)
+    _ids: dict[NodePath, int] = field(factory=dict, init=False, repr=False)
+    _next_id: int = field(default=0, init=False, repr=False)
+    _events: list[Event] = field(factory=list, init=False, repr=False)
+    # The model of the arena's static geometry as compressed BAM in base64,
+    # which is sent with every keyframe
+    _geometry: str | None = field(default=None, init=False, repr=False)
+
+    def __attrs_post_init__(self) -> None:
+        self.listener.setblocking(False)
+        self.health = [fighter.health for fighter in self.fighters]
+        self.acceptor.accept('output_info', self.add_info)
+        geometry = self.arena.geometry
+        if geometry is not None and geometry.model is not None:
+            data = zlib.compress(geometry.model.encode_to_bam_stream())
+            self._geometry = base64.b64encode(data).decode()
+
+    @classmethod
+    def listen(
+        cls,
+        arena: arenas.Arena,
+        fighters: Sequence[Fighter],
+        *,
+        host: str = '127.0.0.1',
+        port: int = DEFAULT_PORT,
+        rate: float = 20,
+    ) -> Self:
+        listener = socket.create_server((host, port))
+        _logger.info(f'Broadcasting to spectators on port {port}')
+        return cls(arena, fighters, listener, rate)
+
+    def start(self) -> None:
+        self.running = True
+        self.arena.task_group.add(self.run())
+
+    async def run(self) -> None:
+        while self.running:
+            self.accept_viewers()
+            self.broadcast()
+            await AsyncTaskPause(1 / self.rate)
+
+    def add_info(self, text: str) -> None:
+        self._events.append({'type': 'info', 'text': text})
+
+    def accept_viewers(self) -> None:
+        while select.select([self.listener], [], [], 0)[0]:
+            sock, address = self.listener.accept()
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            _logger.info(f'Spectator joined from {address}')
+            viewer = _Viewer(sock)
+            viewer.backlog += encode_json(MessageKind.KEYFRAME, self.keyframe())
+            self.viewers.append(viewer)
+
+    def keyframe(self) -> dict[str, Any]:
+        return {
+            'time': self.arena.sim_time,
+            'rate': self.rate,
+            'geometry': self._geometry,
+            'bodies': [
+                {**self.bodies[body_id], 'state': state}
+                for body_id, state in self.states.items()
+            ],
+            'fighters': [
+                {
+                    'name': fighter.name,
+                    'body': self._ids.get(fighter.skeleton.core),
+                    'health': health,
+                    'base_health': fighter.base_health,
+                }
+                for fighter, health in zip(self.fighters, self.health)
+            ],
+        }
+
+    def broadcast(self) -> None:
+        """Send the changes since the last broadcast to every viewer."""
+        snapshot = self.arena.snapshots[1]
+        events = self._events
+        self._events = []
+        changes: list[tuple[int, Quantized, Quantized]] = []
+        seen: set[int] = set()
+        for body, transform in snapshot.transforms.items():
+            state = quantize(transform)
+            proxy = self.arena.proxies.get(body)
+            # Bodies are hidden by hiding their proxies, e.g. by invisibility.
+            hidden = proxy is not None and proxy.is_hidden()
+            body_id = self._ids.get(body)
+            if body_id is None:
+                body_id = self._ids[body] = self._next_id
+                self._next_id += 1
+                self.bodies[body_id] = {
+                    'id': body_id,
+                    'name': body.name,
+                    'shapes': wireframes.describe_body(body.node()),
+                    'hidden': hidden,
+                }
+                self.states[body_id] = state
+                events.append({'type': 'spawn', 'state': state, **self.bodies[body_id]})
+            else:
+                if state != self.states[body_id]:
+                    changes.append((body_id, self.states[body_id], state))
+                    self.states[body_id] = state
+                if hidden != self.bodies[body_id]['hidden']:
+                    self.bodies[body_id]['hidden'] = hidden
+                    events.append(
+                        {'type': 'visibility', 'id': body_id, 'hidden': hidden}
+                    )
+            seen.add(body_id)
+        for body, body_id in tuple(self._ids.items()):
+            if body_id not in seen:
+                del self._ids[body], self.bodies[body_id], self.states[body_id]
+                events.append({'type': 'despawn', 'id': body_id})
+        for i, fighter in enumerate(self.fighters):
+            if fighter.health != self.health[i]:
+                self.health[i] = fighter.health
+                events.append(
+                    {'type': 'health', 'fighter': i, 'health': self.health[i]}
+                )
+        data = b''
+        if events:
+            data += encode_json(MessageKind.EVENTS, events)
+        data += encode_message(MessageKind.DELTA, encode_delta(snapshot.time, changes))
+        self.send(data)
+
+    def send(self, data: bytes) -> None:
+        connected: list[_Viewer] = []
+        for viewer in self.viewers:
+            viewer.backlog += data
+            if viewer.flush():
+                connected.append(viewer)
+            else:
+                _logger.info('Dropped a spectator')
+                viewer.sock.close()
+        self.viewers = connected
+
+    async def finish(self, result: str, *, timeout: float = FINISH_TIMEOUT) -> None:
+        """Tell viewers how the battle ended and stop broadcasting,
+        dropping those that haven't taken everything within `timeout`
+        seconds, or by the time this is cancelled.
+        """
+        self.running = False
+        self.add_info(result)
+        self._events.append({'type': 'end'})
+        self.broadcast()
+        self.listener.close()
+        self.acceptor.ignore_all()
+        deadline = time.monotonic() + timeout
+        try:
+            while self.viewers and time.monotonic() < deadline:
+                await AsyncTaskPause(0)
+                self.send(b'')
+                for viewer in [v for v in self.viewers if not v.backlog]:
+                    viewer.sock.close()
+                    self.viewers.remove(viewer)
+        finally:
+            for viewer in self.viewers:
+                _logger.info('Dropped a slow spectator')
+                viewer.sock.close()
+            self.viewers.clear()
+
+
+@attrs.define
+class SpectatorState:
+    """The state of a broadcast battle, rebuilt from the messages sent by
+    a `Broadcaster`.
+    """
+
+    time: float = 0
+    rate: float = 20
+    # The arena's static geometry, as sent by `Broadcaster`
+    geometry: str | None = None
+    bodies: dict[int, dict[str, Any]] = field(factory=dict)
+    states: dict[int, Quantized] = field(factory=dict)
+    fighters: list[dict[str, Any]] = field(factory=list)
+    synced: bool = False
+    ended: bool = False
+
+    def apply(self, kind: MessageKind, payload: bytes) -> list[Event]:
+        """Apply a message and return the events it contained."""
+        if kind is MessageKind.KEYFRAME:
+            data = json.loads(payload)
+            self.time = data['time']
+            self.rate = data['rate']
+            self.geometry = data['geometry']
+            self.bodies.clear()
+            self.states.clear()
+            for body in data['bodies']:
+                self.bodies[body['id']] = body
+                self.states[body['id']] = tuple(body['state'])
+            self.fighters = data['fighters']
+            self.synced = True
+            return []
+        if not self.synced:
+            return []
+        if kind is MessageKind.DELTA:
+            self.time = apply_delta(payload, self.states)
+            return []
+        events: list[Event] = json.loads(payload)
+        for event in events:
+            if event['type'] == 'spawn':
+                self.bodies[event['id']] = event
+                self.states[event['id']] = tuple(event['state'])
+            elif event['type'] == 'despawn':
+                del self.bodies[event['id']], self.states[event['id']]
+            elif event['type'] == 'visibility':
+                self.bodies[event['id']]['hidden'] = event['hidden']
+            elif event['type'] == 'health':
+                self.fighters[event['fighter']]['health'] = event['health']
+            elif event['type'] == 'end':
+                self.ended = True
+        return events
+
+
+@attrs.define
+class SpectatorConnection:
+    sock: socket.socket
+    closed: bool = field(default=False, init=False)
+    _buffer: bytes = field(default=b'', init=False, repr=False)
+
+    @classmethod
+    def connect(cls, host: str = '127.0.0.1', port: int = DEFAULT_PORT) -> Self:
+        return cls(socket.create_connection((host, port), timeout=10))
+
+    def poll(self) -> list[tuple[MessageKind, bytes]]:
+        """Return the messages that have arrived, without blocking."""
+        while not self.closed and select.select([self.sock], [], [], 0)[0]:
+            data = self.sock.recv(1 << 16)
+            if not data:
+                self.closed = True
+            self._buffer += data
+        messages: list[tuple[MessageKind, bytes]] = []
+        offset = 0
+        while len(self._buffer) - offset >= _HEADER.size:
+            kind, length = _HEADER.unpack_from(self._buffer, offset)
+            end = offset + _HEADER.size + length
+            if end > len(self._buffer):
+                break
+            messages.append((MessageKind(kind), self._buffer[end - length : end]))
+            offset = end
+        self._buffer = self._buffer[offset:]
+        return messages
+
+
+@attrs.define
+class Viewer:
+    """Show a broadcast battle without simulating it.
+
+    Bodies are drawn as wireframes and moved between the last two frames
+    received, so motion stays smooth at any broadcast rate. The arena's
+    static geometry is drawn from the model sent with keyframes.
+    """
+
+    base: ShowBase
+    connection: SpectatorConnection
+    state: SpectatorState = field(factory=SpectatorState)
+    root: NodePath = field(init=False)
+    scenery: NodePath | None = field(default=None, init=False)
+    nodes: dict[int, NodePath] = field(factory=dict, init=False)
+    previous: dict[int, TransformState] = field(factory=dict, init=False)
+    current: dict[int, TransformState] = field(factory=dict, init=False)
+    hud: OnscreenText = field(init=False)
+    info: collections.deque[str] = field(
+        factory=lambda: collections.deque(maxlen=6), init=False
+    )
+    _frame_time: float = field(default=0, init=False, repr=False)
+
+    def __attrs_post_init__(self) -> None:
+        self.root = self.base.render.attach_new_node('Spectator Root')
+        self.hud = OnscreenText(
+            pos=(-1.3, 0.9), scale=0.05, align=TextNode.A_left, mayChange=True
+        )
+
+    async def run(self) -> None:
+        while not self.connection.closed:
+            for kind, payload in self.connection.poll():
+                self.handle(kind, payload)
+            self.present()
+            await AsyncTaskPause(0)
+        self.info.append('The broadcast has ended')
+        self.update_hud()
+
+    def handle(self, kind: MessageKind, payload: bytes) -> None:
+        events = self.state.apply(kind, payload)
+        if kind is MessageKind.KEYFRAME:
+            for node in self.nodes.values():
+                node.remove_node()
+            self.nodes.clear()
+            self.current.clear()
+            for body_id in self.state.bodies:
+                self.add_body(body_id)
+            self.show_geometry()
+        elif kind is MessageKind.DELTA:
+            self.previous = self.current
+            self.current = {
+                body_id: dequantize(state)
+                for body_id, state in self.state.states.items()
+            }
+            self._frame_time = ClockObject.get_global_clock().frame_time
+        for event in events:
+            if event['type'] == 'spawn':
+                self.add_body(event['id'])
+            elif event['type'] == 'despawn':
+                self.nodes.pop(event['id']).remove_node()
+            elif event['type'] == 'visibility':
+                self.show_body(event['id'])
+            elif event['type'] == 'info':
+                self.info.append(event['text'])
+        if events or kind is MessageKind.KEYFRAME:
+            self.update_hud()
+
+    def show_geometry(self) -> None:
+        if self.scenery is not None:
+            self.scenery.remove_node()
+            self.scenery = None
+        if self.state.geometry is not None:
+            data = zlib.decompress(base64.b64decode(self.state.geometry))
+            self.scenery = NodePath.decode_from_bam_stream(data)
+            self.scenery.reparent_to(self.root)
+
+    def add_body(self, body_id: int) -> None:
+        body = self.state.bodies[body_id]
+        node = wireframes.draw_body(body['shapes'])
+        node.reparent_to(self.root)
+        node.name = body['name']
+        transform = dequantize(self.state.states[body_id])
+        node.set_transform(transform)
+        self.nodes[body_id] = node
+        self.current[body_id] = transform
+        self.show_body(body_id)
+
+    def show_body(self, body_id: int) -> None:
+        """Show or hide a body's node, as it is in the arena."""
+        if self.state.bodies[body_id].get('hidden'):
+            self.nodes[body_id].hide()
+        else:
+            self.nodes[body_id].show()
+
+    def present(self) -> None:
+        elapsed = ClockObject.get_global_clock().frame_time - self._frame_time
+        fraction = min(elapsed * self.state.rate, 1)
+        for body_id, transform in self.current.items():
+            node = self.nodes.get(body_id)
+            if node is None:
+                continue
+            prior = self.previous.get(body_id)
+            if prior is not None and fraction < 1:
+                transform = spatial.interpolate_transforms(prior, transform, fraction)
+            node.set_transform(transform)
+
+    def update_hud(self) -> None:
+        lines = [
+            f'{fighter["name"]}: {max(fighter["health"], 0)}/{fighter["base_health"]}'
+            for fighter in self.state.fighters
+        ]
+        self.hud.text = '\n'.join([*lines, '', *self.info])
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.set_defaults(command=watch)
+    parser.add_argument('address', nargs='?', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+
+
+def watch(args: argparse.Namespace) -> None:
+    """Watch a battle broadcast by `python -m joat play --broadcast`."""
+    base = ShowBase()
+    base.cam.set_pos(10 * math.cos(1.2 * math.pi), 10 * math.sin(1.2 * math.pi), 3)
+    base.cam.look_at(0, 0, 0)
+    viewer = Viewer(base, SpectatorConnection.connect(args.address, args.port))
+    tasks.add_task(viewer.run())
+    base.run()
@@ -0,0 +1,556 @@
+from __future__ import annotations
+
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import random
+import time
+from collections.abc import Iterable, Mapping, Sequence
+from pathlib import Path
+from typing import Any, Final
+from typing_extensions import Self
+
+import attrs
+from attrs import field
+
+from . import content, headless, moves
+from .characters import Action, Character, Fighter
+from .hitmaps import Placement
+from .providers import ActionProvider, RandomProvider, needs_pointer
+
+_logger: Final = logging.getLogger(__name__)
+
+DEFAULT_PATH: Final = Path('.cache', 'surrogate.json')
+# Upper edges of the distance bins; anything farther is in the last bin
+DISTANCE_EDGES: Final = (0.8, 1.2, 1.6, 2.4)
+# Observations needed before a key is trusted over a coarser one
+MIN_OBSERVATIONS: Final = 5
+FIT_SEED: Final = 1_000_000
+REPORT_SEED: Final = 2_000_000
+
+
+@attrs.frozen
+class TurnSample:
+    """The damage done to each fighter over one turn of a battle,
+    including any status effects that took hold during it. Attackers can
+    be hurt by their own moves, or by hitting the defender.
+    """
+
+    move: str
+    speed: int
+    strength: int
+    defense: int
+    # Between the fighters' cores, at the start and at the end of the turn
+    distance: float
+    end_distance: float
+    damage: int
+    recoil: int
+    duration: float
+    # The index of the turn in its battle
+    turn: int
+
+
+def distance_bin(distance: float) -> int:
+    return bisect.bisect_left(DISTANCE_EDGES, distance)
+
+
+def _keys(
+    move: str, speed: int, strength: int, defense: int, bin_index: int
+) -> tuple[str, ...]:
+    """Return the keys for a turn's features, from most to least specific."""
+    return (
+        f'{move}|{speed}|{strength}|{defense}|{bin_index}',
+        f'{move}|*|{strength}|{defense}|{bin_index}',
+        f'{move}|*|*|*|{bin_index}',
+        f'{move}|*|*|*|*',
+    )
+
+
+def _transition_keys(move: str, bin_index: int) -> tuple[str, ...]:
+    return f'{move}|{bin_index}', f'{move}|*'
+
+
+@attrs.define
+class TurnLogger:
+    """Record a `TurnSample` for every turn of a headless battle.
+
+    Use `make_provider` as both provider factories of the battle.
+    """
+
+    samples: list[TurnSample] = field(factory=list)
+    fighters: list[Fighter] = field(factory=list, init=False)
+    _open: tuple[Fighter, Action, float, tuple[int, int], float] | None = field(
+        default=None, init=False, repr=False
+    )
+
+    def make_provider(self, fighter: Fighter, rng: random.Random) -> ActionProvider:
+        self.fighters.append(fighter)
+        return _LoggingProvider(self, fighter, RandomProvider.for_fighter(fighter, rng))
+
+    def opponent_of(self, fighter: Fighter) -> Fighter:
+        return self.fighters[1 - self.fighters.index(fighter)]
+
+    def begin(self, fighter: Fighter, action: Action) -> None:
+        self.end()
+        assert fighter.arena is not None
+        opponent = self.opponent_of(fighter)
+        distance = Placement.between(fighter, opponent).distance
+        start_time = fighter.arena.sim_time
+        health = fighter.health, opponent.health
+        self._open = (fighter, action, distance, health, start_time)
+
+    def end(self, sim_time: float | None = None) -> None:
+        """Close the current turn, if there is one."""
+        if self._open is None:
+            return
+        fighter, action, distance, health, start_time = self._open
+        self._open = None
+        opponent = self.opponent_of(fighter)
+        if sim_time is None:
+            assert fighter.arena is not None
+            sim_time = fighter.arena.sim_time
+        self.samples.append(
+            TurnSample(
+                action.name,
+                fighter.speed,
+                fighter.strength,
+                opponent.defense,
+                distance,
+                Placement.between(fighter, opponent).distance,
+                health[1] - opponent.health,
+                health[0] - fighter.health,
+                sim_time - start_time,
+                len(self.samples),
+            )
+        )
+
+
+@attrs.define
+class _LoggingProvider:
+    logger: TurnLogger
+    fighter: Fighter
+    provider: ActionProvider
+
+    async def query_action(self) -> tuple[Action, moves.Target]:
+        action, target = await self.provider.query_action()
+        self.logger.begin(self.fighter, action)
+        return action, target
+
+
+def collect_samples(
+    character_1: Character, character_2: Character, *, seed: int, max_turns: int
+) -> tuple[headless.BattleResult, list[TurnSample]]:
+    """Run a headless battle and return its result and turns."""
+    logger = TurnLogger()
+    result = headless.run_battle(
+        character_1,
+        character_2,
+        seed=seed,
+        max_turns=max_turns,
+        provider_factories=(logger.make_provider, logger.make_provider),
+    )
+    logger.end(result.sim_time)
+    return result, logger.samples
+
+
+@attrs.define
+class Histogram:
+    values: list[Any]
+    cumulative_weights: list[int]
+
+    @classmethod
+    def from_counts(cls, counts: Mapping[Any, int]) -> Self:
+        values = sorted(counts)
+        return cls(values, list(itertools.accumulate(counts[v] for v in values)))
+
+    @property
+    def total(self) -> int:
+        return self.cumulative_weights[-1]
+
+    def sample(self, rng: random.Random) -> Any:
+        x = rng.random() * self.cumulative_weights[-1]
+        return self.values[bisect.bisect_right(self.cumulative_weights, x)]
+
+
+@attrs.define
+class SurrogateModel:
+    """A physics-free model of battles between random bots, fit to the
+    turns of headless battles.
+
+    The damage of a turn to both fighters is drawn from the observed
+    damage of the same move with the same attacker stats, defender defense
+    and distance, backing off to less specific observations when there are
+    too few of them. Attackers defeated by the damage they take lose the
+    battle, like defenders do.
+
+    The distance between the fighters is carried through the battle. It
+    starts in a bin that battles were seen to start in, and after each
+    turn moves to a bin seen at the end of turns of the same move that
+    started in the same bin.
+    """
+
+    # Maps feature keys to histograms of (damage, recoil) pairs
+    damage: dict[str, Histogram]
+    # Maps a move and the distance bin at the start of a turn, or `*` for
+    # any bin, to a histogram of the bin at its end
+    transitions: dict[str, Histogram]
+    # The distance bins that battles started in
+    starts: Histogram
+    # Maps move names to their mean duration in simulated seconds
+    durations: dict[str, float]
+    content_hash: str = ''
+
+    @classmethod
+    def fit(cls, samples: Iterable[TurnSample], *, content_hash: str = '') -> Self:
+        damage_counts: dict[str, collections.Counter[tuple[int, int]]] = {}
+        transition_counts: dict[str, collections.Counter[int]] = {}
+        start_counts: collections.Counter[int] = collections.Counter()
+        durations: dict[str, list[float]] = {}
+        for sample in samples:
+            bin_index = distance_bin(sample.distance)
+            if sample.turn == 0:
+                start_counts[bin_index] += 1
+            for key in _transition_keys(sample.move, bin_index):
+                counter = transition_counts.setdefault(key, collections.Counter())
+                counter[distance_bin(sample.end_distance)] += 1
+            durations.setdefault(sample.move, []).append(sample.duration)
+            for key in _keys(
+                sample.move, sample.speed, sample.strength, sample.defense, bin_index
+            ):
+                counter = damage_counts.setdefault(key, collections.Counter())
+                counter[sample.damage, sample.recoil] += 1
+        return cls(
+            {k: Histogram.from_counts(c) for k, c in damage_counts.items()},
+            {k: Histogram.from_counts(c) for k, c in transition_counts.items()},
+            Histogram.from_counts(start_counts),
+            {k: sum(v) / len(v) for k, v in durations.items()},
+            content_hash,
+        )
+
+    @classmethod
+    def load(cls, path: Path = DEFAULT_PATH) -> Self:
+        data = json.loads(path.read_text())
+
+        def histograms(d: dict[str, Any]) -> dict[str, Histogram]:
+            return {key: Histogram(*value) for key, value in d.items()}
+
+        damage = histograms(data['damage'])
+        for histogram in damage.values():
+            histogram.values = [tuple(pair) for pair in histogram.values]
+        return cls(
+            damage,
+            histograms(data['transitions']),
+            Histogram(*data['starts']),
+            data['durations'],
+            data['content_hash'],
+        )
+
+    def save(self, path: Path = DEFAULT_PATH) -> None:
+        def histograms(d: dict[str, Histogram]) -> dict[str, Any]:
+            return {k: [h.values, h.cumulative_weights] for k, h in d.items()}
+
+        data = {
+            'content_hash': self.content_hash,
+            'damage': histograms(self.damage),
+            'transitions': histograms(self.transitions),
+            'starts': [self.starts.values, self.starts.cumulative_weights],
+            'durations': self.durations,
+        }
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(data))
+
+    def knows(self, move: str) -> bool:
+        return f'{move}|*' in self.transitions
+
+    def damage_histogram(
+        self, move: str, attacker: Character, defender: Character, bin_index: int
+    ) -> Histogram | None:
+        histogram = None
+        keys = _keys(
+            move, attacker.speed, attacker.strength, defender.defense, bin_index
+        )
+        for key in keys:
+            histogram = self.damage.get(key)
+            if histogram is not None and histogram.total >= MIN_OBSERVATIONS:
+                break
+        return histogram
+
+    def transition_histogram(self, move: str, bin_index: int) -> Histogram:
+        histogram = None
+        for key in _transition_keys(move, bin_index):
+            histogram = self.transitions.get(key)
+            if histogram is not None and histogram.total >= MIN_OBSERVATIONS:
+                break
+        assert histogram is not None
+        return histogram
+
+    def sample_turn(
+        self,
+        move: str,
+        attacker: Character,
+        defender: Character,
+        bin_index: int,
+        rng: random.Random,
+    ) -> tuple[int, int, float, int]:
+        """Return the damage dealt to the defender and the attacker, the
+        time taken and the distance bin at the end of a random turn
+        starting in the given distance bin.
+        """
+        histogram = self.damage_histogram(move, attacker, defender, bin_index)
+        assert histogram is not None
+        damage, recoil = histogram.sample(rng)
+        next_bin = self.transition_histogram(move, bin_index).sample(rng)
+        return damage, recoil, self.durations[move], next_bin
+
+    def run_battle(
+        self,
+        character_1: Character,
+        character_2: Character,
+        *,
+        seed: int = 0,
+        max_turns: int = 100,
+    ) -> headless.BattleResult:
+        """Predict a battle between random bots like `headless.run_battle`,
+        without simulating any physics.
+        """
+        rng = random.Random(seed)
+        characters = [character_1, character_2]
+        order = [0, 1]
+        if character_2.speed > character_1.speed:
+            order.reverse()
+        available_moves = [
+            [
+                move.name
+                for move in characters[i].moves
+                if not needs_pointer(move) and self.knows(move.name)
+            ]
+            for i in order
+        ]
+        if not all(available_moves):
+            raise ValueError('The model has not seen any usable moves for a fighter')
+        bins = range(len(DISTANCE_EDGES) + 1)
+        # Look up the histograms for each move and distance ahead of time,
+        # since they don't change during the battle.
+        transitions = {
+            move: [self.transition_histogram(move, bin_index) for bin_index in bins]
+            for move in itertools.chain(*available_moves)
+        }
+        tables = [
+            {
+                move: [
+                    self.damage_histogram(move, attacker, defender, bin_index)
+                    for bin_index in bins
+                ]
+                for move in names
+            }
+            for names, attacker, defender in (
+                (available_moves[0], characters[order[0]], characters[order[1]]),
+                (available_moves[1], characters[order[1]], characters[order[0]]),
+            )
+        ]
+        health = [characters[i].health for i in order]
+        sim_time = 0.0
+        winner: int | None = None
+        turns = 0
+        i = 0
+        bin_index = self.starts.sample(rng)
+        while turns < max_turns:
+            move = rng.choice(available_moves[i])
+            histogram = tables[i][move][bin_index]
+            assert histogram is not None
+            damage, recoil = histogram.sample(rng)
+            bin_index = transitions[move][bin_index].sample(rng)
+            duration = self.durations[move]
+            health[1 - i] -= damage
+            health[i] -= recoil
+            sim_time += duration
+            turns += 1
+            if health[i] <= 0 or health[1 - i] <= 0:
+                # Attackers can defeat themselves with their own moves, and
+                # the battle is a draw if they take the defender with them.
+                if health[i] > 0:
+                    winner = order[i]
+                elif health[1 - i] > 0:
+                    winner = order[1 - i]
+                break
+            i = 1 - i
+        final_health = [0, 0]
+        for j, index in enumerate(order):
+            final_health[index] = health[j]
+        return headless.BattleResult(
+            seed=seed,
+            winner=winner,
+            turns=turns,
+            health=(final_health[0], final_health[1]),
+            sim_time=sim_time,
+        )
+
+
+def pack_hash(pack: content.ContentPack, names: Iterable[str]) -> str:
+    return content.hash_bytes(*(pack.character_hash(name).encode() for name in names))
+
+
+def _collect_batch(
+    name_1: str, name_2: str, seeds: Sequence[int], max_turns: int
+) -> list[tuple[headless.BattleResult, list[TurnSample]]]:
+    pack = headless.get_worker_pack()
+    return [
+        collect_samples(
+            pack.characters[name_1],
+            pack.characters[name_2],
+            seed=seed,
+            max_turns=max_turns,
+        )
+        for seed in seeds
+    ]
+
+
+def run_headless_battles(
+    pack: content.ContentPack,
+    names: Sequence[str],
+    *,
+    battles: int,
+    first_seed: int,
+    max_turns: int = 100,
+    workers: int | None = None,
+) -> dict[tuple[str, str], list[tuple[headless.BattleResult, list[TurnSample]]]]:
+    """Run logged headless battles between every pair of characters."""
+    pairs = list(itertools.combinations(names, 2))
+    seeds = range(first_seed, first_seed + battles)
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, initializer=headless.init_worker, initargs=(pack.root,)
+    ) as executor:
+        futures = {
+            pair: executor.submit(_collect_batch, *pair, seeds, max_turns)
+            for pair in pairs
+        }
+        return {pair: future.result() for pair, future in futures.items()}
+
+
+def calibration_report(
+    model: SurrogateModel,
+    pack: content.ContentPack,
+    names: Sequence[str],
+    *,
+    battles: int,
+    max_turns: int = 100,
+    workers: int | None = None,
+) -> str:
+    """Compare the model's predictions with new headless battles."""
+    simulated = run_headless_battles(
+        pack,
+        names,
+        battles=battles,
+        first_seed=REPORT_SEED,
+        max_turns=max_turns,
+        workers=workers,
+    )
+    rows = [('pair', 'win rate', 'turns', 'health lead', 'time per battle')]
+    for (name_1, name_2), entries in simulated.items():
+        real = [result for result, _ in entries]
+        start = time.perf_counter()
+        predicted = [
+            model.run_battle(
+                pack.characters[name_1],
+                pack.characters[name_2],
+                seed=seed,
+                max_turns=max_turns,
+            )
+            for seed in range(battles * 10)
+        ]
+        elapsed = (time.perf_counter() - start) / len(predicted)
+        real_stats = _summarize(real)
+        predicted_stats = _summarize(predicted)
+        rows.append(
+            (
+                f'{name_1} vs. {name_2}',
+                f'{predicted_stats[0]:.0%} (real {real_stats[0]:.0%})',
+                f'{predicted_stats[1]:.1f} (real {real_stats[1]:.1f})',
+                f'{predicted_stats[2]:.0f} (real {real_stats[2]:.0f})',
+                f'{elapsed * 1e6:.0f}us',
+            )
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join(
+        '  '.join(entry.ljust(width) for entry, width in zip(row, widths))
+        for row in rows
+    )
+
+
+def _summarize(results: Sequence[headless.BattleResult]) -> tuple[float, float, float]:
+    """Return the first character's win rate (counting draws as half a
+    win), the mean number of turns and the mean health difference.
+    """
+    n = len(results)
+    score = sum(0.5 if r.winner is None else 1 - r.winner for r in results)
+    turns = sum(r.turns for r in results)
+    health = sum(r.health[0] - r.health[1] for r in results)
+    return score / n, turns / n, health / n
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    subparsers = parser.add_subparsers(required=True)
+    fit_parser = subparsers.add_parser('fit', help='fit a model to new battles')
+    fit_parser.set_defaults(command=fit)
+    report_parser = subparsers.add_parser(
+        'report', help='compare a fitted model with new battles'
+    )
+    report_parser.set_defaults(command=report)
+    for subparser in (fit_parser, report_parser):
+        subparser.add_argument(
+            'characters',
+            nargs='*',
+            help='the characters to include (by default, all of them)',
+        )
+        subparser.add_argument('--battles', type=int, default=20, help='per pair')
+        subparser.add_argument('--max-turns', type=int, default=100)
+        subparser.add_argument('--data-dir', type=Path, default=content.DATA_DIR)
+        subparser.add_argument('--model', type=Path, default=DEFAULT_PATH)
+        subparser.add_argument('--workers', type=int, default=os.cpu_count())
+
+
+def fit(args: argparse.Namespace) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    pack = content.ContentPack.load(args.data_dir)
+    names = args.characters or list(pack.characters)
+    simulated = run_headless_battles(
+        pack,
+        names,
+        battles=args.battles,
+        first_seed=FIT_SEED,
+        max_turns=args.max_turns,
+        workers=args.workers,
+    )
+    samples = [
+        sample
+        for entries in simulated.values()
+        for _, battle_samples in entries
+        for sample in battle_samples
+    ]
+    model = SurrogateModel.fit(samples, content_hash=pack_hash(pack, names))
+    model.save(args.model)
+    print(f'Fit a model to {len(samples)} turns and saved it to {args.model}')
+
+
+def report(args: argparse.Namespace) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    pack = content.ContentPack.load(args.data_dir)
+    names = args.characters or list(pack.characters)
+    model = SurrogateModel.load(args.model)
+    if model.content_hash != pack_hash(pack, names):
+        _logger.warning('The model was fit to different content')
+    print(
+        calibration_report(
+            model,
+            pack,
+            names,
+            battles=args.battles,
+            max_turns=args.max_turns,
+            workers=args.workers,
+        )
+    )
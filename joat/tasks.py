@@ -1,12 +1,215 @@
-from collections.abc import Coroutine
-from typing import Any, Final
+from __future__ import annotations
 
-from panda3d.core import AsyncTask, AsyncTaskManager, PythonTask
+import contextlib
+import functools
+import inspect
+import logging
+import time
+from collections import Counter
+from collections.abc import Callable, Coroutine, Generator, Iterator
+from contextlib import AbstractContextManager
+from contextvars import ContextVar
+from typing import Any, Final, TypeVar
+
+import attrs
+from attrs import field
+from panda3d.core import AsyncTask, AsyncTaskChain, AsyncTaskManager, PythonTask
+
+_logger: Final = logging.getLogger(__name__)
 
 TASK_MANAGER: Final = AsyncTaskManager.get_global_ptr()
+PHYSICS_CHAIN: Final = 'physics'
+LOADING_CHAIN: Final = 'loading'
+
+T = TypeVar('T')
+TaskFunction = Callable[[AsyncTask], int]
+
+# The group whose task is running on this thread, if any
+_running_group: ContextVar[TaskGroup | None] = ContextVar('running_group', default=None)
 
 
-def add_task(task: AsyncTask | Coroutine[Any, None, object]) -> None:
+def add_task(
+    task: AsyncTask | Coroutine[Any, None, object] | TaskFunction,
+    *,
+    chain: str | None = None,
+) -> AsyncTask:
     if not isinstance(task, AsyncTask):
         task, task.name = PythonTask(task), task.__qualname__
+    if chain is not None:
+        task.set_task_chain(chain)
+    group = _running_group.get()
+    if group is not None:
+        group.started.append(task)
     TASK_MANAGER.add(task)
+    return task
+
+
+def make_thread_chain(name: str, *, num_threads: int = 1) -> AsyncTaskChain:
+    """Return a task chain whose tasks run on threads of their own,
+    independently of the frame rate.
+    """
+    chain = TASK_MANAGER.make_task_chain(name)
+    chain.set_num_threads(num_threads)
+    chain.set_frame_sync(False)
+    return chain
+
+
+async def run_on_chain(
+    function: Callable[..., T], *args: object, chain: str = LOADING_CHAIN
+) -> T:
+    """Call a function in a task on some chain, such as one made by
+    `make_thread_chain`, and return its result.
+    """
+
+    async def call() -> T:
+        return function(*args)
+
+    task = add_task(call(), chain=chain)
+    await task
+    # Awaiting a task would only give the first element of a tuple.
+    return task.result()
+
+
+def _step_coroutine(
+    coroutine: Coroutine[Any, Any, object],
+    step: Callable[[], AbstractContextManager[object]],
+) -> Generator[Any, Any, object]:
+    """Drive a coroutine, running each step of it within a `step()`
+    context. Closing the generator closes the coroutine.
+    """
+    value: Any = None
+    error: BaseException | None = None
+    while True:
+        try:
+            with step():
+                if error is None:
+                    awaited = coroutine.send(value)
+                else:
+                    awaited = coroutine.throw(error)
+        except StopIteration as e:
+            return e.value
+        value = error = None
+        try:
+            value = yield awaited
+        except GeneratorExit:
+            coroutine.close()
+            raise
+        except BaseException as e:
+            error = e
+
+
+@attrs.define(eq=False)
+class TaskGroup:
+    """Tasks that belong to something, like an arena or a battle, and are
+    cancelled along with it. The CPU time taken by the group's tasks is
+    added up by task name in `cpu_times`.
+
+    Tasks that the group's tasks start with `add_task` are kept in
+    `started`, so that those still running once the group is closed can
+    be reported by `leaked`.
+    """
+
+    name: str
+    cpu_times: Counter[str] = field(factory=Counter, init=False)
+    closed: bool = field(default=False, init=False)
+    started: list[AsyncTask] = field(factory=list, init=False, repr=False)
+    # Each task with the generator driving it, if it's a coroutine
+    _tasks: list[tuple[AsyncTask, Generator[Any, Any, object] | None]] = field(
+        factory=list, init=False, repr=False
+    )
+
+    def add(
+        self,
+        task: Coroutine[Any, None, object] | TaskFunction,
+        *,
+        chain: str | None = None,
+    ) -> AsyncTask:
+        if self.closed:
+            raise RuntimeError(f'The task group {self.name!r} is closed')
+        name = task.__qualname__
+        step = functools.partial(self._step, name)
+        generator = None
+        if inspect.iscoroutine(task):
+            generator = _step_coroutine(task, step)
+            python_task = PythonTask(generator, name)
+        else:
+            function = task
+
+            def stepped(task: AsyncTask) -> int:
+                with step():
+                    return function(task)
+
+            python_task = PythonTask(stepped, name)
+        if chain is not None:
+            python_task.set_task_chain(chain)
+        self._tasks = [entry for entry in self._tasks if not entry[0].done()]
+        self._tasks.append((python_task, generator))
+        self.started = [task for task in self.started if not task.done()]
+        TASK_MANAGER.add(python_task)
+        return python_task
+
+    @contextlib.contextmanager
+    def _step(self, name: str) -> Iterator[None]:
+        """Run a step of one of the group's tasks, timing it."""
+        token = _running_group.set(self)
+        start = time.thread_time()
+        try:
+            yield
+        finally:
+            self.cpu_times[name] += time.thread_time() - start
+            _running_group.reset(token)
+
+    def running(self) -> list[AsyncTask]:
+        return [task for task, _ in self._tasks if not task.done()]
+
+    def cancel(self, task: AsyncTask) -> bool:
+        """Stop a task of the group if it's still running, running the
+        `finally` blocks of a coroutine, and return whether it was.
+        """
+        for i, (other, generator) in enumerate(self._tasks):
+            if other is task:
+                del self._tasks[i]
+                return _stop(task, generator)
+        return False
+
+    def close(self) -> list[str]:
+        """Cancel every task still running and return their names.
+
+        A task can close its own group, in which case it keeps running.
+        """
+        self.closed = True
+        cancelled = [
+            task.name for task, generator in self._tasks if _stop(task, generator)
+        ]
+        self._tasks.clear()
+        if cancelled:
+            _logger.debug(f'Cancelled in {self.name}: {", ".join(cancelled)}')
+        return cancelled
+
+    def leaked(self) -> list[str]:
+        """Return the names of the tasks started by the group's tasks with
+        `add_task` that are still running. Cancelled tasks that were
+        waiting on something only finish on the next poll.
+        """
+        return [task.name for task in self.started if not task.done()]
+
+    def report(self) -> str:
+        """Return the number of running tasks and the CPU time taken by
+        each kind of task, most first.
+        """
+        lines = [f'{self.name}: {len(self.running())} running']
+        for name, seconds in self.cpu_times.most_common():
+            lines.append(f'  {name}: {seconds * 1000:.1f}ms')
+        return '\n'.join(lines)
+
+
+def _stop(task: AsyncTask, generator: Generator[Any, Any, object] | None) -> bool:
+    if task.done():
+        return False
+    if generator is not None and generator.gi_running:
+        # Closing a generator from within it is an error.
+        return False
+    task.remove()
+    if generator is not None:
+        generator.close()
+    return True
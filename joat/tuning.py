@@ -0,0 +1,375 @@
+from __future__ import annotations
+
+import argparse
+import concurrent.futures
+import copy
+import json
+import logging
+import math
+import os
+import random
+from collections.abc import Iterable, Mapping, Sequence
+from pathlib import Path
+from typing import Any, Final
+from typing_extensions import Self
+
+import attrs
+
+from . import balance, content, headless
+from .characters import Character
+
+_logger: Final = logging.getLogger(__name__)
+
+STATS: Final = ('health', 'speed', 'strength', 'defense')
+MEASURE_PREFIX: Final = 'measures.'
+DEFAULT_OUTPUT_DIR: Final = Path('.cache', 'tuning')
+
+Point = Mapping[str, float]
+
+
+@attrs.frozen
+class Parameter:
+    """A character stat or skeleton measure to search over, such as
+    `speed` or `measures.arm_length`.
+    """
+
+    name: str
+    low: float
+    high: float
+
+    @classmethod
+    def parse(cls, spec: str) -> Self:
+        """Parse a parameter from a string of the form `name=low:high`."""
+        name, _, bounds = spec.partition('=')
+        low, _, high = bounds.partition(':')
+        if name not in STATS and not name.startswith(MEASURE_PREFIX):
+            raise ValueError(f'Unknown parameter {name!r}')
+        if not low or not high or float(low) > float(high):
+            raise ValueError(f'Invalid bounds for {name!r}: {bounds!r}')
+        return cls(name, float(low), float(high))
+
+    @property
+    def is_integer(self) -> bool:
+        return self.name in STATS
+
+    def sample(self, rng: random.Random) -> float:
+        if self.is_integer:
+            return rng.randint(math.ceil(self.low), math.floor(self.high))
+        return rng.uniform(self.low, self.high)
+
+
+@attrs.frozen
+class Target:
+    """The performance that tuning aims for against the reference roster.
+
+    `damage` is the average damage the tuned character deals per battle.
+    """
+
+    win_rate: float | None = None
+    damage: float | None = None
+
+    def loss(self, win_rate: float, damage: float) -> float:
+        loss = 0.0
+        if self.win_rate is not None:
+            loss += (win_rate - self.win_rate) ** 2
+        if self.damage is not None:
+            loss += ((damage - self.damage) / max(self.damage, 1)) ** 2
+        return loss
+
+
+def get_skeleton_params(character: Character) -> dict[str, dict[str, Any]]:
+    if character.skeleton_params is None:
+        return content.load_skeleton()
+    return character.skeleton_params
+
+
+def get_point(
+    character: Character, parameters: Iterable[Parameter]
+) -> dict[str, float]:
+    """Return the current values of the parameters for a character."""
+    skeleton_params = get_skeleton_params(character)
+    point: dict[str, float] = {}
+    for parameter in parameters:
+        if parameter.is_integer:
+            point[parameter.name] = getattr(character, parameter.name)
+        else:
+            measure = parameter.name.removeprefix(MEASURE_PREFIX)
+            point[parameter.name] = skeleton_params['measures'][measure]
+    return point
+
+
+def apply_point(character: Character, point: Point) -> Character:
+    """Return a copy of the character with the given parameter values."""
+    skeleton_params = copy.deepcopy(get_skeleton_params(character))
+    stats: dict[str, int] = {}
+    for name, value in point.items():
+        if name in STATS:
+            stats[name] = round(value)
+        else:
+            skeleton_params['measures'][name.removeprefix(MEASURE_PREFIX)] = value
+    return attrs.evolve(character, **stats, skeleton_params=skeleton_params)
+
+
+def point_key(point: Point) -> str:
+    return json.dumps(point, sort_keys=True)
+
+
+def _run_point_batch(
+    name: str,
+    point: Point,
+    opponent: str,
+    seeds: Sequence[int],
+    max_turns: int,
+) -> list[headless.BattleResult]:
+    pack = headless.get_worker_pack()
+    character = apply_point(pack.characters[name], point)
+    return [
+        headless.run_battle(
+            character, pack.characters[opponent], seed=seed, max_turns=max_turns
+        )
+        for seed in seeds
+    ]
+
+
+@attrs.define
+class Tuner:
+    """Search for the values of some parameters of a character that best
+    meet a target against a roster of opponents, using successive halving.
+
+    Every candidate starts with `min_battles` battles against each
+    opponent. After each round, the best `1 / eta` of the candidates
+    survive and fight `eta` times as many battles, until one candidate is
+    left or `max_battles` is reached.
+
+    All results are saved to `output_path` as they arrive. Candidates are
+    drawn from a seeded generator, so running the same search again
+    resumes from the saved results instead of starting over.
+    """
+
+    pack: content.ContentPack
+    name: str
+    parameters: Sequence[Parameter]
+    opponents: Sequence[str]
+    target: Target
+    output_path: Path
+    candidates: int = 27
+    eta: int = 3
+    min_battles: int = 4
+    max_battles: int = 108
+    batch_size: int = 4
+    max_turns: int = 100
+    seed: int = 0
+    workers: int | None = None
+    # Maps point keys to opponent names to results
+    results: dict[str, dict[str, list[headless.BattleResult]]] = attrs.Factory(dict)
+
+    def __attrs_post_init__(self) -> None:
+        self.load()
+
+    @property
+    def content_hash(self) -> str:
+        names = [self.name, *self.opponents]
+        return content.hash_bytes(
+            str(balance.CACHE_VERSION).encode(),
+            str(self.max_turns).encode(),
+            *(self.pack.character_hash(name).encode() for name in names),
+        )
+
+    def load(self) -> None:
+        try:
+            data = json.loads(self.output_path.read_text())
+        except FileNotFoundError:
+            return
+        if data['content_hash'] != self.content_hash:
+            _logger.warning(
+                f'Ignoring results in {self.output_path} for outdated content'
+            )
+            return
+        self.results = {
+            key: {
+                opponent: [headless.BattleResult.from_json(r) for r in results]
+                for opponent, results in by_opponent.items()
+            }
+            for key, by_opponent in data['results'].items()
+        }
+
+    def save(self) -> None:
+        data = {
+            'content_hash': self.content_hash,
+            'results': {
+                key: {
+                    opponent: [result.to_json() for result in results]
+                    for opponent, results in by_opponent.items()
+                }
+                for key, by_opponent in self.results.items()
+            },
+        }
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.output_path.with_suffix('.tmp')
+        temp_path.write_text(json.dumps(data))
+        temp_path.replace(self.output_path)
+
+    def make_candidates(self) -> list[dict[str, float]]:
+        """Return the current values of the parameters, followed by
+        randomly sampled values.
+        """
+        rng = random.Random(self.seed)
+        character = self.pack.characters[self.name]
+        candidates = [get_point(character, self.parameters)]
+        while len(candidates) < self.candidates:
+            candidates.append({p.name: p.sample(rng) for p in self.parameters})
+        return candidates
+
+    def evaluate(self, point: Point) -> tuple[float, float]:
+        """Return the win rate of the point and the damage it deals per
+        battle, counting draws as half a win.
+        """
+        by_opponent = self.results.get(point_key(point), {})
+        battles = 0
+        score = 0.0
+        damage = 0
+        for opponent in self.opponents:
+            opponent_health = self.pack.characters[opponent].health
+            for result in by_opponent.get(opponent, ()):
+                battles += 1
+                score += 0.5 if result.winner is None else 1 - result.winner
+                damage += opponent_health - max(result.health[1], 0)
+        if not battles:
+            return 0.5, 0
+        return score / battles, damage / battles
+
+    def loss(self, point: Point) -> float:
+        return self.target.loss(*self.evaluate(point))
+
+    def run_round(
+        self,
+        executor: concurrent.futures.Executor,
+        candidates: Iterable[Point],
+        battles: int,
+    ) -> None:
+        """Make sure every candidate has at least `battles` results against
+        each opponent.
+        """
+        futures: dict[
+            concurrent.futures.Future[list[headless.BattleResult]], tuple[str, str]
+        ] = {}
+        for point in candidates:
+            key = point_key(point)
+            by_opponent = self.results.setdefault(key, {})
+            for opponent in self.opponents:
+                done = {result.seed for result in by_opponent.get(opponent, ())}
+                missing = [seed for seed in range(battles) if seed not in done]
+                for i in range(0, len(missing), self.batch_size):
+                    future = executor.submit(
+                        _run_point_batch,
+                        self.name,
+                        point,
+                        opponent,
+                        missing[i : i + self.batch_size],
+                        self.max_turns,
+                    )
+                    futures[future] = key, opponent
+        for future in concurrent.futures.as_completed(futures):
+            key, opponent = futures[future]
+            self.results[key].setdefault(opponent, []).extend(future.result())
+            self.save()
+
+    def run(self) -> list[tuple[dict[str, float], float]]:
+        """Run the search and return the final candidates with their losses,
+        best first.
+        """
+        candidates = self.make_candidates()
+        battles = self.min_battles
+        with concurrent.futures.ProcessPoolExecutor(
+            self.workers, initializer=headless.init_worker, initargs=(self.pack.root,)
+        ) as executor:
+            while True:
+                self.run_round(executor, candidates, battles)
+                candidates.sort(key=self.loss)
+                _logger.info(
+                    f'{len(candidates)} candidates after {battles} battles per'
+                    f' opponent, best loss {self.loss(candidates[0]):.4f}'
+                )
+                if len(candidates) == 1 or battles >= self.max_battles:
+                    break
+                candidates = candidates[: max(len(candidates) // self.eta, 1)]
+                battles = min(battles * self.eta, self.max_battles)
+        return [(point, self.loss(point)) for point in candidates]
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.set_defaults(command=run)
+    parser.add_argument('character', help='the character to tune')
+    parser.add_argument(
+        '-p',
+        '--param',
+        dest='parameters',
+        type=Parameter.parse,
+        action='append',
+        required=True,
+        help='a stat or measure to tune, as name=low:high'
+        ' (e.g. speed=1:5 or measures.arm_length=0.8:1.2)',
+    )
+    parser.add_argument(
+        '--opponents',
+        nargs='+',
+        help='the reference roster (by default, every other character)',
+    )
+    parser.add_argument('--target-win-rate', type=float)
+    parser.add_argument(
+        '--target-damage', type=float, help='average damage dealt per battle'
+    )
+    parser.add_argument('--data-dir', type=Path, default=content.DATA_DIR)
+    parser.add_argument(
+        '--output',
+        type=Path,
+        help='where to save results (by default, under .cache/tuning)',
+    )
+    parser.add_argument('--candidates', type=int, default=27)
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--min-battles', type=int, default=4)
+    parser.add_argument('--max-battles', type=int, default=108)
+    parser.add_argument('--max-turns', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+
+
+def run(args: argparse.Namespace) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    _logger.setLevel(logging.INFO)
+    if args.target_win_rate is None and args.target_damage is None:
+        args.target_win_rate = 0.5
+    pack = content.ContentPack.load(args.data_dir)
+    opponents = args.opponents or [
+        name for name in pack.characters if name != args.character
+    ]
+    output_path = args.output
+    if output_path is None:
+        parameters = ','.join(sorted(p.name for p in args.parameters))
+        target = f'{args.target_win_rate}-{args.target_damage}'
+        key = content.hash_bytes(parameters.encode(), target.encode())[:16]
+        output_path = Path(DEFAULT_OUTPUT_DIR, f'{args.character}-{key}.json')
+    tuner = Tuner(
+        pack,
+        args.character,
+        args.parameters,
+        opponents,
+        Target(args.target_win_rate, args.target_damage),
+        output_path,
+        candidates=args.candidates,
+        eta=args.eta,
+        min_battles=args.min_battles,
+        max_battles=args.max_battles,
+        max_turns=args.max_turns,
+        seed=args.seed,
+        workers=args.workers,
+    )
+    ranking = tuner.run()
+    for point, loss in ranking:
+        win_rate, damage = tuner.evaluate(point)
+        values = ', '.join(f'{name}={value:.3g}' for name, value in point.items())
+        print(
+            f'{values}: win rate {win_rate:.0%}, damage {damage:.1f},'
+            f' loss {loss:.4f}'
+        )
+    print(f'Results saved to {output_path}')
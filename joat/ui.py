@@ -8,9 +8,10 @@ from typing_extensions import Self
 import attrs
 import imgui
 from attrs import field
+from direct.gui import DirectGuiGlobals as DGG
 from direct.gui.DirectGui import DirectButton, DirectFrame, OnscreenText
 from direct.showbase.DirectObject import DirectObject
-from panda3d.core import AsyncTaskPause
+from panda3d.core import AsyncFuture
 
 from . import moves
 from .characters import Action, Character, Fighter
@@ -68,10 +69,13 @@ class CharacterMenu:
     backdrop: DirectFrame
     character_view: DirectFrame
     confirmation_button: DirectButton | None = None
+    # Buttons by character name, disabled until the character is ready
+    buttons: dict[str, DirectButton]
+    _spots: Iterator[tuple[float, ...]]
 
     def __init__(
         self,
-        characters: Iterable[Character],
+        characters: Iterable[Character] = (),
         *,
         confirmation_callback: Callable[[Character], object] | None = None,
         back_callback: Callable[[], object] | None = None,
@@ -110,17 +114,37 @@ class CharacterMenu:
             scale=0.05,
             parent=self.backdrop,
         )
-        for char, (x, y) in zip(characters, uniform_spacing((4, 4), (0.5, 0.5))):
-            DirectButton(
-                text=char.name,
-                command=self.select_character,
-                extraArgs=[char],
-                pos=(y, 0, -x - 0.2),
-                frameSize=(-4, 4, -4, 4),
-                borderWidth=(0.25, 0.25),
-                scale=0.05,
-                parent=self.backdrop,
-            )
+        self.buttons = {}
+        self._spots = uniform_spacing((4, 4), (0.5, 0.5))
+        for character in characters:
+            self.set_ready(character.name, character)
+
+    def add_loading(self, name: str) -> None:
+        """Add a disabled button for a character that is still loading."""
+        spot = next(self._spots, None)
+        if spot is None or name in self.buttons:
+            return
+        x, y = spot
+        self.buttons[name] = DirectButton(
+            text=f'{name}\n(loading)',
+            state=DGG.DISABLED,
+            pos=(y, 0, -x - 0.2),
+            frameSize=(-4, 4, -4, 4),
+            borderWidth=(0.25, 0.25),
+            scale=0.05,
+            parent=self.backdrop,
+        )
+
+    def set_ready(self, name: str, character: Character) -> None:
+        """Let a character be selected, adding a button for it if needed."""
+        self.add_loading(name)
+        button = self.buttons.get(name)
+        if button is None:
+            return
+        button['text'] = character.name
+        button['command'] = self.select_character
+        button['extraArgs'] = [character]
+        button['state'] = DGG.NORMAL
 
     def reset(self) -> None:
         self.selection = None
@@ -165,7 +189,12 @@ class BattleMenu:
 
     @classmethod
     def from_fighters(cls, *fighters: Fighter) -> Self:
-        return cls([FighterInterface.for_fighter(fighter) for fighter in fighters])
+        interfaces = []
+        for fighter in fighters:
+            opponents = [other for other in fighters if not fighter.is_ally(other)]
+            interface = FighterInterface.for_fighter(fighter, opponents=opponents)
+            interfaces.append(interface)
+        return cls(interfaces)
 
     def __attrs_post_init__(self) -> None:
         self.acceptor.accept('output_info', self.output_info)
@@ -193,22 +222,30 @@ class BattleMenu:
 class FighterInterface:
     available_moves: Iterable[Action]
     text: str = ''
-    selected_target: moves.Target | None = field(default=None, init=False)
+    # Returns the chance that an action hits and its expected damage,
+    # or `None` if they aren't known
+    estimate: Callable[[Action], tuple[float, float] | None] | None = None
+    opponents: Sequence[Fighter] = ()
+    # The opponent to use moves on, if the player has chosen one
+    focus: Fighter | None = field(default=None, init=False)
     selected_action: Action | None = field(default=None, init=False)
     shown: bool = field(default=False, init=False)
+    _pending: AsyncFuture | None = field(default=None, init=False, repr=False)
 
     @classmethod
-    def for_fighter(cls, fighter: Fighter) -> Self:
-        return cls(available_moves=fighter.moves)
+    def for_fighter(
+        cls, fighter: Fighter, *, opponents: Sequence[Fighter] = ()
+    ) -> Self:
+        return cls(available_moves=fighter.moves, opponents=opponents)
 
     def draw(self) -> None:
         imgui.text(self.text)
+        self.draw_opponents()
         with imgui.begin_group():
             for action in self.available_moves:
                 if imgui.button(action.name):
                     self.selected_action = action
-                    accuracy = getattr(action, 'accuracy', 100)
-                    self.text = f'{action.name}\nAccuracy: {accuracy}%'
+                    self.text = self.describe(action)
         imgui.same_line()
         if self.selected_action is None:
             imgui.text('Select a move...')
@@ -217,16 +254,43 @@ class FighterInterface:
             for target in moves.Target:
                 if target in self.selected_action.valid_targets:
                     if imgui.button(f'Use on {target.value}'):
-                        self.selected_target = target
+                        self.submit(self.selected_action, target)
+
+    def draw_opponents(self) -> None:
+        living = [opponent for opponent in self.opponents if opponent.health > 0]
+        if len(living) < 2:
+            return
+        imgui.text('Opponent:')
+        for opponent in living:
+            if imgui.radio_button(opponent.name, opponent is self.focus):
+                self.focus = opponent
+                if self.selected_action is not None:
+                    self.text = self.describe(self.selected_action)
+
+    def describe(self, action: Action) -> str:
+        estimate = None if self.estimate is None else self.estimate(action)
+        if estimate is None:
+            accuracy = getattr(action, 'accuracy', 100)
+            return f'{action.name}\nAccuracy: {accuracy}%'
+        hit_chance, damage = estimate
+        return f'{action.name}\nHit chance: {hit_chance:.0%}\nDamage: ~{damage:.0f}'
+
+    def submit(self, action: Action, target: moves.Target) -> None:
+        """Resolve the pending query, if there is one."""
+        if self._pending is not None and not self._pending.done():
+            self._pending.set_result((action, target))
 
     async def query_action(self) -> tuple[Action, moves.Target]:
+        self._pending = pending = AsyncFuture()
         self.show()
-        while self.selected_target is None or self.selected_action is None:
-            await AsyncTaskPause(0)
-        assert self.selected_target is not None
-        assert self.selected_action is not None
-        action, target = self.selected_action, self.selected_target
-        self.selected_target = None
+        try:
+            # Awaiting the future directly would only give the first
+            # element of a tuple result.
+            await pending
+            action, target = pending.result()
+        finally:
+            self._pending = None
+            self.hide()
         return action, target
 
     def hide(self) -> None:
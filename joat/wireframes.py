@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import math
+from typing import Any
+
+from panda3d import bullet
+from panda3d.core import GeomNode, LineSegs, NodePath, Quat, Vec3
+
+
+def describe_shape(shape: bullet.BulletShape) -> dict[str, Any]:
+    """Return what is needed to draw a shape, as JSON."""
+    if isinstance(shape, bullet.BulletBoxShape):
+        return {'type': 'box', 'half_extents': list(shape.half_extents_with_margin)}
+    if isinstance(shape, bullet.BulletSphereShape):
+        return {'type': 'sphere', 'radius': shape.radius}
+    if isinstance(shape, bullet.BulletCapsuleShape):
+        # Panda3D doesn't expose the axis of a capsule, but every capsule
+        # in the game is along y.
+        return {'type': 'capsule', 'radius': shape.radius, 'height': shape.height}
+    if isinstance(shape, bullet.BulletCylinderShape):
+        # Likewise, every cylinder is along z.
+        return {
+            'type': 'cylinder',
+            'radius': shape.radius,
+            'height': shape.half_extents_with_margin.z * 2,
+        }
+    return {'type': 'unknown'}
+
+
+def _draw_circle(
+    segments: LineSegs,
+    center: Vec3,
+    u: Vec3,
+    v: Vec3,
+    radius: float,
+    *,
+    steps: int = 16,
+) -> None:
+    segments.move_to(center + u * radius)
+    for i in range(1, steps + 1):
+        angle = 2 * math.pi * i / steps
+        segments.draw_to(center + (u * math.cos(angle) + v * math.sin(angle)) * radius)
+
+
+def draw_shape(shape: dict[str, Any]) -> GeomNode:
+    """Return a wireframe of a shape described by `describe_shape`."""
+    segments = LineSegs()
+    x, y, z = Vec3.unit_x(), Vec3.unit_y(), Vec3.unit_z()
+    if shape['type'] == 'box':
+        hx, hy, hz = shape['half_extents']
+        corners = [
+            Vec3(sx * hx, sy * hy, sz * hz)
+            for sx in (-1, 1)
+            for sy in (-1, 1)
+            for sz in (-1, 1)
+        ]
+        for i, a in enumerate(corners):
+            for b in corners[i + 1 :]:
+                # Corners along an edge differ in exactly one coordinate.
+                if sum(a[k] != b[k] for k in range(3)) == 1:
+                    segments.move_to(a)
+                    segments.draw_to(b)
+    elif shape['type'] == 'sphere':
+        for u, v in ((x, y), (y, z), (z, x)):
+            _draw_circle(segments, Vec3.zero(), u, v, shape['radius'])
+    elif shape['type'] == 'capsule':
+        radius, half_height = shape['radius'], shape['height'] / 2
+        for end in (-half_height, half_height):
+            center = y * end
+            _draw_circle(segments, center, z, x, radius)
+            _draw_circle(segments, center, x, y, radius)
+            _draw_circle(segments, center, y, z, radius)
+        for offset in (x, -x, z, -z):
+            segments.move_to(offset * radius - y * half_height)
+            segments.draw_to(offset * radius + y * half_height)
+    elif shape['type'] == 'cylinder':
+        radius, half_height = shape['radius'], shape['height'] / 2
+        for end in (-half_height, half_height):
+            _draw_circle(segments, z * end, x, y, radius)
+        for offset in (x, -x, y, -y):
+            segments.move_to(offset * radius - z * half_height)
+            segments.draw_to(offset * radius + z * half_height)
+    return segments.create()
+
+
+def describe_body(node: bullet.BulletBodyNode) -> list[dict[str, Any]]:
+    """Return what is needed to draw every shape of a body, as JSON, with
+    the position and rotation of each relative to the body.
+    """
+    shapes = []
+    for i, shape in enumerate(node.shapes):
+        transform = node.get_shape_transform(i)
+        shapes.append(
+            {
+                **describe_shape(shape),
+                'position': list(transform.get_pos()),
+                'rotation': list(transform.get_quat()),
+            }
+        )
+    return shapes
+
+
+def draw_body(shapes: list[dict[str, Any]]) -> NodePath:
+    """Return wireframes of the shapes of a body described by
+    `describe_body`, placed relative to it.
+    """
+    drawing = NodePath('Wireframe')
+    for shape in shapes:
+        wireframe = drawing.attach_new_node(draw_shape(shape))
+        wireframe.set_pos_quat(Vec3(*shape['position']), Quat(*shape['rotation']))
+    drawing.flatten_strong()
+    return drawing
+
+
+def draw_grid(size: float, spacing: float = 1) -> GeomNode:
+    """Return a square grid of lines on the plane z = 0, centred on the
+    origin, to draw the ground with.
+    """
+    segments = LineSegs()
+    half_size = size / 2
+    steps = max(round(size / spacing), 1)
+    for i in range(steps + 1):
+        offset = i * size / steps - half_size
+        segments.move_to(offset, -half_size, 0)
+        segments.draw_to(offset, half_size, 0)
+        segments.move_to(-half_size, offset, 0)
+        segments.draw_to(half_size, offset, 0)
+    return segments.create()